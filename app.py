@@ -3,16 +3,31 @@ Quart应用，提供网页对话界面
 """
 
 import os
+import time
 import asyncio
+import secrets
 import subprocess
 import signal
 import sys
-import threading
 import json
-from quart import Quart, render_template, jsonify, websocket, request
+import functools
+from typing import Dict, Any, Optional, Tuple
+from quart import Quart, render_template, jsonify, websocket, request, Response
 from dotenv import load_dotenv
 
 from mcp_client import mcp_llm_client
+from stream_coalescer import coalesce_stream
+from stream_events import serialize_event, make_event, error_event, EVENT_DONE
+from cancellation import CancellationToken
+from stream_buffer import ResumableStream, stream_registry
+from llm_scheduler import llm_scheduler
+from llm_endpoints import endpoint_pool
+from llm_hedging import hedge_stats
+from completion_cache import completion_cache
+from metrics import metrics_registry, Gauge, chat_turn_duration, active_websockets
+from tracing import tracer, span
+from profiler import runtime_profiler
+from loop_monitor import loop_monitor
 import db_utils
 
 # 加载环境变量
@@ -22,10 +37,19 @@ load_dotenv()
 app = Quart(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", os.urandom(24).hex())
 
+# WebSocket心跳间隔（秒）
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))
+
+# 管理接口（性能分析、事件循环延迟）的访问令牌，未设置时这些接口返回404
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
 # 全局变量
 mcp_server_process = None
 client_initialized = False
-initialization_lock = threading.Lock()
+# 每个工作进程各自初始化一次MCP客户端，并发的首批请求等待同一次初始化完成
+initialization_lock = asyncio.Lock()
+# 进行中的聊天请求任务，保持引用避免被垃圾回收，服务关闭时取消
+chat_tasks = set()
 
 # 启动MCP服务器(这里为前期测试代码，目前已注释)
 def start_mcp_server():
@@ -92,11 +116,7 @@ async def initialize_client():
     """
     global client_initialized
 
-    print("初始化MCP客户端", initialization_lock.locked())
-    if(initialization_lock.locked()) :
-        return
-    with initialization_lock:
-        print("inside lock")
+    async with initialization_lock:
         if client_initialized:
             return
 
@@ -251,10 +271,17 @@ async def get_session_messages(session_id):
         # 转换为前端需要的格式
         messages = []
         for conv in conversations:
-            messages.append({
+            message = {
                 'role': conv['role'],
                 'content': conv['content']
-            })
+            }
+            if conv['prompt_tokens'] is not None or conv['completion_tokens'] is not None:
+                message['usage'] = {
+                    'prompt_tokens': conv['prompt_tokens'],
+                    'completion_tokens': conv['completion_tokens'],
+                    'estimated': bool(conv['usage_estimated'])
+                }
+            messages.append(message)
 
         return jsonify({
             'status': 'success',
@@ -267,6 +294,224 @@ async def get_session_messages(session_id):
         }), 400
 
 
+@app.route('/api/sessions/<int:session_id>/usage', methods=['GET'])
+async def get_session_usage(session_id):
+    """
+    获取会话的token用量统计（合计、提示词大小以及每次LLM调用的用量）
+    """
+    return jsonify({'status': 'success', 'usage': db_utils.get_session_usage(session_id)})
+
+
+@app.route('/api/search', methods=['GET'])
+async def search_conversations():
+    """
+    全文搜索对话历史，支持分页
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({
+            'status': 'error',
+            'message': '缺少搜索关键词'
+        }), 400
+
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = min(max(int(request.args.get('page_size', 20)), 1), 100)
+        session_id = request.args.get('session_id')
+        session_id = int(session_id) if session_id else None
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'无效的分页参数: {str(e)}'
+        }), 400
+
+    try:
+        results, total = db_utils.search_conversations(
+            query,
+            limit=page_size,
+            offset=(page - 1) * page_size,
+            session_id=session_id
+        )
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'搜索对话历史失败: {str(e)}'
+        }), 400
+
+    return jsonify({
+        'status': 'success',
+        'query': query,
+        'page': page,
+        'page_size': page_size,
+        'total': total,
+        'results': results
+    })
+
+
+@app.route('/api/scheduler', methods=['GET'])
+async def get_scheduler_stats():
+    """
+    获取LLM请求调度器的统计信息（排队深度、进行中请求数、等待时间）
+    """
+    return jsonify({'status': 'success', 'stats': llm_scheduler.get_stats()})
+
+
+@app.route('/api/endpoints', methods=['GET'])
+async def get_endpoint_stats():
+    """
+    获取LLM服务端点的健康状态、首token延迟和对冲请求统计
+    """
+    return jsonify({'status': 'success', 'endpoints': endpoint_pool.get_stats(), 'hedging': hedge_stats.get_stats()})
+
+
+@app.route('/api/mcp/health', methods=['GET'])
+async def get_mcp_health():
+    """
+    获取各MCP服务器的健康状态（可用、掉线重连中或熔断中）、重连次数和最近的错误，以及按需启动的服务器是否正在运行
+    """
+    return jsonify({'status': 'success', 'servers': mcp_llm_client.health_monitor.get_stats(),
+                    'lazy': mcp_llm_client.get_lazy_stats()})
+
+
+@app.route('/api/cache', methods=['GET'])
+async def get_cache_stats():
+    """
+    获取LLM补全缓存的命中率和容量
+    """
+    return jsonify({'status': 'success', 'stats': completion_cache.get_stats()})
+
+
+@app.route('/api/cache', methods=['DELETE'])
+async def clear_cache():
+    """
+    清空LLM补全缓存
+    """
+    completion_cache.clear()
+    return jsonify({'status': 'success', 'message': '已清空补全缓存'})
+
+
+# 调度器和可恢复流的状态在输出指标时读取
+metrics_registry.register(Gauge(
+    "llm_scheduler_queue_depth", "等待调度器许可的LLM请求数",
+    function=lambda: llm_scheduler.get_stats()["queue_depth"]))
+metrics_registry.register(Gauge(
+    "llm_scheduler_in_flight", "正在进行的上游LLM请求数",
+    function=lambda: llm_scheduler.get_stats()["in_flight"]))
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    """
+    以Prometheus文本格式输出运行指标
+    """
+    return Response(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/api/traces', methods=['GET'])
+async def get_traces():
+    """
+    获取最近几轮对话的追踪摘要（各类片段的耗时合计）
+    """
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        limit = 20
+    return jsonify({'status': 'success', 'traces': tracer.get_traces(limit)})
+
+
+@app.route('/api/traces/<trace_id>', methods=['GET'])
+async def get_trace(trace_id):
+    """
+    获取一轮对话的完整追踪片段树
+    """
+    trace = tracer.get_trace(trace_id)
+    if trace is None:
+        return jsonify({'status': 'error', 'message': '追踪不存在或已被移出缓冲区'}), 404
+    return jsonify({'status': 'success', 'trace': trace})
+
+
+def admin_required(func):
+    """
+    管理接口的访问控制：未设置ADMIN_TOKEN时返回404，请求头中的令牌不匹配时返回403
+
+    令牌通过请求头`Authorization: Bearer <令牌>`或`X-Admin-Token`传递
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'status': 'error', 'message': '管理接口未启用'}), 404
+        token = request.headers.get('X-Admin-Token', '')
+        authorization = request.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):].strip()
+        if not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({'status': 'error', 'message': '管理令牌无效'}), 403
+        return await func(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/api/admin/profile', methods=['GET'])
+@admin_required
+async def get_profile():
+    """
+    获取性能分析状态和最近一次分析的结果
+
+    查询参数format=text时以纯文本返回最近一次的结果（采样分析为火焰图使用的折叠栈，其他方式为统计表）
+    """
+    if request.args.get('format') == 'text':
+        text = runtime_profiler.get_text()
+        if text is None:
+            return jsonify({'status': 'error', 'message': '还没有性能分析结果'}), 404
+        return Response(text, content_type='text/plain; charset=utf-8')
+    return jsonify({'status': 'success', **runtime_profiler.get_status(), 'result': runtime_profiler.get_result()})
+
+
+@app.route('/api/admin/profile', methods=['POST'])
+@admin_required
+async def start_profile():
+    """
+    开始性能分析
+
+    请求体: {"mode": "sample" | "cprofile" | "yappi", "duration": 秒数, "turns": 轮数}
+    只指定turns时分析接下来的若干轮对话，都不指定时分析30秒
+    """
+    data = await request.get_json(silent=True) or {}
+    try:
+        duration = float(data['duration']) if data.get('duration') is not None else None
+        turns = int(data['turns']) if data.get('turns') is not None else None
+        status = runtime_profiler.start(asyncio.get_running_loop(), data.get('mode', 'sample'), duration, turns)
+    except (TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 409
+    return jsonify({'status': 'success', **status})
+
+
+@app.route('/api/admin/profile', methods=['DELETE'])
+@admin_required
+async def stop_profile():
+    """
+    提前停止性能分析并返回结果
+    """
+    result = runtime_profiler.stop()
+    if result is None:
+        return jsonify({'status': 'error', 'message': '没有正在进行的性能分析'}), 404
+    return jsonify({'status': 'success', 'result': result})
+
+
+@app.route('/api/admin/loop-lag', methods=['GET'])
+@admin_required
+async def get_loop_lag():
+    """
+    获取事件循环延迟监控的统计和最近的阻塞记录（含阻塞时的调用栈）
+    """
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        limit = 20
+    return jsonify({'status': 'success', 'stats': loop_monitor.get_stats(limit)})
+
+
 @app.route('/api/tools', methods=['GET'])
 async def get_tools():
     """
@@ -356,51 +601,210 @@ async def set_llm_params():
     })
 
 
+async def run_chat_request(stream: ResumableStream, user_message: str, session_id: int) -> None:
+    """
+    处理一次聊天请求，将事件发布到可恢复流
+
+    Args:
+        stream: 该请求的可恢复流，流ID即客户端的请求ID
+        user_message: 用户消息
+        session_id: 会话ID
+    """
+    cancel_token = stream.cancel_token
+    start_time = asyncio.get_running_loop().time()
+    outcome = 'error'
+    with tracer.trace('chat_turn', session_id=session_id, request_id=stream.stream_id) as trace:
+        stream.trace = trace
+        try:
+            # 同一会话的请求按顺序处理，不同会话并发处理
+            lock = mcp_llm_client.session_lock(session_id)
+            with span('session_lock_wait'):
+                await lock.acquire()
+            try:
+                # 排队期间已取消的请求不再处理
+                if not cancel_token.cancelled:
+                    # 处理事件流，细碎的增量按时间窗口合并后再发送
+                    async for event in coalesce_stream(mcp_llm_client.process_message(user_message, session_id, cancel_token)):
+                        stream.publish(event)
+            finally:
+                lock.release()
+
+            # 发布结束事件
+            if cancel_token.cancelled:
+                print(f"请求 {stream.stream_id} 已停止")
+                stream.publish(make_event(EVENT_DONE, cancelled=True))
+                outcome = 'cancelled'
+            else:
+                stream.publish(make_event(EVENT_DONE))
+                outcome = 'completed'
+        except asyncio.CancelledError:
+            # 服务关闭时任务被取消
+            print(f"请求 {stream.stream_id} 已取消")
+            stream.publish(make_event(EVENT_DONE, cancelled=True))
+            raise
+        except Exception as e:
+            print(f"处理请求 {stream.stream_id} 时出错: {str(e)}")
+            stream.publish(error_event(f"处理消息时出错: {str(e)}"))
+            stream.publish(make_event(EVENT_DONE))
+        finally:
+            trace.root.set(outcome=outcome)
+            chat_turn_duration.observe(asyncio.get_running_loop().time() - start_time, outcome=outcome)
+            runtime_profiler.turn_finished()
+            stream_registry.finish(stream)
+
+
 @app.websocket('/api/ws')
 async def ws():
     """
     WebSocket处理聊天请求
+
+    长连接，一个连接上可以同时进行多个请求。客户端发送的消息:
+        {"type": "chat", "id": 请求ID, "message": 用户消息, "session_id": 会话ID}
+        {"type": "stop", "id": 请求ID}（也可使用"cancel"）
+        {"type": "resume", "id": 请求ID, "last_seq": 已收到的最后序号}
+        {"type": "ping"}
+    服务器发送的每一帧是一个紧凑的JSON事件（见stream_events模块），带有对应的请求ID和序号seq，
+    每个请求以done事件结束；另外定期发送heartbeat帧，并以pong响应ping。
+    连接断开后生成继续进行并缓存在服务器端，客户端重连后用resume从last_seq之后继续接收；
+    超过等待时间仍未恢复，或收到stop时，通过取消令牌中止上游LLM流和工具调用，已生成的部分回复会保存到对话历史。
+    客户端在连接URL中带上client_key，请求只能由创建它的客户端（相同的client_key）恢复或停止；
+    未提供时使用仅属于本连接的随机密钥，断线后无法恢复
     """
     # 确保客户端已初始化
     if not client_initialized:
         await initialize_client()
 
-    # 接收第一条消息（用户问题）
-    try:
-        data = await websocket.receive()
-        message_data = json.loads(data)
-        user_message = message_data.get('message', '')
-        session_id = message_data.get('session_id', mcp_llm_client.current_session_id)
-
-        if not user_message:
-            await websocket.send(json.dumps({'error': '消息不能为空'}))
-            return
+    connection = websocket._get_current_object()
+    client_key = websocket.args.get('client_key') or secrets.token_hex(16)
+    send_lock = asyncio.Lock()
+    # 本连接接收中的流: 请求ID -> (流, 订阅队列, 转发任务)
+    attachments: Dict[str, Tuple[ResumableStream, asyncio.Queue, asyncio.Task]] = {}
+
+    async def send_event(event: Dict[str, Any], request_id: Optional[str] = None) -> None:
+        if request_id is not None:
+            event = dict(event, id=request_id)
+        async with send_lock:
+            await connection.send(serialize_event(event))
+
+    async def forward(stream: ResumableStream, queue: asyncio.Queue) -> None:
+        # 将流的事件转发到本连接，订阅被关闭、流结束或发送失败时退出
+        # 发送耗时累积到追踪的ws_send片段中（每次接入一个片段）
+        send_span = None
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                if send_span is None and stream.trace is not None:
+                    send_span = stream.trace.start_span('ws_send', stream.trace.root,
+                                                        {'frames': 0, 'chars': 0, 'send_ms': 0.0})
+                send_start = time.perf_counter()
+                frame = serialize_event(dict(event, id=stream.stream_id))
+                async with send_lock:
+                    await connection.send(frame)
+                if send_span is not None:
+                    send_span.set(frames=send_span.attributes['frames'] + 1,
+                                  chars=send_span.attributes['chars'] + len(frame),
+                                  send_ms=send_span.attributes['send_ms'] + (time.perf_counter() - send_start) * 1000)
+                    send_span.end()
+                if event['type'] == EVENT_DONE:
+                    break
+        except Exception as e:
+            print(f"WebSocket发送失败: {str(e)}")
+        finally:
+            if stream.stream_id in attachments and attachments[stream.stream_id][1] is queue:
+                del attachments[stream.stream_id]
+            stream_registry.detach(stream, queue)
+
+    def attach(stream: ResumableStream, after_seq: int) -> bool:
+        queue = stream.attach(after_seq)
+        if queue is None:
+            return False
+        task = asyncio.create_task(forward(stream, queue))
+        attachments[stream.stream_id] = (stream, queue, task)
+        return True
+
+    async def heartbeat() -> None:
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            await send_event({'type': 'heartbeat'})
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    active_websockets.inc()
 
-        # 如果指定了会话ID且与当前会话不同，则切换会话
-        if session_id != mcp_llm_client.current_session_id:
+    try:
+        while True:
+            data = await connection.receive()
             try:
-                mcp_llm_client.switch_session(session_id)
-            except Exception as e:
-                await websocket.send(f"[ERROR]切换会话失败: {str(e)}")
-                return
-
-        # 处理消息流
-        async for chunk in mcp_llm_client.process_message(user_message):
-            # 发送消息块
-            await websocket.send(chunk)
-
-        # 发送一个特殊标记表示流结束
-        await websocket.send("[DONE]")
+                message_data = json.loads(data)
+            except (TypeError, ValueError):
+                message_data = None
+            # 合法的JSON但不是对象（如[]、1），或请求ID不是字符串/整数时只拒绝这一帧，不关闭连接
+            if not isinstance(message_data, dict) or not isinstance(message_data.get('id'), (str, int, type(None))):
+                await send_event(error_event('无效的消息格式'))
+                continue
+
+            message_type = message_data.get('type', 'chat')
+            request_id = message_data.get('id')
+
+            if message_type == 'ping':
+                await send_event({'type': 'pong'})
+
+            elif message_type in ('stop', 'cancel'):
+                stream = stream_registry.get(request_id, client_key)
+                if stream is not None:
+                    stream.cancel_token.cancel()
+
+            elif message_type == 'resume':
+                try:
+                    last_seq = max(int(message_data.get('last_seq', 0)), 0)
+                except (TypeError, ValueError):
+                    await send_event(error_event('无效的last_seq', fatal=False), request_id)
+                    continue
+                stream = stream_registry.get(request_id, client_key)
+                if stream is None or not attach(stream, last_seq):
+                    # 流已过期或所需事件已被移出缓冲区
+                    await send_event(error_event('无法恢复该请求的输出，请刷新对话历史'), request_id)
+                    await send_event(make_event(EVENT_DONE, resumed=False), request_id)
+
+            elif message_type == 'chat':
+                user_message = message_data.get('message', '')
+                session_id = message_data.get('session_id', mcp_llm_client.current_session_id)
+
+                if not user_message:
+                    await send_event(error_event('消息不能为空'), request_id)
+                    await send_event(make_event(EVENT_DONE), request_id)
+                    continue
+
+                stream = (stream_registry.create(request_id, CancellationToken(), client_key)
+                          if request_id is not None else None)
+                if stream is None:
+                    await send_event(error_event(f'请求ID无效或重复: {request_id}'), request_id)
+                    # 缺少ID的请求同样以done结束；ID重复时不发送，避免结束使用该ID的进行中请求
+                    if request_id is None:
+                        await send_event(make_event(EVENT_DONE))
+                    continue
+
+                attach(stream, 0)
+                task = asyncio.create_task(run_chat_request(stream, user_message, session_id))
+                chat_tasks.add(task)
+                task.add_done_callback(chat_tasks.discard)
+
+            else:
+                await send_event(error_event(f'未知的消息类型: {message_type}'), request_id)
     except asyncio.CancelledError:
         # WebSocket连接被客户端关闭
         print("WebSocket连接被客户端关闭")
         raise
     except Exception as e:
         print(f"WebSocket处理出错: {str(e)}")
-        try:
-            await websocket.send(f"[ERROR]处理消息时出错: {str(e)}")
-        except:
-            pass
+    finally:
+        # 连接关闭时保留进行中的生成等待客户端重连，超过等待时间后才停止
+        heartbeat_task.cancel()
+        active_websockets.dec()
+        for stream, queue, task in list(attachments.values()):
+            task.cancel()
+            stream_registry.detach(stream, queue)
 
 
 @app.before_serving
@@ -411,13 +815,23 @@ async def before_serving():
     # 启动MCP服务器
     # start_mcp_server()
 
+    # 监控事件循环延迟
+    loop_monitor.start()
+
 
 @app.after_serving
 async def after_serving():
     """
     在服务结束后执行的操作
     """
+    # 停止进行中的聊天请求
+    for task in list(chat_tasks):
+        task.cancel()
+    await asyncio.gather(*chat_tasks, return_exceptions=True)
+
     # 清理资源
+    runtime_profiler.stop()
+    await loop_monitor.stop()
     await cleanup()
 
 
@@ -0,0 +1,132 @@
+"""
+对冲请求的首token延迟基准测试
+
+模拟两个服务端点：首token延迟大部分较短，但以一定概率出现长尾延迟。
+比较只请求首个端点和启用对冲请求时的首token延迟分位数，以及对冲带来的额外请求比例和token开销
+
+用法:
+    python benchmarks/bench_hedging.py --requests 400 --tail-probability 0.05
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cancellation import CancellationToken, GenerationCancelled
+from llm_hedging import hedged_stream, hedge_delay, HedgeStats
+
+PROMPT_TOKENS = 500
+
+
+class FakeServer:
+    """
+    模拟的流式服务：按注入的延迟输出首token，之后按固定间隔输出其余token
+    """
+
+    def __init__(self, name: str, base_ttft: float, tail_ttft: float, tail_probability: float,
+                 tokens: int, token_interval: float, rng: random.Random):
+        self.name = name
+        self.base_ttft = base_ttft
+        self.tail_ttft = tail_ttft
+        self.tail_probability = tail_probability
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.rng = rng
+        self.started = 0
+        self.cancelled = 0
+
+    async def stream(self, token: CancellationToken):
+        self.started += 1
+        if self.rng.random() < self.tail_probability:
+            ttft = self.tail_ttft * self.rng.uniform(0.8, 1.2)
+        else:
+            ttft = self.base_ttft * self.rng.uniform(0.5, 1.5)
+        try:
+            await token.run(asyncio.sleep(ttft))
+            for i in range(self.tokens):
+                if i:
+                    await token.run(asyncio.sleep(self.token_interval))
+                yield f"{self.name}-{i} "
+        except GenerationCancelled:
+            self.cancelled += 1
+            raise
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def measure(args, hedging: bool):
+    rng = random.Random(args.seed)
+    primary = FakeServer("a", args.base_ttft, args.tail_ttft, args.tail_probability, args.tokens, args.token_interval, rng)
+    secondary = FakeServer("b", args.base_ttft, args.tail_ttft, args.tail_probability, args.tokens, args.token_interval, rng)
+    stats = HedgeStats()
+    ttfts = []
+    primary_samples = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one_request():
+        async with semaphore:
+            start = time.perf_counter()
+            first = None
+            if hedging:
+                stream = hedged_stream(primary.stream, secondary.stream, hedge_delay(primary_samples, args.percentile),
+                                       stats, PROMPT_TOKENS)
+            else:
+                stream = primary.stream(CancellationToken())
+            async for chunk in stream:
+                if first is None:
+                    first = time.perf_counter() - start
+                    if chunk.startswith("a-"):
+                        primary_samples.append(first)
+            ttfts.append(first)
+
+    # 预热：积累首个端点的延迟样本
+    for _ in range(args.warmup):
+        start = time.perf_counter()
+        async for _chunk in primary.stream(CancellationToken()):
+            primary_samples.append(time.perf_counter() - start)
+            break
+
+    await asyncio.gather(*(one_request() for _ in range(args.requests)))
+    return ttfts, stats, primary, secondary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对冲请求基准测试")
+    parser.add_argument("--requests", type=int, default=400, help="请求数")
+    parser.add_argument("--concurrency", type=int, default=20, help="并发请求数")
+    parser.add_argument("--base-ttft", type=float, default=0.05, help="正常情况下的首token延迟（秒）")
+    parser.add_argument("--tail-ttft", type=float, default=1.0, help="长尾情况下的首token延迟（秒）")
+    parser.add_argument("--tail-probability", type=float, default=0.05, help="出现长尾延迟的概率")
+    parser.add_argument("--tokens", type=int, default=20, help="每个回复的token数")
+    parser.add_argument("--token-interval", type=float, default=0.005, help="token之间的间隔（秒）")
+    parser.add_argument("--percentile", type=float, default=0.9, help="对冲截止时间使用的分位数")
+    parser.add_argument("--warmup", type=int, default=50, help="预热请求数")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    args = parser.parse_args()
+
+    baseline, _, _, _ = asyncio.run(measure(args, hedging=False))
+    hedged, stats, primary, secondary = asyncio.run(measure(args, hedging=True))
+
+    print(f"请求数: {args.requests}, 长尾概率: {args.tail_probability:.0%}, 长尾延迟: {args.tail_ttft:.2f}s\n")
+    print(f"{'':10}{'p50(ms)':>10}{'p90(ms)':>10}{'p99(ms)':>10}{'最大(ms)':>10}")
+    for name, values in (("不对冲", baseline), ("对冲", hedged)):
+        print(f"{name:8}{percentile(values, 0.5) * 1000:>10.1f}{percentile(values, 0.9) * 1000:>10.1f}"
+              f"{percentile(values, 0.99) * 1000:>10.1f}{max(values) * 1000:>10.1f}")
+
+    result = stats.get_stats()
+    baseline_tokens = args.requests * (PROMPT_TOKENS + args.tokens)
+    print(f"\n发起对冲: {result['hedged']} 次 ({result['hedge_rate']:.1%})，对冲胜出: {result['hedge_wins']} 次")
+    print(f"额外token: {result['extra_tokens']}（约占总开销的 {result['extra_tokens'] / baseline_tokens:.1%}），"
+          f"被取消的请求: {primary.cancelled + secondary.cancelled}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+LLM请求调度器的限流与公平性基准测试
+
+使用本地模拟的限流服务（与服务商一样按令牌桶连续补充RPM/TPM额度，超限返回429，客户端按指数退避重试），
+比较直接请求和经过调度器请求时：收到429的次数、重度会话和轻量会话的完成时间，以及调度器的排队统计
+
+用法:
+    python benchmarks/bench_llm_scheduler.py --rpm 20 --heavy-requests 24 --light-sessions 6
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_scheduler import LLMScheduler, TokenBucket
+
+MODEL = "fake-model"
+
+
+class RateLimitedServer:
+    """
+    模拟的LLM服务：请求数和token数额度各为一个令牌桶，额度不足时返回429
+    """
+
+    def __init__(self, rpm: float, tpm: float, latency: float):
+        self.request_bucket = TokenBucket(rpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.latency = latency
+        self.rejected = 0
+        self.accepted = 0
+
+    async def complete(self, tokens: int) -> int:
+        if self.request_bucket.delay(1) > 0 or self.token_bucket.delay(tokens) > 0:
+            self.rejected += 1
+            return 429
+        self.request_bucket.consume(1)
+        self.token_bucket.consume(tokens)
+        self.accepted += 1
+        await asyncio.sleep(self.latency)
+        return 200
+
+
+async def run_scenario(server: RateLimitedServer, scheduler, args) -> dict:
+    latencies = {"heavy": [], "light": []}
+
+    async def request(session_id, kind):
+        start = time.monotonic()
+        for attempt in range(args.retries + 1):
+            if scheduler is not None:
+                reservation = await scheduler.acquire(session_id, MODEL, args.tokens)
+                try:
+                    status = await server.complete(args.tokens)
+                finally:
+                    scheduler.release(reservation)
+            else:
+                status = await server.complete(args.tokens)
+            if status == 200:
+                latencies[kind].append(time.monotonic() - start)
+                return
+            # 收到429后指数退避重试
+            await asyncio.sleep(args.backoff * 2 ** attempt)
+
+    tasks = [request("heavy", "heavy") for _ in range(args.heavy_requests)]
+    await asyncio.sleep(0)
+    for session in range(args.light_sessions):
+        tasks.extend(request(f"light-{session}", "light") for _ in range(args.light_requests))
+
+    start = time.monotonic()
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - start
+
+    def mean(values):
+        return sum(values) / len(values) if values else 0.0
+
+    return {
+        "elapsed": elapsed,
+        "completed": server.accepted,
+        "rejected": server.rejected,
+        "heavy_mean": mean(latencies["heavy"]),
+        "light_mean": mean(latencies["light"]),
+        "light_max": max(latencies["light"], default=0.0)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM请求调度器基准测试")
+    parser.add_argument("--rpm", type=float, default=20, help="模拟服务的每分钟请求数限制")
+    parser.add_argument("--tpm", type=float, default=200000, help="模拟服务的每分钟token数限制")
+    parser.add_argument("--tokens", type=int, default=1000, help="每个请求的token数")
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟服务的响应时间（秒）")
+    parser.add_argument("--concurrency", type=int, default=8, help="调度器的并发上限")
+    parser.add_argument("--heavy-requests", type=int, default=24, help="重度会话的请求数")
+    parser.add_argument("--light-sessions", type=int, default=6, help="轻量会话数")
+    parser.add_argument("--light-requests", type=int, default=2, help="每个轻量会话的请求数")
+    parser.add_argument("--retries", type=int, default=6, help="收到429后的最大重试次数")
+    parser.add_argument("--backoff", type=float, default=0.5, help="首次重试的等待时间（秒）")
+    args = parser.parse_args()
+
+    total = args.heavy_requests + args.light_sessions * args.light_requests
+    print(f"总请求数: {total}, 服务限制: {args.rpm:.0f} RPM / {args.tpm:.0f} TPM, 并发上限: {args.concurrency}")
+
+    direct = asyncio.run(run_scenario(RateLimitedServer(args.rpm, args.tpm, args.latency), None, args))
+
+    scheduler_holder = {}
+
+    async def scheduled():
+        # 调度器的限额略低于服务端，留出时钟误差的余量
+        scheduler = LLMScheduler(max_concurrency=args.concurrency,
+                                 rpm_limit=args.rpm * 0.95, tpm_limit=args.tpm * 0.95)
+        scheduler_holder["scheduler"] = scheduler
+        return await run_scenario(RateLimitedServer(args.rpm, args.tpm, args.latency), scheduler, args)
+
+    with_scheduler = asyncio.run(scheduled())
+
+    print(f"\n{'':12}{'完成':>8}{'429':>8}{'耗时(s)':>10}{'重度均值(s)':>14}{'轻量均值(s)':>14}{'轻量最大(s)':>14}")
+    for name, result in (("直接请求", direct), ("调度器", with_scheduler)):
+        print(f"{name:10}{result['completed']:>8}{result['rejected']:>8}{result['elapsed']:>10.2f}"
+              f"{result['heavy_mean']:>14.2f}{result['light_mean']:>14.2f}{result['light_max']:>14.2f}")
+
+    stats = scheduler_holder["scheduler"].get_stats()
+    print(f"\n调度器统计: 等待p50 {stats['wait_seconds_p50']:.3f}s, p95 {stats['wait_seconds_p95']:.3f}s, "
+          f"最大 {stats['wait_seconds_max']:.3f}s, 限流等待 {stats['rate_limited_waits']} 次")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""
+端到端负载测试
+
+在临时目录中启动模拟LLM服务（fake_llm_server.py）、以serve.py（Hypercorn多进程）运行的app.py（只配置模拟MCP服务器fake_mcp_server.py），
+然后由N个并发WebSocket客户端各自在独立会话中连续发送消息，统计吞吐量、首token延迟和整轮耗时的分位数，
+以及服务进程（含子进程）的CPU和内存占用。可将结果写入JSON文件，并在分位数超过阈值时以非零状态退出，
+用于发布前发现性能回退
+
+用法:
+    python benchmarks/bench_load.py --clients 20 --turns 5
+    python benchmarks/bench_load.py --clients 50 --ttft 0.5 --tool-call-probability 0.3 --tool-latency 0.2
+    python benchmarks/bench_load.py --output results.json --max-p95-turn 8 --max-p95-ttft 1.5
+    python benchmarks/bench_load.py --replay-file recorded.jsonl --clients 10
+    python benchmarks/bench_load.py --workers 4 --gateway --tool-call-probability 0.5
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# 首token：第一个携带模型输出的事件
+FIRST_TOKEN_EVENTS = ("text", "think_start", "think_delta", "tool_call_start")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class ProcessSampler:
+    """
+    定期采样进程树（进程及其所有子进程）的CPU和常驻内存，读取/proc，仅支持Linux
+    """
+
+    def __init__(self, pids, interval: float = 0.5):
+        self.pids = list(pids)
+        self.interval = interval
+        self.ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.cpu_samples = []
+        self.rss_samples = []
+
+    def _tree(self):
+        pids = list(self.pids)
+        i = 0
+        while i < len(pids):
+            try:
+                for task in os.listdir(f"/proc/{pids[i]}/task"):
+                    with open(f"/proc/{pids[i]}/task/{task}/children") as f:
+                        pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+            i += 1
+        return pids
+
+    def _read(self):
+        cpu_ticks = 0
+        rss_kb = 0
+        for pid in self._tree():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                cpu_ticks += int(fields[11]) + int(fields[12])  # utime + stime
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss_kb += int(line.split()[1])
+                            break
+            except (OSError, IndexError, ValueError):
+                pass
+        return cpu_ticks, rss_kb
+
+    async def run(self):
+        if not os.path.exists(f"/proc/{self.pids[0]}"):
+            return
+        last_ticks, _ = self._read()
+        last_time = time.perf_counter()
+        while True:
+            await asyncio.sleep(self.interval)
+            ticks, rss_kb = self._read()
+            now = time.perf_counter()
+            self.cpu_samples.append((ticks - last_ticks) / self.ticks / (now - last_time) * 100)
+            self.rss_samples.append(rss_kb / 1024)
+            last_ticks, last_time = ticks, now
+
+
+async def wait_ready(url: str, timeout: float) -> None:
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"等待服务启动超时: {url}")
+
+
+async def run_client(index: int, args, base_url: str, results: dict) -> None:
+    """
+    一个WebSocket客户端：创建独立会话，连续发送args.turns条消息
+    """
+    async with aiohttp.ClientSession() as http:
+        async with http.post(f"{base_url}/api/sessions", json={"name": f"负载测试-{index}"}) as response:
+            session_id = (await response.json())["session_id"]
+
+        async with http.ws_connect(f"{base_url.replace('http', 'ws', 1)}/api/ws", max_msg_size=0) as ws:
+            for turn in range(args.turns):
+                request_id = f"load-{index}-{turn}"
+                start = time.perf_counter()
+                first_token = None
+                failed = False
+                await ws.send_json({"type": "chat", "id": request_id, "session_id": session_id,
+                                    "message": f"第{turn + 1}个问题：请解释异步流式输出（客户端{index}）"})
+                while True:
+                    message = await ws.receive(timeout=args.turn_timeout)
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        raise RuntimeError(f"WebSocket连接已关闭: {message.type}")
+                    event = json.loads(message.data)
+                    if event.get("id") != request_id:
+                        continue
+                    if first_token is None and event["type"] in FIRST_TOKEN_EVENTS:
+                        first_token = time.perf_counter() - start
+                    if event["type"] == "error" and event.get("fatal", True):
+                        failed = True
+                    if event["type"] == "done":
+                        break
+                elapsed = time.perf_counter() - start
+                if failed or first_token is None:
+                    results["errors"] += 1
+                else:
+                    results["ttft"].append(first_token)
+                    results["turn"].append(elapsed)
+
+
+def start_process(command, cwd, env, log_path):
+    log = open(log_path, "w")
+    return subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_process(process) -> None:
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def run_load_test(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    llm_port = args.llm_port or free_port()
+    app_port = args.app_port or free_port()
+    llm_process = app_process = gateway_process = None
+
+    try:
+        # 只配置模拟MCP服务器
+        with open(os.path.join(workdir, "mcpServers.json"), "w", encoding="utf-8") as f:
+            json.dump({"mcpServers": {"LoadTest": {
+                "command": sys.executable,
+                "args": [os.path.join(BENCH_DIR, "fake_mcp_server.py")],
+                "env": {"FAKE_MCP_LATENCY": str(args.tool_latency)}
+            }}}, f)
+
+        if args.replay_file:
+            # 回放录制的真实LLM流
+            llm_command = [
+                sys.executable, os.path.join(BENCH_DIR, "replay_llm_server.py"), "--port", str(llm_port),
+                "--file", os.path.abspath(args.replay_file), "--speed", str(args.replay_speed)
+            ]
+        else:
+            llm_command = [
+                sys.executable, os.path.join(BENCH_DIR, "fake_llm_server.py"), "--port", str(llm_port),
+                "--ttft", str(args.ttft), "--tokens", str(args.tokens), "--tokens-per-sec", str(args.tokens_per_sec),
+                "--tool-call-probability", str(args.tool_call_probability)
+            ]
+        llm_process = start_process(llm_command, workdir, dict(os.environ), os.path.join(workdir, "fake_llm.log"))
+
+        env = dict(os.environ)
+        env.update({
+            "PYTHONPATH": REPO_DIR + os.pathsep + env.get("PYTHONPATH", ""),
+            "LLM_API_URL": f"http://127.0.0.1:{llm_port}/v1/chat/completions",
+            "LLM_API_MODEL": "fake-model",
+            "LLM_API_KEY": "load-test",
+            "LLM_ENDPOINTS": "",
+        })
+        for item in args.env:
+            key, _, value = item.partition("=")
+            env[key] = value
+        if args.gateway:
+            # 所有工作进程共用一个MCP工具网关
+            gateway_address = f"http://127.0.0.1:{free_port()}"
+            env["MCP_GATEWAY"] = gateway_address
+            gateway_process = start_process([sys.executable, os.path.join(REPO_DIR, "mcp_gateway.py")],
+                                            workdir, env, os.path.join(workdir, "gateway.log"))
+            await wait_ready(f"{gateway_address}/health", 60)
+        env.update({"WEB_BIND": f"127.0.0.1:{app_port}", "WEB_WORKERS": str(args.workers)})
+        app_process = start_process([sys.executable, os.path.join(REPO_DIR, "serve.py")],
+                                    workdir, env, os.path.join(workdir, "app.log"))
+
+        base_url = f"http://127.0.0.1:{app_port}"
+        await wait_ready(f"http://127.0.0.1:{llm_port}/stats", 30)
+        # /api/tools会触发MCP客户端初始化
+        await wait_ready(f"{base_url}/api/tools", 60)
+
+        sampler = ProcessSampler([process.pid for process in (app_process, gateway_process) if process is not None])
+        sampler_task = asyncio.create_task(sampler.run())
+        results = {"ttft": [], "turn": [], "errors": 0}
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(run_client(i, args, base_url, results) for i in range(args.clients)),
+                                        return_exceptions=True)
+        duration = time.perf_counter() - start
+        sampler_task.cancel()
+
+        failed_clients = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+        for outcome in failed_clients[:3]:
+            print(f"客户端出错: {outcome!r}")
+
+        completed = len(results["turn"])
+        return {
+            "config": {key: value for key, value in vars(args).items() if key not in ("output",)},
+            "duration_seconds": duration,
+            "completed_turns": completed,
+            "failed_turns": results["errors"],
+            "failed_clients": len(failed_clients),
+            "turns_per_second": completed / duration if duration else 0.0,
+            "ttft_seconds": {p: percentile(results["ttft"], q) for p, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+            "turn_seconds": {p: percentile(results["turn"], q) for p, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+            "cpu_percent": {"avg": sum(sampler.cpu_samples) / len(sampler.cpu_samples) if sampler.cpu_samples else None,
+                            "max": max(sampler.cpu_samples, default=None)},
+            "rss_mb": {"max": max(sampler.rss_samples, default=None)},
+        }
+    finally:
+        stop_process(app_process)
+        stop_process(gateway_process)
+        stop_process(llm_process)
+        if args.keep_workdir:
+            print(f"日志保留在: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="端到端负载测试")
+    parser.add_argument("--clients", type=int, default=20, help="并发WebSocket客户端数")
+    parser.add_argument("--turns", type=int, default=5, help="每个客户端发送的消息数")
+    parser.add_argument("--ttft", type=float, default=0.2, help="模拟LLM的首token延迟（秒）")
+    parser.add_argument("--tokens", type=int, default=100, help="模拟LLM每个回复的token数")
+    parser.add_argument("--tokens-per-sec", type=float, default=50, help="模拟LLM的生成速度")
+    parser.add_argument("--tool-call-probability", type=float, default=0.0, help="模拟LLM回复为工具调用的概率")
+    parser.add_argument("--tool-latency", type=float, default=0.1, help="模拟MCP工具的延迟（秒）")
+    parser.add_argument("--replay-file", type=str, default="", help="使用LLM_RECORD_FILE录制的文件回放LLM流，代替模拟LLM")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="回放速度倍数，0表示不等待")
+    parser.add_argument("--workers", type=int, default=1, help="Hypercorn工作进程数")
+    parser.add_argument("--gateway", action="store_true", help="启动MCP工具网关，所有工作进程通过网关调用工具")
+    parser.add_argument("--env", action="append", default=[], help="传给服务进程的环境变量，格式KEY=VALUE，可重复")
+    parser.add_argument("--app-port", type=int, default=0, help="服务端口，默认随机")
+    parser.add_argument("--llm-port", type=int, default=0, help="模拟LLM服务端口，默认随机")
+    parser.add_argument("--turn-timeout", type=float, default=120, help="单轮对话的超时时间（秒）")
+    parser.add_argument("--output", type=str, default="", help="结果写入的JSON文件")
+    parser.add_argument("--max-p95-turn", type=float, default=0, help="整轮耗时p95的上限（秒），超过时以非零状态退出")
+    parser.add_argument("--max-p95-ttft", type=float, default=0, help="首token延迟p95的上限（秒），超过时以非零状态退出")
+    parser.add_argument("--keep-workdir", action="store_true", help="保留临时目录（包含服务日志和数据库）")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    result = asyncio.run(run_load_test(args))
+
+    print(f"客户端: {args.clients}, 每个客户端 {args.turns} 轮, 工作进程: {args.workers}")
+    print(f"完成: {result['completed_turns']} 轮, 失败: {result['failed_turns']} 轮, "
+          f"耗时 {result['duration_seconds']:.1f}s, 吞吐量 {result['turns_per_second']:.2f} 轮/秒\n")
+    print(f"{'':14}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for name, key in (("首token延迟", "ttft_seconds"), ("整轮耗时", "turn_seconds")):
+        values = result[key]
+        print(f"{name:10}{values['p50'] * 1000:>10.0f}{values['p95'] * 1000:>10.0f}{values['p99'] * 1000:>10.0f}")
+    if result["cpu_percent"]["avg"] is not None:
+        print(f"\n服务进程（含子进程）CPU: 平均 {result['cpu_percent']['avg']:.0f}%，最高 {result['cpu_percent']['max']:.0f}%；"
+              f"最大常驻内存 {result['rss_mb']['max']:.0f} MB")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    failures = []
+    if args.max_p95_turn and result["turn_seconds"]["p95"] > args.max_p95_turn:
+        failures.append(f"整轮耗时p95 {result['turn_seconds']['p95']:.2f}s 超过 {args.max_p95_turn}s")
+    if args.max_p95_ttft and result["ttft_seconds"]["p95"] > args.max_p95_ttft:
+        failures.append(f"首token延迟p95 {result['ttft_seconds']['p95']:.2f}s 超过 {args.max_p95_ttft}s")
+    if result["failed_turns"] or result["failed_clients"]:
+        failures.append("存在失败的请求")
+    for failure in failures:
+        print(f"未通过: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
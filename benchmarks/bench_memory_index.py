@@ -0,0 +1,75 @@
+"""
+跨会话记忆向量索引的查询延迟基准测试
+
+用法:
+    python benchmarks/bench_memory_index.py --size 1000000 --queries 200
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from memory_index import MemoryIndex, EMBEDDING_DIM, embed_text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="记忆索引查询延迟基准测试")
+    parser.add_argument("--size", type=int, default=1000000, help="索引中的向量数量")
+    parser.add_argument("--queries", type=int, default=200, help="查询次数")
+    parser.add_argument("--top-k", type=int, default=5, help="每次查询返回的结果数")
+    parser.add_argument("--sessions", type=int, default=1000, help="模拟的会话数量")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base_path = os.path.join(tmp_dir, "bench.memory")
+        # 创建空索引文件，避免从对话数据库重建
+        for suffix in (".vec", ".ids"):
+            open(base_path + suffix, "wb").close()
+
+        index = MemoryIndex(base_path=base_path)
+
+        print(f"生成 {args.size} 个 {EMBEDDING_DIM} 维向量...")
+        rng = np.random.default_rng(0)
+        batch_size = 100000
+        start = time.perf_counter()
+        for offset in range(0, args.size, batch_size):
+            n = min(batch_size, args.size - offset)
+            vectors = rng.standard_normal((n, EMBEDDING_DIM), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            ids = np.empty((n, 2), dtype=np.int64)
+            ids[:, 0] = np.arange(offset, offset + n)
+            ids[:, 1] = rng.integers(1, args.sessions + 1, n)
+            index.add_vectors(vectors, ids, persist=False)
+        print(f"构建耗时: {time.perf_counter() - start:.2f}s, 内存占用约 {args.size * EMBEDDING_DIM * 4 / 1024 / 1024:.0f} MB")
+
+        queries = [f"如何在 Python 中使用 asyncio 处理第 {i} 个并发请求" for i in range(args.queries)]
+
+        start = time.perf_counter()
+        for query in queries:
+            embed_text(query)
+        embed_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+        latencies = []
+        for i, query in enumerate(queries):
+            start = time.perf_counter()
+            index.search(query, top_k=args.top_k, exclude_session_id=i % args.sessions + 1)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        latencies = np.array(latencies)
+        print(f"嵌入耗时: {embed_ms:.3f} ms/条")
+        print(
+            f"查询延迟 (含嵌入): p50={np.percentile(latencies, 50):.2f} ms, "
+            f"p95={np.percentile(latencies, 95):.2f} ms, "
+            f"p99={np.percentile(latencies, 99):.2f} ms, "
+            f"max={latencies.max():.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
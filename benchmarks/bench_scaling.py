@@ -0,0 +1,62 @@
+"""
+多进程扩展性测试
+
+以不同的工作进程数依次运行bench_load.py的端到端负载测试，比较吞吐量相对单进程的加速比和每个进程的效率（加速比/进程数）。
+模拟LLM应设置较高的生成速度和较多的客户端，使网页应用的CPU而不是模拟LLM的延迟成为瓶颈；
+模拟LLM服务本身是单进程的，进程数接近CPU核数时它也可能成为瓶颈，可观察其CPU占用判断
+
+用法:
+    python benchmarks/bench_scaling.py --workers-list 1,2,4 --clients 64 --turns 5 --ttft 0 --tokens 300 --tokens-per-sec 0
+    python benchmarks/bench_scaling.py --workers-list 1,2 --min-efficiency 0.8 --output scaling.json
+"""
+
+import os
+import sys
+import json
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_load import build_parser, run_load_test
+
+
+def main():
+    parser = build_parser()
+    parser.description = "多进程扩展性测试"
+    parser.add_argument("--workers-list", type=str, default="1,2,4", help="依次测试的工作进程数，逗号分隔")
+    parser.add_argument("--min-efficiency", type=float, default=0,
+                        help="最大进程数下效率（加速比/进程数）的下限，低于时以非零状态退出")
+    args = parser.parse_args()
+
+    worker_counts = [int(value) for value in args.workers_list.split(",") if value.strip()]
+    runs = []
+    for workers in worker_counts:
+        args.workers = workers
+        print(f"工作进程数 {workers} ...")
+        result = asyncio.run(run_load_test(args))
+        runs.append({"workers": workers, **result})
+
+    baseline = runs[0]["turns_per_second"] / runs[0]["workers"] if runs and runs[0]["turns_per_second"] else 0.0
+    print(f"\n{'进程数':<8}{'吞吐量(轮/秒)':>14}{'加速比':>10}{'效率':>10}{'p95整轮(ms)':>14}{'失败':>8}")
+    for run in runs:
+        run["speedup"] = run["turns_per_second"] / baseline if baseline else 0.0
+        run["efficiency"] = run["speedup"] / run["workers"]
+        print(f"{run['workers']:<8}{run['turns_per_second']:>14.2f}{run['speedup']:>10.2f}{run['efficiency']:>10.0%}"
+              f"{run['turn_seconds']['p95'] * 1000:>14.0f}{run['failed_turns'] + run['failed_clients']:>8}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(runs, f, ensure_ascii=False, indent=2)
+
+    failures = []
+    if args.min_efficiency and runs and runs[-1]["efficiency"] < args.min_efficiency:
+        failures.append(f"{runs[-1]['workers']} 个进程的效率 {runs[-1]['efficiency']:.0%} 低于 {args.min_efficiency:.0%}")
+    if any(run["failed_turns"] or run["failed_clients"] for run in runs):
+        failures.append("存在失败的请求")
+    for failure in failures:
+        print(f"未通过: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
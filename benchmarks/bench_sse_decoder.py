@@ -0,0 +1,143 @@
+"""
+SSE解码的吞吐量基准测试
+
+对一段录制的（或按OpenAI格式生成的）流式响应，比较原先逐行decode/strip/json.loads的解析方式
+与SSEDecoder（分别使用json和orjson）每秒解析的token数。新解码器的输入按随机大小切分，模拟网络读取
+
+用法:
+    python benchmarks/bench_sse_decoder.py --tokens 20000
+    python benchmarks/bench_sse_decoder.py --file recorded_stream.txt
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sse_decoder
+from sse_decoder import SSEDecoder, parse_event, extract_delta, DONE_MARKERS
+
+
+def generate_stream(tokens: int) -> bytes:
+    """
+    生成OpenAI格式的流式响应
+    """
+    rng = random.Random(0)
+    words = ["异步", "请求", "调度", "the", " model", " stream", "，", "。", "\n", " token", "缓存", " latency"]
+    parts = []
+    for i in range(tokens):
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "delta": {"content": rng.choice(words)}, "finish_reason": None}]
+        }
+        parts.append(b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n")
+    usage = {"id": "chatcmpl-bench", "choices": [], "usage": {"prompt_tokens": 100, "completion_tokens": tokens, "total_tokens": tokens + 100}}
+    parts.append(b"data: " + json.dumps(usage).encode("utf-8") + b"\n\n")
+    parts.append(b"data: [DONE]\n\n")
+    return b"".join(parts)
+
+
+def split_reads(payload: bytes, min_size: int, max_size: int):
+    rng = random.Random(1)
+    reads = []
+    offset = 0
+    while offset < payload.__len__():
+        size = rng.randint(min_size, max_size)
+        reads.append(payload[offset:offset + size])
+        offset += size
+    return reads
+
+
+def legacy_parse(lines):
+    """
+    原先call_llm_api中的逐行解析
+    """
+    output = []
+    for line in lines:
+        if line.strip():
+            line_str = line.decode('utf-8').strip()
+            if line_str.startswith('data: '):
+                line_str = line_str[len('data: '):]
+            if line_str == '[DONE]' or line_str == '[ERROR]':
+                break
+            try:
+                chunk = json.loads(line_str)
+                if chunk.get("choices") and chunk["choices"][0].get("delta") and chunk["choices"][0]["delta"].get("content"):
+                    output.append(chunk["choices"][0]["delta"]["content"])
+            except json.JSONDecodeError:
+                pass
+    return output
+
+
+def decoder_parse(reads):
+    output = []
+    decoder = SSEDecoder()
+    for raw in reads:
+        for data in decoder.feed(raw):
+            if data in DONE_MARKERS:
+                return output
+            for chunk in parse_event(data):
+                content, _, _ = extract_delta(chunk)
+                if content:
+                    output.append(content)
+    return output
+
+
+def measure(func, arg, repeat: int):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(arg)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE解码吞吐量基准测试")
+    parser.add_argument("--tokens", type=int, default=20000, help="生成的流中的token数")
+    parser.add_argument("--file", type=str, default="", help="录制的流式响应文件（原始字节）")
+    parser.add_argument("--min-read", type=int, default=64, help="模拟网络读取的最小字节数")
+    parser.add_argument("--max-read", type=int, default=4096, help="模拟网络读取的最大字节数")
+    parser.add_argument("--repeat", type=int, default=5, help="重复次数，取最快的一次")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            payload = f.read()
+    else:
+        payload = generate_stream(args.tokens)
+
+    lines = payload.splitlines(keepends=True)
+    reads = split_reads(payload, args.min_read, args.max_read)
+    print(f"流大小: {len(payload) / 1024:.0f} KB, {len(lines)} 行, {len(reads)} 次读取")
+
+    legacy_time, expected = measure(legacy_parse, lines, args.repeat)
+    results = [("逐行解析(json)", legacy_time)]
+
+    backends = [("json", sse_decoder._stdlib_json_loads)]
+    if sse_decoder.JSON_BACKEND == "orjson":
+        backends.append(("orjson", sse_decoder.json_loads))
+    original_loads = sse_decoder.json_loads
+    for name, loads in backends:
+        sse_decoder.json_loads = loads
+        elapsed, output = measure(decoder_parse, reads, args.repeat)
+        assert output == expected, f"SSEDecoder({name})的解析结果与逐行解析不一致"
+        results.append((f"SSEDecoder({name})", elapsed))
+    sse_decoder.json_loads = original_loads
+
+    tokens = len(expected)
+    print(f"\n{'':22}{'耗时(ms)':>10}{'token/s':>14}{'加速':>8}")
+    for name, elapsed in results:
+        print(f"{name:22}{elapsed * 1000:>10.1f}{tokens / elapsed:>14,.0f}{legacy_time / elapsed:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+模拟的OpenAI兼容流式LLM服务，供负载测试使用
+
+按配置的首token延迟和生成速度输出SSE流，可按一定概率输出<tool>工具调用（调用负载测试的模拟MCP工具），
+收到工具结果后输出总结。请求携带stream_options.include_usage时在最后一个块中返回用量
+
+用法:
+    python benchmarks/fake_llm_server.py --port 9100 --ttft 0.2 --tokens-per-sec 50 --tokens 100
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+# 负载测试中模拟MCP服务器的名称和工具
+TOOL_NAME = "LoadTest:slow_tool"
+
+WORDS = ["异步", "请求", "调度", "模型", "流式", "输出", "缓存", "延迟", "工具", "会话", "，", "。"]
+
+
+def make_chunk(content: str = None, usage: dict = None) -> bytes:
+    chunk = {
+        "id": "chatcmpl-loadtest",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "fake-model",
+        "choices": [] if content is None else [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+    }
+    if usage is not None:
+        chunk["usage"] = usage
+    return b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+class FakeLLM:
+    """
+    模拟的流式补全服务
+    """
+
+    def __init__(self, args):
+        self.ttft = args.ttft
+        self.ttft_jitter = args.ttft_jitter
+        self.tokens = args.tokens
+        self.interval = 1.0 / args.tokens_per_sec if args.tokens_per_sec > 0 else 0.0
+        self.tool_call_probability = args.tool_call_probability
+        self.rng = random.Random(args.seed)
+        self.requests = 0
+
+    def plan_tokens(self, messages) -> list:
+        last = messages[-1]["content"] if messages else ""
+        if not last.startswith("<tool_result>") and self.rng.random() < self.tool_call_probability:
+            call = json.dumps({"name": TOOL_NAME, "parameters": {"text": "负载测试"}}, ensure_ascii=False)
+            return ["好的", "，", "我来", "调用", "工具", "。\n", "<tool>\n", call, "\n</tool>"]
+        return [self.rng.choice(WORDS) for _ in range(self.tokens)]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        tokens = self.plan_tokens(body.get("messages", []))
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        prompt_tokens = sum(len(message.get("content", "")) for message in body.get("messages", [])) // 2
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        await asyncio.sleep(max(0.0, self.ttft + self.rng.uniform(-self.ttft_jitter, self.ttft_jitter)))
+        try:
+            for i, token in enumerate(tokens):
+                if i and self.interval:
+                    await asyncio.sleep(self.interval)
+                await response.write(make_chunk(token))
+            if include_usage:
+                await response.write(make_chunk(usage={
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(tokens),
+                    "total_tokens": prompt_tokens + len(tokens)
+                }))
+            await response.write(b"data: [DONE]\n\n")
+        except (ConnectionResetError, asyncio.CancelledError):
+            # 客户端停止生成时关闭了连接
+            pass
+        return response
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟的OpenAI兼容流式LLM服务")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=9100, help="监听端口")
+    parser.add_argument("--ttft", type=float, default=0.2, help="首token延迟（秒）")
+    parser.add_argument("--ttft-jitter", type=float, default=0.05, help="首token延迟的随机波动（秒）")
+    parser.add_argument("--tokens", type=int, default=100, help="每个回复的token数")
+    parser.add_argument("--tokens-per-sec", type=float, default=50, help="生成速度（token/秒），0表示不限速")
+    parser.add_argument("--tool-call-probability", type=float, default=0.0, help="回复为工具调用的概率")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    args = parser.parse_args()
+
+    fake = FakeLLM(args)
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/v1/chat/completions", fake.chat_completions)
+    app.router.add_get("/stats", fake.stats)
+    web.run_app(app, host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""
+负载测试使用的模拟MCP服务器（stdio），提供一个按配置延迟返回的工具
+
+工具延迟通过环境变量FAKE_MCP_LATENCY（秒）配置，由负载测试写入的mcpServers.json传入
+"""
+
+import os
+import asyncio
+
+from fastmcp import FastMCP
+
+# 工具调用的延迟（秒）
+FAKE_MCP_LATENCY = float(os.getenv("FAKE_MCP_LATENCY", "0.1"))
+
+mcp = FastMCP(name="LoadTest", instructions="负载测试使用的模拟工具")
+
+
+@mcp.tool()
+async def slow_tool(text: str) -> str:
+    """按配置的延迟返回输入文本，用于负载测试
+
+    Args:
+        text: 任意文本
+    """
+    await asyncio.sleep(FAKE_MCP_LATENCY)
+    return f"已处理: {text}"
+
+
+if __name__ == "__main__":
+    mcp.run()
@@ -0,0 +1,79 @@
+"""
+回放录制的LLM流的本地服务
+
+读取LLM_RECORD_FILE录制的JSONL文件，以OpenAI兼容接口按录制的状态码、响应时间和每次读取的字节及时间回放，
+用于在不访问服务商的情况下经过真实的网络路径对网页应用做可重复的基准测试（例如配合bench_load.py --replay-file）
+
+用法:
+    python benchmarks/replay_llm_server.py --file recorded.jsonl --port 9100 --speed 1
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_replay import ReplayStore
+
+
+class ReplayServer:
+    """
+    回放服务
+    """
+
+    def __init__(self, store: ReplayStore, speed: float):
+        self.store = store
+        self.speed = speed
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        start_time = time.perf_counter()
+        record = self.store.take(await request.json())
+        if self.speed > 0 and record.get("response_time"):
+            await asyncio.sleep(record["response_time"] / self.speed)
+
+        headers = {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        headers.update(record.get("headers", {}))
+        response = web.StreamResponse(status=record["status"], headers=headers)
+        await response.prepare(request)
+        try:
+            for offset, text in record.get("chunks", []):
+                if self.speed > 0:
+                    delay = start_time + offset / self.speed - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await response.write(text.encode("utf-8", errors="surrogateescape"))
+        except (ConnectionResetError, asyncio.CancelledError):
+            # 客户端停止生成时关闭了连接
+            pass
+        return response
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "records": len(self.store.records),
+            "matched": self.store.matched,
+            "fallbacks": self.store.fallbacks
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放录制的LLM流")
+    parser.add_argument("--file", type=str, required=True, help="录制文件（JSONL）")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=9100, help="监听端口")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放速度倍数，0表示不等待")
+    args = parser.parse_args()
+
+    server = ReplayServer(ReplayStore(args.file), args.speed)
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/v1/chat/completions", server.chat_completions)
+    app.router.add_get("/stats", server.stats)
+    web.run_app(app, host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
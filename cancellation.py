@@ -0,0 +1,120 @@
+"""
+生成取消模块
+提供在LLM流式调用、MCP工具调用和消息持久化之间传递的取消令牌，
+使被放弃的生成能够立即释放上游连接，并一致地保存已生成的部分回复
+"""
+
+import asyncio
+from typing import Awaitable, Callable, List, TypeVar
+
+T = TypeVar("T")
+
+# 追加在被取消的部分回复末尾的标记
+CANCELLED_MARKER = "[已停止生成]"
+
+
+class GenerationCancelled(Exception):
+    """
+    生成已被取消
+    """
+
+
+class CancellationToken:
+    """
+    协作式取消令牌
+
+    取消时立即执行已注册的回调（例如关闭上游HTTP响应），并唤醒正在等待取消的协程
+    """
+
+    def __init__(self):
+        self._event = asyncio.Event()
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        """
+        是否已取消
+        """
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        """
+        取消生成，重复调用无副作用
+        """
+        if self._event.is_set():
+            return
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"执行取消回调时出错: {str(e)}")
+
+    def add_callback(self, callback: Callable[[], None]) -> None:
+        """
+        注册取消回调，已取消时立即执行
+
+        Args:
+            callback: 回调函数
+        """
+        if self._event.is_set():
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    def remove_callback(self, callback: Callable[[], None]) -> None:
+        """
+        移除取消回调
+
+        Args:
+            callback: 回调函数
+        """
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self) -> None:
+        """
+        已取消时抛出GenerationCancelled
+        """
+        if self._event.is_set():
+            raise GenerationCancelled()
+
+    async def run(self, awaitable: Awaitable[T]) -> T:
+        """
+        执行一个可等待对象，取消时立即中止它
+
+        Args:
+            awaitable: 可等待对象，例如MCP工具调用
+
+        Returns:
+            可等待对象的结果
+
+        Raises:
+            GenerationCancelled: 执行完成前令牌被取消
+        """
+        if self.cancelled:
+            # 不再等待该对象，关闭协程或取消future，避免"coroutine was never awaited"警告
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            elif asyncio.isfuture(awaitable):
+                awaitable.cancel()
+            raise GenerationCancelled()
+        task = asyncio.ensure_future(awaitable)
+        waiter = asyncio.ensure_future(self._event.wait())
+        try:
+            await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            waiter.cancel()
+
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+            raise GenerationCancelled()
+        return task.result()
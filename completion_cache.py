@@ -0,0 +1,236 @@
+"""
+LLM补全缓存模块
+以规范化后的消息列表、模型和生成参数的哈希为键，缓存完整的流式回复（保留原始分块），
+相同的请求直接回放缓存，不再请求服务商。缓存存储在conversations.db旁的SQLite文件中，
+超过容量上限时淘汰最久未使用的条目
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, List, Any, Optional
+
+import db_utils
+
+# 是否启用补全缓存
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "false").lower() == "true"
+
+# 只缓存temperature不超过该值的请求（较高的temperature下相同请求本应得到不同回复）
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0"))
+
+# 缓存内容的总大小上限（字节）
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# 每写入多少次按数据库重新统计总大小（其他工作进程的写入和淘汰不会反映在本进程的计数中）
+RECONCILE_INTERVAL = 100
+
+# 缓存文件路径（与对话数据库放在一起）
+CACHE_FILE = os.path.splitext(db_utils.DB_FILE)[0] + '.cache.db'
+
+
+def _normalize_content(content: Any) -> Any:
+    if isinstance(content, str):
+        # 首尾空白和换行风格不影响回复
+        return content.replace("\r\n", "\n").strip()
+    return content
+
+
+def make_cache_key(messages: List[Dict[str, Any]], model: str, temperature: float, max_tokens: int) -> str:
+    """
+    计算请求的缓存键
+
+    Args:
+        messages: 消息列表（系统消息中包含工具目录）
+        model: 模型名称
+        temperature: temperature参数
+        max_tokens: max_tokens参数
+
+    Returns:
+        缓存键（SHA-256十六进制字符串）
+    """
+    normalized = [
+        {key: _normalize_content(value) if key == "content" else value for key, value in message.items()}
+        for message in messages
+    ]
+    payload = json.dumps(
+        {"model": model, "temperature": temperature, "max_tokens": max_tokens, "messages": normalized},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    基于SQLite的补全缓存
+    """
+
+    def __init__(self, path: str = CACHE_FILE, max_bytes: int = LLM_CACHE_MAX_BYTES,
+                 max_temperature: float = LLM_CACHE_MAX_TEMPERATURE, enabled: bool = LLM_CACHE_ENABLED):
+        """
+        初始化补全缓存
+
+        Args:
+            path: 缓存文件路径
+            max_bytes: 缓存内容的总大小上限（字节）
+            max_temperature: 可缓存请求的最大temperature
+            enabled: 是否启用
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_temperature = max_temperature
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._total_bytes = 0
+        self._writes_since_reconcile = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            # 多个工作进程共享同一个缓存文件
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                chunks TEXT NOT NULL,
+                usage TEXT,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_completions_last_used ON completions(last_used)')
+            conn.commit()
+            self._conn = conn
+            self._reconcile_locked()
+        return self._conn
+
+    def _reconcile_locked(self) -> None:
+        self._total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+        self._writes_since_reconcile = 0
+
+    def cacheable(self, temperature: float) -> bool:
+        """
+        判断请求是否可以使用缓存
+
+        Args:
+            temperature: 请求的temperature参数
+
+        Returns:
+            是否可以使用缓存
+        """
+        return self.enabled and temperature <= self.max_temperature
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        查询缓存
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            包含chunks（文本块列表）和usage的字典，未命中时返回None
+        """
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT chunks, usage FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute('UPDATE completions SET last_used = ?, hits = hits + 1 WHERE key = ?', (time.time(), key))
+            conn.commit()
+            self.hits += 1
+        return {"chunks": json.loads(row[0]), "usage": json.loads(row[1]) if row[1] else None}
+
+    def put(self, key: str, model: str, chunks: List[str], usage: Optional[Dict[str, Any]] = None) -> None:
+        """
+        写入缓存，超过容量上限时淘汰最久未使用的条目
+
+        Args:
+            key: 缓存键
+            model: 模型名称
+            chunks: 回复的文本块列表（保留原始分块）
+            usage: 服务商返回的token用量
+        """
+        data = json.dumps(chunks, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # 增量更新总大小，替换已有条目时减去旧条目的大小
+            row = conn.execute('SELECT size FROM completions WHERE key = ?', (key,)).fetchone()
+            conn.execute(
+                'INSERT OR REPLACE INTO completions (key, model, chunks, usage, size, created_at, last_used, hits) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                (key, model, data, json.dumps(usage) if usage else None, size, now, now)
+            )
+            self._total_bytes += size - (row[0] if row else 0)
+            self._writes_since_reconcile += 1
+            # 其他工作进程也会写入和淘汰，定期以及需要淘汰前按数据库中的实际大小重新统计
+            if self._writes_since_reconcile >= RECONCILE_INTERVAL or self._total_bytes > self.max_bytes:
+                self._reconcile_locked()
+            self.stores += 1
+            self._evict_locked(conn)
+            conn.commit()
+
+    def _evict_locked(self, conn: sqlite3.Connection) -> None:
+        while self._total_bytes > self.max_bytes:
+            rows = conn.execute('SELECT key, size FROM completions ORDER BY last_used LIMIT 64').fetchall()
+            if not rows:
+                self._total_bytes = 0
+                return
+            for key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    return
+                conn.execute('DELETE FROM completions WHERE key = ?', (key,))
+                self._total_bytes -= size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        清空缓存
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM completions')
+            conn.commit()
+            self._total_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取缓存统计信息
+
+        Returns:
+            统计信息字典
+        """
+        with self._lock:
+            entries = self._connect().execute('SELECT COUNT(*) FROM completions').fetchone()[0] if self.enabled else 0
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "max_temperature": self.max_temperature,
+                "entries": entries,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions
+            }
+
+
+# 创建全局补全缓存实例
+completion_cache = CompletionCache()
@@ -2,13 +2,26 @@
 数据库工具模块，用于管理对话数据库
 """
 
+import html
+import json
 import sqlite3
 import datetime
 from typing import List, Dict, Any, Optional, Tuple
 
+from local_index import build_match_query
+from metrics import timed, db_operation_duration
+
 # 数据库文件路径
 DB_FILE = 'conversations.db'
 
+# 搜索结果中高亮匹配内容使用的标记
+HIGHLIGHT_OPEN = '<mark>'
+HIGHLIGHT_CLOSE = '</mark>'
+
+# 生成摘要时使用的临时标记，转义消息内容后再替换为HIGHLIGHT_OPEN/HIGHLIGHT_CLOSE
+_SNIPPET_OPEN = '\x02'
+_SNIPPET_CLOSE = '\x03'
+
 def init_db():
     """
     初始化数据库，创建必要的表
@@ -16,6 +29,9 @@ def init_db():
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
+    # 使用WAL日志，多个工作进程可以在写入的同时读取
+    cursor.execute('PRAGMA journal_mode=WAL')
+
     # 创建会话表
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS sessions (
@@ -37,6 +53,71 @@ def init_db():
     )
     ''')
 
+    # 为已有的对话表添加token用量列（LLM回复记录该次调用的用量，estimated表示服务商未返回、按本地估算）
+    cursor.execute('PRAGMA table_info(conversations)')
+    columns = {row[1] for row in cursor.fetchall()}
+    for column, definition in (('prompt_tokens', 'INTEGER'), ('completion_tokens', 'INTEGER'),
+                               ('usage_estimated', 'INTEGER NOT NULL DEFAULT 0')):
+        if column not in columns:
+            try:
+                cursor.execute(f'ALTER TABLE conversations ADD COLUMN {column} {definition}')
+            except sqlite3.OperationalError as e:
+                # 多个工作进程同时启动时，其他进程可能已经添加了该列
+                if 'duplicate column' not in str(e):
+                    raise
+
+    # 按会话查询对话的索引
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversations_session ON conversations(session_id)')
+
+    # 创建应用状态表（当前会话、LLM参数等在多个工作进程之间共享的设置，值为JSON）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS app_state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    ''')
+
+    # 创建会话摘要表（长会话中较早的对话被压缩为摘要，原始消息仍保留在对话表中）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS summaries (
+        session_id INTEGER PRIMARY KEY,
+        content TEXT NOT NULL,
+        last_message_id INTEGER NOT NULL,
+        updated_at DATETIME
+    )
+    ''')
+
+    # 创建对话内容的全文索引（外部内容表，由触发器在插入/删除/更新时维护）
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='conversations_fts'")
+    fts_exists = cursor.fetchone()[0] > 0
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+        content,
+        content='conversations',
+        content_rowid='id',
+        tokenize='trigram'
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN
+        INSERT INTO conversations_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN
+        INSERT INTO conversations_fts(conversations_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE OF content ON conversations BEGIN
+        INSERT INTO conversations_fts(conversations_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO conversations_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    ''')
+    # 首次创建索引时为已有对话建立索引
+    if not fts_exists:
+        cursor.execute("INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')")
+
     # 添加默认会话（如果不存在）
     cursor.execute('SELECT COUNT(*) FROM sessions')
     if cursor.fetchone()[0] == 0:
@@ -48,6 +129,7 @@ def init_db():
     conn.commit()
     conn.close()
 
+@timed(db_operation_duration, operation="get_sessions")
 def get_sessions() -> List[Dict[str, Any]]:
     """
     获取所有会话
@@ -60,10 +142,21 @@ def get_sessions() -> List[Dict[str, Any]]:
     cursor = conn.cursor()
     
     cursor.execute('''
-    SELECT id, name, created_at, updated_at,
-           (SELECT COUNT(*) FROM conversations WHERE session_id = sessions.id) as message_count
-    FROM sessions
-    ORDER BY updated_at DESC
+    SELECT s.id, s.name, s.created_at, s.updated_at,
+           COALESCE(u.message_count, 0) AS message_count,
+           COALESCE(u.prompt_tokens, 0) AS prompt_tokens,
+           COALESCE(u.completion_tokens, 0) AS completion_tokens,
+           COALESCE(u.max_prompt_tokens, 0) AS max_prompt_tokens
+    FROM sessions s
+    LEFT JOIN (
+        SELECT session_id, COUNT(*) AS message_count,
+               SUM(prompt_tokens) AS prompt_tokens,
+               SUM(completion_tokens) AS completion_tokens,
+               MAX(prompt_tokens) AS max_prompt_tokens
+        FROM conversations
+        GROUP BY session_id
+    ) u ON u.session_id = s.id
+    ORDER BY s.updated_at DESC
     ''')
     
     sessions = [dict(row) for row in cursor.fetchall()]
@@ -71,6 +164,7 @@ def get_sessions() -> List[Dict[str, Any]]:
     
     return sessions
 
+@timed(db_operation_duration, operation="create_session")
 def create_session(name: str) -> int:
     """
     创建新会话
@@ -96,6 +190,7 @@ def create_session(name: str) -> int:
     
     return session_id
 
+@timed(db_operation_duration, operation="update_session")
 def update_session(session_id: int, name: Optional[str] = None) -> bool:
     """
     更新会话信息
@@ -125,6 +220,7 @@ def update_session(session_id: int, name: Optional[str] = None) -> bool:
     
     return success
 
+@timed(db_operation_duration, operation="delete_session")
 def delete_session(session_id: int) -> bool:
     """
     删除会话及其所有对话
@@ -144,8 +240,9 @@ def delete_session(session_id: int) -> bool:
         conn.close()
         return False  # 不允许删除最后一个会话
     
-    # 删除会话的所有对话
+    # 删除会话的所有对话和摘要
     cursor.execute('DELETE FROM conversations WHERE session_id = ?', (session_id,))
+    cursor.execute('DELETE FROM summaries WHERE session_id = ?', (session_id,))
     
     # 删除会话
     cursor.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
@@ -156,6 +253,7 @@ def delete_session(session_id: int) -> bool:
     
     return success
 
+@timed(db_operation_duration, operation="get_conversations")
 def get_conversations(session_id: int) -> List[Dict[str, Any]]:
     """
     获取指定会话的所有对话
@@ -171,7 +269,7 @@ def get_conversations(session_id: int) -> List[Dict[str, Any]]:
     cursor = conn.cursor()
     
     cursor.execute('''
-    SELECT id, content, role, timestamp
+    SELECT id, content, role, timestamp, prompt_tokens, completion_tokens, usage_estimated
     FROM conversations
     WHERE session_id = ?
     ORDER BY id
@@ -182,7 +280,41 @@ def get_conversations(session_id: int) -> List[Dict[str, Any]]:
     
     return conversations
 
-def add_message(session_id: int, role: str, content: str) -> int:
+@timed(db_operation_duration, operation="get_messages_by_ids")
+def get_messages_by_ids(message_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """
+    按ID批量获取消息
+
+    Args:
+        message_ids: 消息ID列表
+
+    Returns:
+        消息ID到消息的映射，消息包含会话名称；已删除的消息不在结果中
+    """
+    if not message_ids:
+        return {}
+
+    conn = sqlite3.connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+
+    placeholders = ','.join('?' * len(message_ids))
+    cursor.execute(f'''
+    SELECT c.id, CAST(c.session_id AS INTEGER) AS session_id, s.name AS session_name,
+           c.content, c.role, c.timestamp
+    FROM conversations c
+    LEFT JOIN sessions s ON s.id = c.session_id
+    WHERE c.id IN ({placeholders})
+    ''', list(message_ids))
+
+    messages = {row['id']: dict(row) for row in cursor.fetchall()}
+    conn.close()
+
+    return messages
+
+@timed(db_operation_duration, operation="add_message")
+def add_message(session_id: int, role: str, content: str,
+                usage: Optional[Dict[str, Any]] = None) -> int:
     """
     添加消息到指定会话
     
@@ -190,6 +322,7 @@ def add_message(session_id: int, role: str, content: str) -> int:
         session_id: 会话ID
         role: 消息角色
         content: 消息内容
+        usage: 生成该消息的LLM调用的token用量（prompt_tokens、completion_tokens，estimated表示本地估算）
         
     Returns:
         新消息的ID
@@ -198,9 +331,13 @@ def add_message(session_id: int, role: str, content: str) -> int:
     cursor = conn.cursor()
     
     now = datetime.datetime.now()
+    usage = usage or {}
     cursor.execute(
-        'INSERT INTO conversations (session_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
-        (session_id, role, content, now)
+        '''INSERT INTO conversations (session_id, role, content, timestamp,
+                                      prompt_tokens, completion_tokens, usage_estimated)
+        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        (session_id, role, content, now, usage.get('prompt_tokens'), usage.get('completion_tokens'),
+         1 if usage.get('estimated') else 0)
     )
     
     message_id = cursor.lastrowid
@@ -216,6 +353,7 @@ def add_message(session_id: int, role: str, content: str) -> int:
     
     return message_id
 
+@timed(db_operation_duration, operation="clear_conversations")
 def clear_conversations(session_id: int) -> bool:
     """
     清除指定会话的所有对话
@@ -230,6 +368,7 @@ def clear_conversations(session_id: int) -> bool:
     cursor = conn.cursor()
     
     cursor.execute('DELETE FROM conversations WHERE session_id = ?', (session_id,))
+    cursor.execute('DELETE FROM summaries WHERE session_id = ?', (session_id,))
     
     success = True
     conn.commit()
@@ -237,5 +376,254 @@ def clear_conversations(session_id: int) -> bool:
     
     return success
 
+@timed(db_operation_duration, operation="get_session_usage")
+def get_session_usage(session_id: int) -> Dict[str, Any]:
+    """
+    获取会话的token用量统计
+
+    Args:
+        session_id: 会话ID
+
+    Returns:
+        包含合计、平均和最大提示词token数以及每次LLM调用用量的字典
+    """
+    conn = sqlite3.connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    SELECT id, timestamp, prompt_tokens, completion_tokens, usage_estimated
+    FROM conversations
+    WHERE session_id = ? AND (prompt_tokens IS NOT NULL OR completion_tokens IS NOT NULL)
+    ORDER BY id
+    ''', (session_id,))
+
+    calls = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+
+    prompt_tokens = [call['prompt_tokens'] or 0 for call in calls]
+    completion_tokens = sum(call['completion_tokens'] or 0 for call in calls)
+    return {
+        'session_id': session_id,
+        'llm_calls': len(calls),
+        'estimated_calls': sum(1 for call in calls if call['usage_estimated']),
+        'prompt_tokens': sum(prompt_tokens),
+        'completion_tokens': completion_tokens,
+        'total_tokens': sum(prompt_tokens) + completion_tokens,
+        'avg_prompt_tokens': sum(prompt_tokens) / len(calls) if calls else 0,
+        'max_prompt_tokens': max(prompt_tokens, default=0),
+        'calls': calls
+    }
+
+@timed(db_operation_duration, operation="get_session_version")
+def get_session_version(session_id: int) -> Tuple[int, int]:
+    """
+    获取会话对话记录的版本，用于判断缓存在内存中的对话历史是否已被其他进程修改
+
+    Args:
+        session_id: 会话ID
+
+    Returns:
+        (消息数, 最大消息ID)，没有消息时为(0, 0)
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        'SELECT COUNT(*), COALESCE(MAX(id), 0) FROM conversations WHERE session_id = ?',
+        (session_id,)
+    )
+
+    row = cursor.fetchone()
+    conn.close()
+
+    return (row[0], row[1])
+
+@timed(db_operation_duration, operation="get_app_state")
+def get_app_state(key: str, default: Any = None) -> Any:
+    """
+    获取应用状态
+
+    Args:
+        key: 状态名称
+        default: 不存在时的默认值
+
+    Returns:
+        状态值
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT value FROM app_state WHERE key = ?', (key,))
+
+    row = cursor.fetchone()
+    conn.close()
+
+    return json.loads(row[0]) if row else default
+
+@timed(db_operation_duration, operation="set_app_state")
+def set_app_state(key: str, value: Any) -> None:
+    """
+    设置应用状态
+
+    Args:
+        key: 状态名称
+        value: 状态值（可JSON序列化）
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        'INSERT OR REPLACE INTO app_state (key, value) VALUES (?, ?)',
+        (key, json.dumps(value))
+    )
+
+    conn.commit()
+    conn.close()
+
+@timed(db_operation_duration, operation="get_summary")
+def get_summary(session_id: int) -> Optional[Dict[str, Any]]:
+    """
+    获取会话摘要
+
+    Args:
+        session_id: 会话ID
+
+    Returns:
+        摘要信息（content、last_message_id、updated_at），不存在时返回None
+    """
+    conn = sqlite3.connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+
+    cursor.execute(
+        'SELECT content, last_message_id, updated_at FROM summaries WHERE session_id = ?',
+        (session_id,)
+    )
+
+    row = cursor.fetchone()
+    conn.close()
+
+    return dict(row) if row else None
+
+@timed(db_operation_duration, operation="save_summary")
+def save_summary(session_id: int, content: str, last_message_id: int) -> None:
+    """
+    保存会话摘要
+
+    Args:
+        session_id: 会话ID
+        content: 摘要内容
+        last_message_id: 摘要覆盖到的最后一条消息ID
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+
+    now = datetime.datetime.now()
+    cursor.execute(
+        'INSERT OR REPLACE INTO summaries (session_id, content, last_message_id, updated_at) VALUES (?, ?, ?, ?)',
+        (session_id, content, last_message_id, now)
+    )
+
+    conn.commit()
+    conn.close()
+
+def _finish_snippet(snippet: str, escape: bool) -> str:
+    # 先转义消息内容，再插入高亮标签，消息中的HTML不会被当作标记
+    if escape:
+        snippet = html.escape(snippet)
+    return snippet.replace(_SNIPPET_OPEN, HIGHLIGHT_OPEN).replace(_SNIPPET_CLOSE, HIGHLIGHT_CLOSE)
+
+@timed(db_operation_duration, operation="search_conversations")
+def search_conversations(query: str, limit: int = 20, offset: int = 0,
+                         session_id: Optional[int] = None, escape: bool = True) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    全文搜索对话历史，结果按相关度排序
+
+    Args:
+        query: 搜索查询
+        limit: 返回结果的数量
+        offset: 结果偏移量，用于分页
+        session_id: 只搜索指定会话，None表示搜索所有会话
+        escape: 是否对snippet中的消息内容做HTML转义（用于网页展示）
+
+    Returns:
+        元组 (搜索结果列表, 匹配总数)，结果中的snippet使用HIGHLIGHT_OPEN/HIGHLIGHT_CLOSE标记匹配内容
+
+    Raises:
+        sqlite3.Error: 查询语法错误等数据库错误
+    """
+    query = query.strip()
+    if not query:
+        return [], 0
+
+    conn = sqlite3.connect(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+
+    try:
+        session_filter = ''
+        match_query = build_match_query(query)
+
+        if match_query is not None:
+            params = [match_query]
+            if session_id is not None:
+                session_filter = 'AND c.session_id = ?'
+                params.append(session_id)
+
+            cursor.execute(f'''
+            SELECT COUNT(*)
+            FROM conversations_fts
+            JOIN conversations c ON c.id = conversations_fts.rowid
+            WHERE conversations_fts MATCH ? {session_filter}
+            ''', params)
+            total = cursor.fetchone()[0]
+
+            cursor.execute(f'''
+            SELECT c.id, CAST(c.session_id AS INTEGER) AS session_id, s.name AS session_name, c.role, c.timestamp,
+                   snippet(conversations_fts, 0, ?, ?, '...', 32) AS snippet,
+                   bm25(conversations_fts) AS score
+            FROM conversations_fts
+            JOIN conversations c ON c.id = conversations_fts.rowid
+            LEFT JOIN sessions s ON s.id = c.session_id
+            WHERE conversations_fts MATCH ? {session_filter}
+            ORDER BY score
+            LIMIT ? OFFSET ?
+            ''', [_SNIPPET_OPEN, _SNIPPET_CLOSE] + params + [limit, offset])
+            results = [dict(row) for row in cursor.fetchall()]
+        else:
+            # 查询词过短无法使用trigram索引，退化为子串匹配，按时间倒序
+            params = [query]
+            if session_id is not None:
+                session_filter = 'AND c.session_id = ?'
+                params.append(session_id)
+
+            cursor.execute(f'''
+            SELECT COUNT(*) FROM conversations c
+            WHERE instr(c.content, ?) > 0 {session_filter}
+            ''', params)
+            total = cursor.fetchone()[0]
+
+            cursor.execute(f'''
+            SELECT c.id, CAST(c.session_id AS INTEGER) AS session_id, s.name AS session_name, c.role, c.timestamp,
+                   substr(c.content, max(instr(c.content, ?) - 60, 1), 160) AS snippet,
+                   0 AS score
+            FROM conversations c
+            LEFT JOIN sessions s ON s.id = c.session_id
+            WHERE instr(c.content, ?) > 0 {session_filter}
+            ORDER BY c.id DESC
+            LIMIT ? OFFSET ?
+            ''', [query] + params + [limit, offset])
+            results = [dict(row) for row in cursor.fetchall()]
+            for result in results:
+                result['snippet'] = result['snippet'].replace(query, f"{_SNIPPET_OPEN}{query}{_SNIPPET_CLOSE}")
+    finally:
+        conn.close()
+
+    for result in results:
+        result['snippet'] = _finish_snippet(result['snippet'], escape)
+
+    return results, total
+
 # 初始化数据库
 init_db()
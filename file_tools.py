@@ -0,0 +1,240 @@
+"""
+文件读写辅助模块
+提供按字节/行范围、头尾、正则过滤的流式读取，以及追加和按行替换的写入，避免把大文件整体读入内存
+"""
+
+import os
+import re
+import mmap
+import shutil
+import tempfile
+from itertools import islice
+from pathlib import Path
+from typing import List, Tuple
+
+# 流式读取时每次读取的块大小（字节）
+CHUNK_SIZE = 1024 * 1024
+
+# 单次读取返回给模型的默认最大字节数
+DEFAULT_MAX_READ_BYTES = 100000
+
+
+def get_file_stats(path: Path) -> Tuple[int, int]:
+    """
+    获取文件大小和总行数（分块统计，不整体读入内存）
+
+    Args:
+        path: 文件路径
+
+    Returns:
+        元组 (文件大小, 总行数)
+    """
+    size = path.stat().st_size
+    total_lines = 0
+    last_byte = b''
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            total_lines += chunk.count(b'\n')
+            last_byte = chunk[-1:]
+
+    # 最后一行没有换行符时也计为一行
+    if size > 0 and last_byte != b'\n':
+        total_lines += 1
+
+    return size, total_lines
+
+
+def count_text_lines(text: str) -> int:
+    """
+    统计已在内存中的文本的行数，规则与get_file_stats相同
+
+    Args:
+        text: 文本
+
+    Returns:
+        行数
+    """
+    if not text:
+        return 0
+    return text.count('\n') + (0 if text.endswith('\n') else 1)
+
+
+def read_byte_range(path: Path, offset: int, length: int) -> str:
+    """
+    使用mmap读取指定字节范围
+
+    Args:
+        path: 文件路径
+        offset: 起始字节偏移，负数表示从文件末尾倒数
+        length: 读取的字节数
+
+    Returns:
+        解码后的文本（范围边界截断的多字节字符会被替换）
+    """
+    size = path.stat().st_size
+    if size == 0 or length <= 0:
+        return ""
+
+    if offset < 0:
+        offset = max(size + offset, 0)
+    end = min(offset + length, size)
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[offset:end]
+
+    return data.decode('utf-8', errors='replace')
+
+
+def read_line_range(path: Path, start_line: int, end_line: int) -> List[str]:
+    """
+    流式读取指定行范围
+
+    Args:
+        path: 文件路径
+        start_line: 起始行号（从1开始）
+        end_line: 结束行号（包含），0表示读到文件末尾
+
+    Returns:
+        行列表（保留行尾换行符）
+    """
+    start = max(start_line, 1) - 1
+    stop = end_line if end_line > 0 else None
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return list(islice(f, start, stop))
+
+
+def read_tail(path: Path, num_lines: int) -> List[str]:
+    """
+    使用mmap从文件末尾向前查找，读取最后若干行
+
+    Args:
+        path: 文件路径
+        num_lines: 行数
+
+    Returns:
+        行列表（保留行尾换行符）
+    """
+    size = path.stat().st_size
+    if size == 0 or num_lines <= 0:
+        return []
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # 忽略文件末尾的换行符
+            pos = size - 1 if mm[size - 1:size] == b'\n' else size
+            for _ in range(num_lines):
+                pos = mm.rfind(b'\n', 0, pos)
+                if pos == -1:
+                    break
+            data = mm[pos + 1:]
+
+    return data.decode('utf-8', errors='replace').splitlines(keepends=True)
+
+
+def grep_file(path: Path, pattern: str, max_matches: int = 100, ignore_case: bool = False) -> Tuple[List[Tuple[int, str]], bool]:
+    """
+    流式按正则过滤文件行
+
+    Args:
+        path: 文件路径
+        pattern: 正则表达式
+        max_matches: 最多返回的匹配行数
+        ignore_case: 是否忽略大小写
+
+    Returns:
+        元组 (匹配行列表[(行号, 行内容)], 是否因达到上限而提前停止)
+
+    Raises:
+        re.error: 正则表达式无效
+    """
+    regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    matches = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line_no, line in enumerate(f, start=1):
+            if regex.search(line):
+                if len(matches) >= max_matches:
+                    return matches, True
+                matches.append((line_no, line.rstrip('\n')))
+    return matches, False
+
+
+def append_to_file(path: Path, content: str) -> None:
+    """
+    追加内容到文件末尾
+
+    Args:
+        path: 文件路径
+        content: 要追加的内容
+    """
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(content)
+
+
+def replace_lines(path: Path, start_line: int, end_line: int, content: str) -> None:
+    """
+    流式替换文件中的行范围，通过临时文件写入后原子替换原文件。
+    按字节处理，范围之外的行原样保留（包括CRLF换行和非UTF-8字节），新内容沿用文件的换行风格
+
+    Args:
+        path: 文件路径
+        start_line: 起始行号（从1开始）
+        end_line: 结束行号（包含），小于start_line时表示在start_line之前插入而不删除任何行
+        content: 替换后的内容
+    """
+    if content and not content.endswith('\n'):
+        content += '\n'
+
+    def encode(newline: bytes) -> bytes:
+        text = content.replace('\r\n', '\n')
+        if newline == b'\r\n':
+            text = text.replace('\n', '\r\n')
+        return text.encode('utf-8')
+
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as out, open(path, 'rb') as src:
+            written = False
+            newline = None  # 文件的换行风格，取第一个换行
+            line = b''
+            for line_no, line in enumerate(src, start=1):
+                if newline is None and line.endswith(b'\n'):
+                    newline = b'\r\n' if line.endswith(b'\r\n') else b'\n'
+                if line_no == start_line:
+                    out.write(encode(newline or b'\n'))
+                    written = True
+                if start_line <= line_no <= end_line:
+                    continue
+                out.write(line)
+            # 起始行超出文件末尾时，追加到文件末尾
+            if not written:
+                newline = newline or b'\n'
+                if line and not line.endswith(b'\n'):
+                    out.write(newline)
+                out.write(encode(newline))
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def truncate_text(text: str, max_bytes: int) -> Tuple[str, bool]:
+    """
+    按UTF-8字节数截断文本
+
+    Args:
+        text: 文本
+        max_bytes: 最大字节数
+
+    Returns:
+        元组 (截断后的文本, 是否发生截断)
+    """
+    encoded = text.encode('utf-8')
+    if max_bytes <= 0 or len(encoded) <= max_bytes:
+        return text, False
+    return encoded[:max_bytes].decode('utf-8', errors='ignore'), True
@@ -0,0 +1,236 @@
+"""
+LLM服务端点池模块
+管理多个OpenAI兼容的服务端点，记录各端点的健康状态和首token延迟，
+请求时优先选择最快的健康端点，连续失败的端点暂时熔断
+"""
+
+import os
+import json
+import time
+import random
+from collections import deque
+from typing import Dict, List, Any, Optional
+
+# 端点列表，JSON格式，例如 [{"name": "openai", "url": "...", "model": "gpt-4o", "api_key": "..."}]
+# 未设置时使用LLM_API_URL、LLM_API_MODEL、LLM_API_KEY作为唯一端点
+LLM_ENDPOINTS = os.getenv("LLM_ENDPOINTS", "")
+
+# 首token之前遇到429、5xx或连接错误时的最大重试次数（重试会切换到下一个端点）
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+
+# 重试退避的基础时间和上限（秒）
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+
+# 连续失败达到该次数后熔断端点
+ENDPOINT_FAILURE_THRESHOLD = int(os.getenv("LLM_ENDPOINT_FAILURE_THRESHOLD", "3"))
+
+# 熔断时间（秒），再次熔断时加倍，不超过上限
+ENDPOINT_COOLDOWN_SECONDS = 5.0
+ENDPOINT_MAX_COOLDOWN_SECONDS = 120.0
+
+# 首token延迟的指数移动平均系数
+LATENCY_EWMA_ALPHA = 0.3
+
+# 每个端点保留的首token延迟样本数
+LATENCY_SAMPLE_SIZE = 200
+
+# 可以重试的HTTP状态码
+RETRYABLE_STATUS = (408, 409, 429, 500, 502, 503, 504)
+
+
+class RetryableLLMError(Exception):
+    """
+    首token之前发生的可重试错误（429、5xx、连接错误）
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None, status: Optional[int] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+
+class LLMEndpoint:
+    """
+    一个OpenAI兼容的服务端点及其健康状态
+    """
+
+    def __init__(self, name: str, url: str, model: str, api_key: str = ""):
+        """
+        初始化端点
+
+        Args:
+            name: 端点名称
+            url: chat/completions接口地址
+            model: 模型名称
+            api_key: API密钥
+        """
+        self.name = name
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+
+        self.latency: Optional[float] = None  # 首token延迟的指数移动平均（秒）
+        self.latency_samples: deque = deque(maxlen=LATENCY_SAMPLE_SIZE)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.cooldown = ENDPOINT_COOLDOWN_SECONDS
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def healthy(self) -> bool:
+        """
+        是否可用（未处于熔断期）
+        """
+        return time.monotonic() >= self.unhealthy_until
+
+    def record_success(self, first_token_latency: float) -> None:
+        """
+        记录一次成功的请求
+
+        Args:
+            first_token_latency: 首token延迟（秒）
+        """
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.cooldown = ENDPOINT_COOLDOWN_SECONDS
+        self.latency_samples.append(first_token_latency)
+        if self.latency is None:
+            self.latency = first_token_latency
+        else:
+            self.latency += LATENCY_EWMA_ALPHA * (first_token_latency - self.latency)
+
+    def record_failure(self) -> None:
+        """
+        记录一次失败的请求，连续失败达到阈值时熔断
+        """
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= ENDPOINT_FAILURE_THRESHOLD:
+            print(f"LLM端点 {self.name} 连续失败 {self.consecutive_failures} 次，暂停使用 {self.cooldown:.0f} 秒")
+            self.unhealthy_until = time.monotonic() + self.cooldown
+            self.cooldown = min(self.cooldown * 2, ENDPOINT_MAX_COOLDOWN_SECONDS)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取端点状态
+
+        Returns:
+            端点状态字典
+        """
+        return {
+            "name": self.name,
+            "model": self.model,
+            "healthy": self.healthy,
+            "latency": self.latency,
+            "consecutive_failures": self.consecutive_failures,
+            "requests": self.requests,
+            "failures": self.failures
+        }
+
+
+class EndpointPool:
+    """
+    LLM服务端点池
+    """
+
+    def __init__(self, endpoints: List[LLMEndpoint]):
+        """
+        初始化端点池
+
+        Args:
+            endpoints: 端点列表，顺序即没有延迟数据时的优先级
+
+        Raises:
+            ValueError: 端点列表为空
+        """
+        if not endpoints:
+            raise ValueError("LLM端点列表不能为空")
+        self.endpoints = endpoints
+
+    def ordered(self) -> List[LLMEndpoint]:
+        """
+        按优先级排列端点：健康端点按首token延迟从低到高（尚无延迟数据的端点优先，以便测量），
+        熔断中的端点排在最后，所有端点都熔断时仍可使用
+
+        Returns:
+            端点列表
+        """
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        unhealthy = [endpoint for endpoint in self.endpoints if not endpoint.healthy]
+        healthy.sort(key=lambda endpoint: endpoint.latency if endpoint.latency is not None else 0.0)
+        unhealthy.sort(key=lambda endpoint: endpoint.unhealthy_until)
+        return healthy + unhealthy
+
+    def plan(self, attempts: int) -> List[LLMEndpoint]:
+        """
+        生成一次调用的尝试顺序，每次重试切换到下一个端点
+
+        Args:
+            attempts: 尝试次数
+
+        Returns:
+            每次尝试使用的端点
+        """
+        ordered = self.ordered()
+        return [ordered[i % len(ordered)] for i in range(attempts)]
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """
+        获取所有端点的状态
+
+        Returns:
+            端点状态列表
+        """
+        return [endpoint.get_stats() for endpoint in self.endpoints]
+
+
+def retry_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+    计算第attempt次重试前的等待时间：指数退避加随机抖动，服务端给出Retry-After时以其为准
+
+    Args:
+        attempt: 重试序号，从1开始
+        retry_after: 服务端要求的等待时间（秒）
+
+    Returns:
+        等待时间（秒）
+    """
+    if retry_after is not None:
+        return min(retry_after, LLM_RETRY_MAX_DELAY)
+    delay = min(LLM_RETRY_BASE_DELAY * 2 ** (attempt - 1), LLM_RETRY_MAX_DELAY)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _load_endpoints() -> List[LLMEndpoint]:
+    default_key = os.getenv("LLM_API_KEY", "")
+    if LLM_ENDPOINTS:
+        try:
+            configs = json.loads(LLM_ENDPOINTS)
+            endpoints = [
+                LLMEndpoint(
+                    config.get("name", f"endpoint-{i + 1}"),
+                    config["url"],
+                    config["model"],
+                    config.get("api_key", default_key)
+                )
+                for i, config in enumerate(configs)
+            ]
+            if endpoints:
+                return endpoints
+            print("LLM_ENDPOINTS中没有端点，使用LLM_API_URL")
+        except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+            print(f"解析LLM_ENDPOINTS时出错，使用LLM_API_URL: {str(e)}")
+
+    return [LLMEndpoint(
+        "default",
+        os.getenv("LLM_API_URL", "https://api.openai.com/v1/chat/completions"),
+        os.getenv("LLM_API_MODEL", "gpt-3.5-turbo"),
+        default_key
+    )]
+
+
+# 创建全局端点池实例
+endpoint_pool = EndpointPool(_load_endpoints())
@@ -0,0 +1,186 @@
+"""
+对冲请求模块
+首个请求在截止时间（按首token延迟的分位数计算）内没有输出时，向另一个端点发起相同的请求，
+使用先输出的一方并取消另一方，以降低首token延迟的长尾；额外请求的开销单独统计
+"""
+
+import os
+import asyncio
+from typing import AsyncIterator, AsyncGenerator, Callable, Dict, List, Any, Optional, Sequence
+
+from cancellation import CancellationToken, GenerationCancelled
+from memory_index import estimate_tokens
+
+# 是否启用对冲请求（需要至少两个端点）
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+
+# 对冲截止时间取首个端点首token延迟的该分位数
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.9"))
+
+# 截止时间的下限，以及样本不足时使用的截止时间（秒）
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.3"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "2.0"))
+
+# 计算分位数所需的最少样本数
+HEDGE_MIN_SAMPLES = 20
+
+# 请求工厂：接收取消令牌，返回文本块的异步迭代器
+StreamFactory = Callable[[CancellationToken], AsyncIterator[str]]
+
+# 请求正常结束标记
+_END = object()
+
+
+def hedge_delay(latency_samples: Sequence[float], percentile: float = LLM_HEDGE_PERCENTILE) -> float:
+    """
+    计算对冲截止时间
+
+    Args:
+        latency_samples: 首个端点最近的首token延迟样本（秒）
+        percentile: 分位数
+
+    Returns:
+        截止时间（秒）
+    """
+    if len(latency_samples) < HEDGE_MIN_SAMPLES:
+        return LLM_HEDGE_DEFAULT_DELAY
+    samples = sorted(latency_samples)
+    value = samples[min(int(len(samples) * percentile), len(samples) - 1)]
+    return max(value, LLM_HEDGE_MIN_DELAY)
+
+
+class HedgeStats:
+    """
+    对冲请求的统计信息
+    """
+
+    def __init__(self):
+        self.requests = 0        # 经过对冲逻辑的调用数
+        self.hedged = 0          # 发起了对冲请求的调用数
+        self.hedge_wins = 0      # 对冲请求先输出的调用数
+        self.extra_tokens = 0    # 被取消的一方消耗的token数（估算，请求已发出时含提示词）
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取统计信息
+
+        Returns:
+            统计信息字典
+        """
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_rate": self.hedged / self.requests if self.requests else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "extra_tokens": self.extra_tokens
+        }
+
+
+async def hedged_stream(primary: StreamFactory, hedge: StreamFactory, delay: float,
+                        stats: HedgeStats, prompt_tokens: int = 0,
+                        cancel_token: Optional[CancellationToken] = None,
+                        hedge_sent: Optional[asyncio.Event] = None,
+                        on_winner: Optional[Callable[[int], None]] = None) -> AsyncGenerator[str, None]:
+    """
+    发起首个请求，超过截止时间仍无输出时发起对冲请求，输出先产生文本的一方
+
+    Args:
+        primary: 首个请求的工厂
+        hedge: 对冲请求的工厂
+        delay: 截止时间（秒）
+        stats: 统计信息
+        prompt_tokens: 提示词token数，用于统计被取消一方的开销
+        cancel_token: 外部取消令牌，取消时两个请求都被取消
+        hedge_sent: 对冲请求实际发出时由对冲请求设置的事件（例如排队获准之后），
+            未设置时不统计其提示词开销；为None时视为启动即发出
+        on_winner: 确定胜出一方时调用，参数为0（首个请求）或1（对冲请求）
+
+    Yields:
+        胜出一方的文本块
+
+    Raises:
+        两个请求都失败时抛出最后一个错误
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    runners: List[Dict[str, Any]] = []
+
+    def launch(factory: StreamFactory, sent: Optional[asyncio.Event] = None) -> None:
+        index = len(runners)
+        token = CancellationToken()
+        # finished: 已从队列取出该请求的结束标记或错误，之前仍可能有未取出的输出
+        runner = {"token": token, "chunks": [], "finished": False, "sent": sent}
+
+        async def run():
+            try:
+                async for chunk in factory(token):
+                    runner["chunks"].append(chunk)
+                    queue.put_nowait((index, chunk))
+                queue.put_nowait((index, _END))
+            except GenerationCancelled:
+                queue.put_nowait((index, _END))
+            except Exception as e:
+                queue.put_nowait((index, e))
+
+        runner["task"] = asyncio.create_task(run())
+        runners.append(runner)
+        if cancel_token is not None:
+            cancel_token.add_callback(token.cancel)
+
+    stats.requests += 1
+    launch(primary)
+    winner = None
+    last_error = None
+
+    try:
+        while True:
+            timeout = delay if winner is None and len(runners) == 1 else None
+            try:
+                index, item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                # 首个请求超过截止时间仍无输出，发起对冲请求
+                stats.hedged += 1
+                launch(hedge, hedge_sent)
+                continue
+
+            if item is _END or isinstance(item, Exception):
+                runners[index]["finished"] = True
+
+            if winner is None:
+                if isinstance(item, Exception):
+                    last_error = item
+                    # 另一方仍在进行，或已结束但输出还在队列中时继续等待
+                    if any(not runner["finished"] for runner in runners):
+                        continue
+                    raise last_error
+                # 先产生输出（或正常结束）的一方胜出，取消其余请求
+                winner = index
+                if index > 0:
+                    stats.hedge_wins += 1
+                if on_winner is not None:
+                    on_winner(index)
+                for other, runner in enumerate(runners):
+                    if other != winner:
+                        runner["token"].cancel()
+
+            if index != winner:
+                continue
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        for index, runner in enumerate(runners):
+            runner["token"].cancel()
+            if cancel_token is not None:
+                cancel_token.remove_callback(runner["token"].cancel)
+            if index != winner:
+                # 对冲请求在排队期间被取消时没有发出，不计提示词
+                sent = runner["sent"] is None or runner["sent"].is_set()
+                stats.extra_tokens += (prompt_tokens if sent else 0) + estimate_tokens("".join(runner["chunks"]))
+        # 等待被取消的请求释放连接
+        await asyncio.gather(*(runner["task"] for runner in runners), return_exceptions=True)
+
+
+# 创建全局对冲统计实例
+hedge_stats = HedgeStats()
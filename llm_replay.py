@@ -0,0 +1,310 @@
+"""
+LLM流录制与回放模块
+录制模式下将每次LLM请求的请求体、响应状态以及每次网络读取的原始SSE字节和到达时间追加写入JSONL文件；
+回放模式下不访问网络，按录制的时间（可加速）回放原始字节，经过与真实请求相同的SSE解码、调度和工具调用路径，
+用于离线、可重复地对智能体循环和流式输出进行基准测试和性能分析
+"""
+
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from typing import Dict, List, Any, Optional
+
+from completion_cache import make_cache_key
+
+# 录制文件，设置后每次LLM请求追加一行记录
+LLM_RECORD_FILE = os.getenv("LLM_RECORD_FILE", "")
+
+# 回放文件，设置后LLM请求从该文件回放，不访问网络
+LLM_REPLAY_FILE = os.getenv("LLM_REPLAY_FILE", "")
+
+# 回放速度倍数，0表示不等待、尽快输出
+LLM_REPLAY_SPEED = float(os.getenv("LLM_REPLAY_SPEED", "1.0"))
+
+
+def request_key(data: Dict[str, Any]) -> str:
+    """
+    计算请求体的匹配键（与补全缓存的键相同：规范化的消息、模型和生成参数）
+
+    Args:
+        data: 请求体
+
+    Returns:
+        匹配键
+    """
+    return make_cache_key(data.get("messages", []), data.get("model", ""),
+                          data.get("temperature", 0), data.get("max_tokens", 0))
+
+
+def _encode_bytes(raw: bytes) -> str:
+    # 网络读取可能在多字节字符中间切分，用surrogateescape无损保存任意字节
+    return raw.decode("utf-8", errors="surrogateescape")
+
+
+def _decode_bytes(text: str) -> bytes:
+    return text.encode("utf-8", errors="surrogateescape")
+
+
+class Recording:
+    """
+    一次请求的录制
+    """
+
+    def __init__(self, recorder: "LLMRecorder", endpoint: str, data: Dict[str, Any], status: int,
+                 headers: Dict[str, str], start_time: float):
+        self.recorder = recorder
+        self.record = {
+            "key": request_key(data),
+            "endpoint": endpoint,
+            "request": data,
+            "status": status,
+            "headers": headers,
+            "response_time": asyncio.get_running_loop().time() - start_time,
+            "chunks": []
+        }
+        self.start_time = start_time
+
+    def add(self, raw: bytes) -> None:
+        """
+        记录一次网络读取
+
+        Args:
+            raw: 读取到的原始字节
+        """
+        self.record["chunks"].append([round(asyncio.get_running_loop().time() - self.start_time, 6), _encode_bytes(raw)])
+
+    def finish(self) -> None:
+        """
+        结束录制并写入文件
+        """
+        self.recorder.write(self.record)
+
+
+class LLMRecorder:
+    """
+    LLM请求录制器
+    """
+
+    def __init__(self, path: str = LLM_RECORD_FILE):
+        """
+        初始化录制器
+
+        Args:
+            path: 录制文件路径，为空时不录制
+        """
+        self.path = path
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def start(self, endpoint: str, data: Dict[str, Any], status: int, headers: Dict[str, str],
+              start_time: float) -> Optional[Recording]:
+        """
+        收到响应头后开始录制
+
+        Args:
+            endpoint: 端点名称
+            data: 请求体
+            status: HTTP状态码
+            headers: 需要保留的响应头（如Retry-After）
+            start_time: 发出请求时事件循环的时间
+
+        Returns:
+            录制，未启用时返回None
+        """
+        if not self.enabled:
+            return None
+        return Recording(self, endpoint, data, status, headers, start_time)
+
+    def write(self, record: Dict[str, Any]) -> None:
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"写入LLM录制文件时出错: {str(e)}")
+
+
+class ReplayStore:
+    """
+    录制记录的存储，按请求匹配键查找，找不到时按录制顺序依次使用
+    """
+
+    def __init__(self, path: str):
+        """
+        加载录制文件
+
+        Args:
+            path: 录制文件路径
+        """
+        self.records: List[Dict[str, Any]] = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self.records.append(json.loads(line))
+        self._by_key: Dict[str, deque] = {}
+        for index, record in enumerate(self.records):
+            self._by_key.setdefault(record["key"], deque()).append(index)
+        self._used = set()
+        self._next = 0
+        self.matched = 0
+        self.fallbacks = 0
+
+    def take(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        取出与请求对应的录制记录
+
+        先按匹配键查找尚未使用的记录（同一请求录制了多次时依次使用）；
+        找不到时（例如提示词中含有时间等变化的内容）使用录制顺序中下一个未使用的记录；
+        所有记录都用完后从头循环
+
+        Args:
+            data: 请求体
+
+        Returns:
+            录制记录
+        """
+        if not self.records:
+            raise RuntimeError("LLM回放文件中没有记录")
+
+        indexes = self._by_key.get(request_key(data))
+        while indexes:
+            index = indexes.popleft()
+            if index not in self._used:
+                self._used.add(index)
+                self.matched += 1
+                return self.records[index]
+
+        self.fallbacks += 1
+        if len(self._used) >= len(self.records):
+            self._reset()
+        while self._next in self._used:
+            self._next += 1
+        index = self._next
+        self._used.add(index)
+        return self.records[index]
+
+    def _reset(self) -> None:
+        self._used.clear()
+        self._next = 0
+        self._by_key = {}
+        for index, record in enumerate(self.records):
+            self._by_key.setdefault(record["key"], deque()).append(index)
+
+
+class _ReplayContent:
+    """
+    按录制时间输出原始字节，接口与aiohttp的StreamReader.readany()相同
+    """
+
+    def __init__(self, chunks: List[List[Any]], start_time: float, speed: float):
+        self._chunks = deque(chunks)
+        self._start_time = start_time
+        self._speed = speed
+        self._closed = False
+
+    async def readany(self) -> bytes:
+        if self._closed or not self._chunks:
+            return b""
+        offset, text = self._chunks.popleft()
+        if self._speed > 0:
+            delay = self._start_time + offset / self._speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return b"" if self._closed else _decode_bytes(text)
+
+
+class ReplayResponse:
+    """
+    回放的响应，提供_stream_endpoint使用到的aiohttp响应接口
+    """
+
+    def __init__(self, record: Dict[str, Any], start_time: float, speed: float):
+        self.status = record["status"]
+        self.headers = record.get("headers", {})
+        self.content = _ReplayContent(record.get("chunks", []), start_time, speed)
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            raise RuntimeError(f"回放的响应状态为 HTTP {self.status}")
+
+    def close(self) -> None:
+        self.content._closed = True
+
+    async def __aenter__(self) -> "ReplayResponse":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.close()
+
+
+class _ReplayRequest:
+    def __init__(self, replayer: "LLMReplayer", data: Dict[str, Any]):
+        self._replayer = replayer
+        self._data = data
+
+    async def __aenter__(self) -> ReplayResponse:
+        start_time = time.perf_counter()
+        record = self._replayer.store.take(self._data)
+        speed = self._replayer.speed
+        # 按录制的响应头到达时间等待
+        if speed > 0 and record.get("response_time"):
+            await asyncio.sleep(record["response_time"] / speed)
+        return ReplayResponse(record, start_time, speed)
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+class LLMReplayer:
+    """
+    LLM请求回放器，替代aiohttp.ClientSession
+    """
+
+    def __init__(self, path: str = LLM_REPLAY_FILE, speed: float = LLM_REPLAY_SPEED):
+        """
+        初始化回放器
+
+        Args:
+            path: 回放文件路径，为空时不回放
+            speed: 回放速度倍数，0表示不等待
+        """
+        self.path = path
+        self.speed = speed
+        self._store: Optional[ReplayStore] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    @property
+    def store(self) -> ReplayStore:
+        if self._store is None:
+            self._store = ReplayStore(self.path)
+            print(f"从 {self.path} 回放LLM请求，共 {len(self._store.records)} 条记录")
+        return self._store
+
+    def session(self) -> "LLMReplayer":
+        """
+        获取回放会话（用法与aiohttp.ClientSession相同）
+
+        Returns:
+            回放会话
+        """
+        return self
+
+    def post(self, url: str, headers: Optional[Dict[str, str]] = None, json: Optional[Dict[str, Any]] = None) -> _ReplayRequest:
+        return _ReplayRequest(self, json or {})
+
+    async def __aenter__(self) -> "LLMReplayer":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+# 创建全局录制器和回放器实例
+llm_recorder = LLMRecorder()
+llm_replayer = LLMReplayer()
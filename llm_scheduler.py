@@ -0,0 +1,302 @@
+"""
+LLM请求调度模块
+在LLMClient.call_llm_api之前进行准入控制：全局并发上限、按会话轮转的公平排队，
+以及按模型的令牌桶限流（每分钟请求数RPM、每分钟token数TPM），避免突发流量触发服务商的限流
+"""
+
+import os
+import json
+import time
+import asyncio
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional, Tuple
+
+# 同时进行的上游LLM请求数上限
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+# 默认的每分钟请求数和每分钟token数限制，0表示不限制
+LLM_RPM_LIMIT = float(os.getenv("LLM_RPM_LIMIT", "0"))
+LLM_TPM_LIMIT = float(os.getenv("LLM_TPM_LIMIT", "0"))
+
+# 按模型覆盖的限制，JSON格式，例如 {"gpt-4o": {"rpm": 500, "tpm": 30000}}
+LLM_RATE_LIMITS = os.getenv("LLM_RATE_LIMITS", "")
+
+# 服务商返回429但没有Retry-After时，暂停调度该模型请求的时间（秒）
+LLM_RATE_LIMIT_PAUSE = float(os.getenv("LLM_RATE_LIMIT_PAUSE", "1"))
+
+# 统计等待时间分位数时保留的最近样本数
+WAIT_SAMPLE_SIZE = 1000
+
+
+class TokenBucket:
+    """
+    令牌桶，按每分钟的速率连续补充，容量为一分钟的额度
+    """
+
+    def __init__(self, rate_per_minute: float):
+        """
+        初始化令牌桶
+
+        Args:
+            rate_per_minute: 每分钟补充的令牌数，小于等于0表示不限制
+        """
+        self.rate = rate_per_minute / 60
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated_at = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.rate <= 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, amount: float) -> float:
+        """
+        获取取得指定数量令牌前需要等待的时间
+
+        Args:
+            amount: 令牌数，超过容量时按容量计算
+
+        Returns:
+            等待时间（秒），0表示可以立即取得
+        """
+        if self.unlimited:
+            return 0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        """
+        取出令牌，可以为负数（退还多预留的令牌）；令牌数允许暂时为负，表示超额使用
+
+        Args:
+            amount: 令牌数
+        """
+        if self.unlimited:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - min(amount, self.capacity))
+
+
+class Reservation:
+    """
+    一次获准的LLM请求，请求结束后可以报告实际使用的token数
+    """
+
+    def __init__(self, model: str, tokens: int):
+        self.model = model
+        self.tokens = tokens
+        self.actual_tokens: Optional[int] = None
+
+
+class _Waiter:
+    def __init__(self, model: str, tokens: int, future: asyncio.Future):
+        self.model = model
+        self.tokens = tokens
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.rate_limited = False
+
+
+class LLMScheduler:
+    """
+    LLM请求调度器
+
+    每个会话有自己的等待队列，空出名额时在会话之间轮转，单个会话的大量请求不会阻塞其他会话；
+    队首请求所属模型的令牌桶不足时跳过该会话，继续调度其他会话，令牌补充后再调度该会话
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 rpm_limit: float = LLM_RPM_LIMIT, tpm_limit: float = LLM_TPM_LIMIT,
+                 model_limits: Optional[Dict[str, Dict[str, float]]] = None):
+        """
+        初始化调度器
+
+        Args:
+            max_concurrency: 全局并发上限
+            rpm_limit: 默认的每分钟请求数限制，0表示不限制
+            tpm_limit: 默认的每分钟token数限制，0表示不限制
+            model_limits: 按模型覆盖的限制，模型名称 -> {"rpm": ..., "tpm": ...}
+        """
+        self.max_concurrency = max_concurrency
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.model_limits = model_limits or {}
+
+        self._queues: "OrderedDict[Any, deque]" = OrderedDict()  # 会话ID -> 等待队列
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        self._paused_until: Dict[str, float] = {}  # 模型 -> 服务商限流后恢复调度的时间
+        self._in_flight = 0
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+        # 统计信息
+        self._total_requests = 0
+        self._rate_limited_waits = 0
+        self._rate_limited_responses = 0
+        self._wait_samples: deque = deque(maxlen=WAIT_SAMPLE_SIZE)
+        self._max_wait = 0.0
+
+    def _get_buckets(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        buckets = self._buckets.get(model)
+        if buckets is None:
+            limits = self.model_limits.get(model, {})
+            buckets = (TokenBucket(limits.get("rpm", self.rpm_limit)),
+                       TokenBucket(limits.get("tpm", self.tpm_limit)))
+            self._buckets[model] = buckets
+        return buckets
+
+    def _dispatch(self) -> None:
+        """
+        在并发和限流允许的范围内，按会话轮转唤醒等待的请求
+        """
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+
+        min_delay = None
+        while self._in_flight < self.max_concurrency and self._queues:
+            # 按轮转顺序找到第一个队首请求未被限流的会话，被限流的会话不阻塞其他模型的请求
+            selected = None
+            now = time.monotonic()
+            for session_id, queue in self._queues.items():
+                waiter = queue[0]
+                request_bucket, token_bucket = self._get_buckets(waiter.model)
+                delay = max(request_bucket.delay(1), token_bucket.delay(waiter.tokens),
+                            self._paused_until.get(waiter.model, 0) - now)
+                if delay <= 0:
+                    selected = session_id, queue, waiter, request_bucket, token_bucket
+                    break
+                if not waiter.rate_limited:
+                    waiter.rate_limited = True
+                    self._rate_limited_waits += 1
+                min_delay = delay if min_delay is None else min(min_delay, delay)
+            if selected is None:
+                break
+            session_id, queue, waiter, request_bucket, token_bucket = selected
+
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(session_id)
+            else:
+                del self._queues[session_id]
+
+            request_bucket.consume(1)
+            token_bucket.consume(waiter.tokens)
+            self._in_flight += 1
+            self._total_requests += 1
+            wait = time.monotonic() - waiter.enqueued_at
+            self._wait_samples.append(wait)
+            self._max_wait = max(self._max_wait, wait)
+            waiter.future.set_result(None)
+
+        if min_delay is not None and self._queues:
+            self._wakeup = asyncio.get_running_loop().call_later(min_delay, self._dispatch)
+
+    async def acquire(self, session_id: Any, model: str, tokens: int) -> Reservation:
+        """
+        排队等待发起LLM请求的许可
+
+        Args:
+            session_id: 会话ID，用于公平排队
+            model: 模型名称，用于限流
+            tokens: 预计使用的token数
+
+        Returns:
+            许可，请求结束后必须调用release
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(model, tokens, future)
+        self._queues.setdefault(session_id, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # 已获准但等待方被取消，归还名额
+                self._in_flight -= 1
+            else:
+                # 放弃等待，从队列中移除
+                queue = self._queues.get(session_id)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[session_id]
+            self._dispatch()
+            raise
+        return Reservation(model, tokens)
+
+    def release(self, reservation: Reservation) -> None:
+        """
+        归还许可，并按实际使用的token数修正令牌桶
+
+        Args:
+            reservation: acquire返回的许可
+        """
+        self._in_flight -= 1
+        if reservation.actual_tokens is not None:
+            _, token_bucket = self._get_buckets(reservation.model)
+            token_bucket.consume(reservation.actual_tokens - reservation.tokens)
+        self._dispatch()
+
+    def report_rate_limited(self, model: str, retry_after: Optional[float] = None) -> None:
+        """
+        服务商返回429时调用，在Retry-After（没有时为LLM_RATE_LIMIT_PAUSE）期间暂停调度该模型的请求，
+        其他模型的请求不受影响
+
+        Args:
+            model: 模型名称
+            retry_after: 服务商要求的等待时间（秒）
+        """
+        pause = retry_after if retry_after is not None else LLM_RATE_LIMIT_PAUSE
+        self._paused_until[model] = max(self._paused_until.get(model, 0), time.monotonic() + pause)
+        self._rate_limited_responses += 1
+        # 已被跳过的会话需要在暂停结束时重新调度
+        self._dispatch()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取调度统计信息
+
+        Returns:
+            包含排队深度、进行中请求数和等待时间的字典
+        """
+        samples = sorted(self._wait_samples)
+
+        def percentile(p: float) -> float:
+            if not samples:
+                return 0.0
+            return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+        return {
+            "queue_depth": sum(len(queue) for queue in self._queues.values()),
+            "queued_sessions": len(self._queues),
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "total_requests": self._total_requests,
+            "rate_limited_waits": self._rate_limited_waits,
+            "rate_limited_responses": self._rate_limited_responses,
+            "wait_seconds_p50": percentile(0.5),
+            "wait_seconds_p95": percentile(0.95),
+            "wait_seconds_max": self._max_wait
+        }
+
+
+def _load_model_limits() -> Dict[str, Dict[str, float]]:
+    if not LLM_RATE_LIMITS:
+        return {}
+    try:
+        return json.loads(LLM_RATE_LIMITS)
+    except json.JSONDecodeError as e:
+        print(f"解析LLM_RATE_LIMITS时出错: {str(e)}")
+        return {}
+
+
+# 创建全局调度器实例
+llm_scheduler = LLMScheduler(model_limits=_load_model_limits())
@@ -0,0 +1,164 @@
+"""
+本地全文索引模块
+基于SQLite FTS5为已获取的网页和已读取的文件建立离线索引，供search_web在本地检索
+"""
+
+import os
+import re
+import sqlite3
+import datetime
+import threading
+from typing import List, Dict, Any, Optional
+
+# 索引数据库文件路径
+INDEX_DB_FILE = os.getenv("SEARCH_INDEX_DB", "search_index.db")
+
+# trigram分词器要求查询词至少包含3个字符
+MIN_TERM_LENGTH = 3
+
+# 单个文档写入索引的最大字符数，避免超大文件拖慢写入
+MAX_DOCUMENT_LENGTH = 200000
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    将用户查询转换为FTS5 MATCH表达式
+
+    每个查询词作为短语加引号，避免查询中的特殊字符被解析为FTS5语法
+
+    Args:
+        query: 用户查询
+
+    Returns:
+        MATCH表达式，如果没有可用于索引查询的词则返回None
+    """
+    terms = [term for term in re.split(r'\s+', query.strip()) if len(term) >= MIN_TERM_LENGTH]
+    if not terms:
+        return None
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+
+class LocalIndex:
+    """
+    本地全文索引，使用单个长连接以保证查询延迟在亚毫秒级
+    """
+
+    def __init__(self, db_file: str = INDEX_DB_FILE):
+        """
+        初始化本地索引
+
+        Args:
+            db_file: 索引数据库文件路径
+        """
+        self.db_file = db_file
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        获取数据库连接，首次调用时创建索引表
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_file, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+                uri UNINDEXED,
+                title,
+                content,
+                source UNINDEXED,
+                indexed_at UNINDEXED,
+                tokenize = 'trigram'
+            )
+            ''')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def add_document(self, uri: str, title: str, content: str, source: str) -> None:
+        """
+        添加或更新一个文档
+
+        Args:
+            uri: 文档地址（网页URL或file://路径）
+            title: 文档标题
+            content: 文档内容
+            source: 文档来源，如 'web'、'file'
+        """
+        if not content:
+            return
+
+        with self._lock:
+            conn = self._connect()
+            now = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+            conn.execute('DELETE FROM documents WHERE uri = ?', (uri,))
+            conn.execute(
+                'INSERT INTO documents (uri, title, content, source, indexed_at) VALUES (?, ?, ?, ?, ?)',
+                (uri, title, content[:MAX_DOCUMENT_LENGTH], source, now)
+            )
+            conn.commit()
+
+    def search(self, query: str, num_results: int = 5) -> List[Dict[str, Any]]:
+        """
+        在本地索引中搜索
+
+        Args:
+            query: 搜索查询
+            num_results: 返回结果的数量
+
+        Returns:
+            搜索结果列表，格式与baidusearch一致（title、abstract、url、rank），
+            另含相关度score（BM25，越大越相关；查询词过短退化为子串匹配时为None）
+        """
+        if not query.strip():
+            return []
+
+        match_query = build_match_query(query)
+
+        with self._lock:
+            conn = self._connect()
+            if match_query is not None:
+                rows = conn.execute('''
+                SELECT uri, title, source, indexed_at, -bm25(documents) AS score,
+                       snippet(documents, 2, '', '', '...', 32) AS abstract
+                FROM documents
+                WHERE documents MATCH ?
+                ORDER BY bm25(documents)
+                LIMIT ?
+                ''', (match_query, num_results)).fetchall()
+            else:
+                # 查询词过短无法使用trigram索引，退化为逐行子串匹配
+                rows = conn.execute('''
+                SELECT uri, title, source, indexed_at, NULL AS score,
+                       substr(content, max(instr(content, ?1) - 60, 1), 200) AS abstract
+                FROM documents
+                WHERE instr(content, ?1) > 0
+                LIMIT ?2
+                ''', (query.strip(), num_results)).fetchall()
+
+        results = []
+        for rank, row in enumerate(rows, start=1):
+            results.append({
+                'title': row['title'],
+                'abstract': row['abstract'],
+                'url': row['uri'],
+                'rank': rank,
+                'score': round(row['score'], 4) if row['score'] is not None else None,
+                'source': row['source'],
+                'indexed_at': row['indexed_at']
+            })
+        return results
+
+    def close(self) -> None:
+        """
+        关闭数据库连接
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# 全局索引实例
+local_index = LocalIndex()
@@ -0,0 +1,167 @@
+"""
+事件循环延迟监控模块
+事件循环中的心跳协程定期记录时间，后台看门狗线程发现心跳超过阈值未更新时读取事件循环线程当时的调用栈，
+从而定位阻塞事件循环的同步调用（如SQLite操作、requests请求）。每次阻塞结束后输出耗时和调用栈，
+最近的阻塞记录保存在内存中，延迟分布记录到运行指标
+"""
+
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import deque
+from typing import Dict, List, Any, Optional
+
+from metrics import event_loop_lag, event_loop_stalls
+
+# 视为阻塞的延迟阈值（秒），为0时不监控
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.1"))
+
+# 心跳间隔（秒）
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.05"))
+
+# 内存中保留的最近阻塞记录数
+LOOP_STALL_HISTORY = 50
+
+# 调用栈最多保留的帧数
+LOOP_STACK_LIMIT = 30
+
+
+class LoopMonitor:
+    """
+    事件循环延迟监控器
+    """
+
+    def __init__(self, threshold: float = LOOP_LAG_THRESHOLD, interval: float = LOOP_MONITOR_INTERVAL,
+                 history: int = LOOP_STALL_HISTORY):
+        """
+        初始化监控器
+
+        Args:
+            threshold: 视为阻塞的延迟阈值（秒），为0时不监控
+            interval: 心跳间隔（秒）
+            history: 保留的最近阻塞记录数
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls: deque = deque(maxlen=history)
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self._loop_thread_id: Optional[int] = None
+        self._beat = 0.0
+        self._stack: Optional[str] = None
+        self._stack_beat = 0.0
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def start(self) -> None:
+        """
+        开始监控，在事件循环中调用
+        """
+        if not self.enabled or self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        print(f"事件循环延迟监控已启动，阈值 {self.threshold * 1000:.0f} ms")
+
+    async def stop(self) -> None:
+        """
+        停止监控
+        """
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._watchdog.join()
+        self._watchdog = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            before = time.monotonic()
+            with self._lock:
+                self._beat = before
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - before - self.interval, 0.0)
+            event_loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self._record(before, lag)
+
+    def _watch(self) -> None:
+        # 检查间隔不超过阈值的一半，保证在阻塞期间至少检查到一次
+        check_interval = min(self.interval, self.threshold / 2)
+        while not self._stop.wait(check_interval):
+            with self._lock:
+                beat = self._beat
+                if self._stack_beat == beat:
+                    continue
+            if time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=LOOP_STACK_LIMIT))
+            with self._lock:
+                # 读取调用栈期间心跳可能已经恢复
+                if self._beat == beat:
+                    self._stack = stack
+                    self._stack_beat = beat
+
+    def _record(self, beat: float, lag: float) -> None:
+        with self._lock:
+            stack = self._stack if self._stack_beat == beat else None
+            self._stack = None
+        stall = {
+            "time": time.time() - lag,
+            "duration_ms": round(lag * 1000, 1),
+            "stack": stack
+        }
+        self.stalls.append(stall)
+        self.stall_count += 1
+        event_loop_stalls.inc()
+        if stack:
+            print(f"事件循环阻塞了 {stall['duration_ms']:.0f} ms，阻塞时的调用栈:\n{stack}")
+        else:
+            # 阻塞时间短于看门狗的检查间隔，未能读取调用栈
+            print(f"事件循环阻塞了 {stall['duration_ms']:.0f} ms")
+
+    def get_stats(self, limit: int = 20) -> Dict[str, Any]:
+        """
+        获取监控统计
+
+        Args:
+            limit: 返回的最近阻塞记录数
+
+        Returns:
+            阈值、最大延迟、阻塞次数和最近的阻塞记录（新的在前）
+        """
+        stalls: List[Dict[str, Any]] = list(self.stalls)[-limit:] if limit > 0 else []
+        return {
+            "enabled": self.enabled,
+            "running": self._task is not None,
+            "threshold_ms": self.threshold * 1000,
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "stall_count": self.stall_count,
+            "stalls": list(reversed(stalls))
+        }
+
+
+# 创建全局监控器实例
+loop_monitor = LoopMonitor()
@@ -4,18 +4,53 @@ MCP客户端实现，负责与LLM API通信并处理MCP工具调用
 
 import os
 import json
+import time
 import asyncio
 import requests
 from typing import Dict, List, Any, Optional, Tuple, AsyncGenerator
 from pathlib import Path
+from collections import OrderedDict
 from dotenv import load_dotenv
 
 from fastmcp import Client
-import db_utils
 
-# 加载环境变量
+# 加载环境变量（需在导入读取配置的本地模块之前）
 load_dotenv()
 
+import db_utils
+from memory_index import memory_index, build_memory_context, estimate_tokens
+from summarizer import needs_summary, summarize_session
+from stream_events import (
+    TagStreamParser, make_event, error_event, EVENT_ERROR, EVENT_TOOL_RESULT, EVENT_USAGE
+)
+from cancellation import CancellationToken, GenerationCancelled, CANCELLED_MARKER
+from llm_scheduler import llm_scheduler
+from llm_endpoints import endpoint_pool, LLMEndpoint, RetryableLLMError, retry_delay, LLM_MAX_RETRIES, RETRYABLE_STATUS
+from llm_hedging import hedged_stream, hedge_delay, hedge_stats, LLM_HEDGE_ENABLED
+from sse_decoder import SSEDecoder, parse_event, extract_delta, DONE_MARKERS
+from completion_cache import completion_cache, make_cache_key
+from tracing import span
+from llm_replay import llm_recorder, llm_replayer
+from mcp_gateway import MCPGatewayConnection, MCP_GATEWAY, MCP_GATEWAY_POLL_INTERVAL
+from mcp_health import MCPHealthMonitor, OwnedClient, check_client, close_client
+from mcp_lazy import LazyMCPClient, is_lazy
+from session_lock import SessionLock
+from metrics import (
+    llm_time_to_first_token, llm_tokens_per_second, llm_requests, tool_call_duration, tool_call_errors
+)
+
+# 同时缓存的会话客户端数量上限
+MAX_CACHED_SESSIONS = int(os.getenv("MAX_CACHED_SESSIONS", "32"))
+
+# 从数据库读取的共享状态（当前会话、LLM参数）在本进程中缓存的时间（秒），其他工作进程的修改最多延迟这么久生效
+APP_STATE_CACHE_TTL = float(os.getenv("APP_STATE_CACHE_TTL", "1"))
+
+# 跨进程会话锁文件所在目录
+SESSION_LOCK_DIR = os.path.splitext(db_utils.DB_FILE)[0] + '.locks'
+
+# 流式请求是否携带stream_options.include_usage（不支持该参数的服务端可关闭，用量改为本地估算）
+LLM_STREAM_USAGE = os.getenv("LLM_STREAM_USAGE", "true").lower() == "true"
+
 class LLMClient:
     """
     LLM客户端，负责与LLM API通信
@@ -28,21 +63,31 @@ class LLMClient:
         Args:
             session_id: 会话ID，默认为1（默认会话）
         """
-        self.api_url = os.getenv("LLM_API_URL", "https://api.openai.com/v1/chat/completions")
-        self.api_model = os.getenv("LLM_API_MODEL", "gpt-3.5-turbo")
-        self.api_key = os.getenv("LLM_API_KEY", "")
+        self.endpoint_pool = endpoint_pool
+        self.api_url = endpoint_pool.endpoints[0].url
+        self.api_model = endpoint_pool.endpoints[0].model
+        self.api_key = endpoint_pool.endpoints[0].api_key
 
         if not self.api_key:
             print("警告: 未设置API密钥，请在.env文件中设置LLM_API_KEY")
 
         self.session_id = session_id
         self.conversation_history = []
+        self.summary = None          # 当前会话的摘要（较早对话的压缩）
+        self.summarized_id = 0       # 已被摘要覆盖的最后一条消息的ID
+        self._summary_tasks = {}     # 会话ID到后台摘要任务的映射
         self.system_message = "你是一个由FastMcpLLM提供支持的AI助手。你可以通过MCP协议调用各种工具来扩展你的能力。请确保使用中文进行回答。"
 
         # LLM参数设置
         self.temperature = 0.2
         self.max_tokens = 40960
 
+        # 跨会话记忆检索设置
+        self.memory_enabled = os.getenv("MEMORY_ENABLED", "true").lower() == "true"
+
+        self.memory_top_k = int(os.getenv("MEMORY_TOP_K", "5"))
+        self.memory_token_budget = int(os.getenv("MEMORY_TOKEN_BUDGET", "800"))
+
         # 从数据库加载对话历史
         self.load_history_from_db()
 
@@ -56,27 +101,124 @@ class LLMClient:
         for conv in conversations:
             self.conversation_history.append({
                 "role": conv["role"],
-                "content": conv["content"]
+                "content": conv["content"],
+                "id": conv["id"]
             })
+        # 与db_utils.get_session_version相同的版本，其他工作进程写入后两者不再一致
+        self.history_version = (len(conversations), max((conv["id"] for conv in conversations), default=0))
+
+        self._apply_summary(db_utils.get_summary(self.session_id))
 
-    def add_message(self, role: str, content: str) -> None:
+    def _apply_summary(self, summary: Optional[Dict[str, Any]]) -> None:
+        """
+        应用会话摘要，记录已被摘要覆盖的最后一条消息的ID。
+        按消息ID而不是前缀长度判断，出错时从对话历史中移除的消息不会使覆盖范围错位
+
+        Args:
+            summary: 摘要信息，None表示没有摘要
+        """
+        self.summary = summary
+        self.summarized_id = summary["last_message_id"] if summary is not None else 0
+
+    def get_recent_history(self) -> List[Dict[str, str]]:
+        """
+        获取未被摘要覆盖的对话历史
+
+        Returns:
+            消息列表（只含role和content，可直接发送给LLM）
+        """
+        return [
+            {"role": message["role"], "content": message["content"]}
+            for message in self.conversation_history
+            if message.get("id") is None or message["id"] > self.summarized_id
+        ]
+
+    def get_summary_prompt(self) -> str:
+        """
+        获取附加到系统消息的摘要提示词
+
+        Returns:
+            摘要提示词，没有摘要时返回空字符串
+        """
+        if not self.summary:
+            return ""
+        return f"\n\n以下是本会话较早对话的摘要:\n{self.summary['content']}"
+
+    def maybe_schedule_summary(self) -> None:
+        """
+        当未压缩的历史超过阈值时，在后台启动摘要任务（不阻塞当前请求）
+        """
+        session_id = self.session_id
+        task = self._summary_tasks.get(session_id)
+        if task is not None and not task.done():
+            return
+        if not needs_summary(self.get_recent_history()):
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._summary_tasks[session_id] = loop.create_task(self._run_summary(session_id))
+
+    async def _run_summary(self, session_id: int) -> None:
+        """
+        后台执行会话摘要，完成后如果仍在该会话则更新内存中的摘要
+        """
+        try:
+            summary = await summarize_session(self, session_id)
+            if summary is not None and session_id == self.session_id:
+                self._apply_summary(summary)
+                print(f"会话 {session_id} 的摘要已更新，覆盖到消息 {self.summarized_id}")
+                # 历史仍然过长时继续压缩
+                self._summary_tasks.pop(session_id, None)
+                self.maybe_schedule_summary()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"生成会话摘要时出错: {str(e)}")
+
+    def add_message(self, role: str, content: str, usage: Optional[Dict[str, Any]] = None) -> None:
         """
         添加消息到对话历史并保存到数据库
 
         Args:
             role: 消息角色 (user, assistant, system)
             content: 消息内容
+            usage: 生成该消息的LLM调用的token用量
         """
-        self.conversation_history.append({"role": role, "content": content})
+        message = {"role": role, "content": content, "id": None}
+        self.conversation_history.append(message)
 
         # 保存到数据库
-        db_utils.add_message(self.session_id, role, content)
+        with span("db_write", role=role, chars=len(content)):
+            message_id = db_utils.add_message(self.session_id, role, content, usage)
+        message["id"] = message_id
+        self.history_version = (self.history_version[0] + 1, message_id)
+
+        if role == "assistant":
+            self.maybe_schedule_summary()
+
+        # 写入跨会话记忆索引（工具结果由索引忽略）
+        if self.memory_enabled:
+            try:
+                with span("memory_index_add", chars=len(content)):
+                    memory_index.add(message_id, self.session_id, content)
+            except Exception as e:
+                print(f"写入记忆索引时出错: {str(e)}")
 
     def clear_history(self) -> None:
         """
         清除对话历史
         """
         self.conversation_history = []
+        self.history_version = (0, 0)
+
+        # 取消正在进行的摘要任务，避免清除后写回旧摘要
+        task = self._summary_tasks.pop(self.session_id, None)
+        if task is not None:
+            task.cancel()
+        self._apply_summary(None)
 
         # 清除数据库中的对话历史
         db_utils.clear_conversations(self.session_id)
@@ -126,6 +268,32 @@ class LLMClient:
             max_tokens = 1
         self.max_tokens = max_tokens
 
+    async def get_memory_context(self, query: str) -> str:
+        """
+        检索其他会话中与查询相关的历史片段。
+        嵌入计算、向量矩阵乘法和数据库查询在线程中执行，不阻塞事件循环
+
+        Args:
+            query: 查询文本，通常为当前用户消息
+
+        Returns:
+            可附加到系统消息的提示词片段，未启用或没有相关历史时返回空字符串
+        """
+        if not self.memory_enabled:
+            return ""
+        try:
+            return await asyncio.to_thread(
+                build_memory_context,
+                memory_index,
+                query,
+                self.session_id,
+                top_k=self.memory_top_k,
+                token_budget=self.memory_token_budget
+            )
+        except Exception as e:
+            print(f"检索记忆索引时出错: {str(e)}")
+            return ""
+
     def get_messages(self) -> List[Dict[str, str]]:
         """
         获取完整的消息列表，包括系统消息
@@ -133,16 +301,24 @@ class LLMClient:
         Returns:
             消息列表
         """
-        messages = [{"role": "system", "content": self.system_message}]
-        messages.extend(self.conversation_history)
+        messages = [{"role": "system", "content": self.system_message + self.get_summary_prompt()}]
+        messages.extend(self.get_recent_history())
         return messages
 
-    async def call_llm_api(self, messages: Optional[List[Dict[str, str]]] = None):
+    async def call_llm_api(self, messages: Optional[List[Dict[str, str]]] = None,
+                           cancel_token: Optional[CancellationToken] = None,
+                           usage: Optional[Dict[str, Any]] = None):
         """
         调用LLM API (支持流式响应)
 
+        按端点池的优先级选择端点；首token之前遇到429、5xx或连接错误时，退避后切换到下一个端点重试；
+        启用对冲请求时，首个端点超过截止时间仍无输出则同时请求下一个端点
+
         Args:
             messages: 消息列表，如果为None则使用当前对话历史
+            cancel_token: 取消令牌，取消时立即关闭上游响应并结束输出
+            usage: 接收本次调用token用量的字典，输出结束后填入（服务商未返回时为本地估算）。
+                用量按调用返回而不是保存在客户端上，后台摘要与对话轮次同时调用时互不覆盖
 
         Yields:
             API响应的文本块
@@ -150,46 +326,295 @@ class LLMClient:
         if messages is None:
             messages = self.get_messages()
 
+        call_usage = usage if usage is not None else {}
+        call_usage.clear()
+
+        if cancel_token is not None and cancel_token.cancelled:
+            return
+
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+
+        # 相同的确定性请求直接按原始分块回放缓存的回复，不请求服务商
+        cacheable = completion_cache.cacheable(self.temperature)
+        if cacheable:
+            cached = completion_cache.get(make_cache_key(messages, self.api_model, self.temperature, self.max_tokens))
+            if cached is not None:
+                # 缓存中没有用量时按本地估算，与服务商未返回用量时一致
+                completion_tokens = estimate_tokens("".join(cached["chunks"]))
+                call_usage.update(cached["usage"] or {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "estimated": True
+                })
+                for chunk in cached["chunks"]:
+                    if cancel_token is not None and cancel_token.cancelled:
+                        return
+                    yield chunk
+                    await asyncio.sleep(0)
+                return
+
+        output = []
+        last_error = None
+
+        for attempt, endpoint in enumerate(self.endpoint_pool.plan(LLM_MAX_RETRIES + 1)):
+            try:
+                if attempt > 0:
+                    # 退避后重试，等待期间取消则直接结束
+                    delay = retry_delay(attempt, last_error.retry_after)
+                    print(f"{delay:.2f}秒后使用端点 {endpoint.name} 重试（第{attempt}次）")
+                    if cancel_token is not None:
+                        await cancel_token.run(asyncio.sleep(delay))
+                    else:
+                        await asyncio.sleep(delay)
+
+                # 排队等待调度器的许可，排队期间取消则直接结束
+                acquire = llm_scheduler.acquire(self.session_id, endpoint.model, prompt_tokens)
+                if cancel_token is not None:
+                    reservation = await cancel_token.run(acquire)
+                else:
+                    reservation = await acquire
+            except GenerationCancelled:
+                return
+
+            try:
+                # 实际输出回复的端点及其用量，对冲请求胜出时为对冲端点
+                served = {"endpoint": endpoint, "usage": {}}
+                hedge_endpoint = self._get_hedge_endpoint(endpoint) if LLM_HEDGE_ENABLED else None
+                if hedge_endpoint is not None:
+                    hedge_sent = asyncio.Event()
+                    primary_usage, hedge_usage = served["usage"], {}
+
+                    def on_winner(index: int) -> None:
+                        served["endpoint"] = hedge_endpoint if index else endpoint
+                        served["usage"] = hedge_usage if index else primary_usage
+
+                    stream = hedged_stream(
+                        lambda token: self._stream_endpoint(endpoint, messages, token, primary_usage),
+                        lambda token: self._stream_hedge(hedge_endpoint, messages, token, prompt_tokens,
+                                                         hedge_sent, hedge_usage),
+                        hedge_delay(endpoint.latency_samples),
+                        hedge_stats,
+                        prompt_tokens,
+                        cancel_token,
+                        hedge_sent,
+                        on_winner
+                    )
+                else:
+                    stream = self._stream_endpoint(endpoint, messages, cancel_token, served["usage"])
+                async for chunk in stream:
+                    output.append(chunk)
+                    yield chunk
+                # 只缓存完整且没有错误的回复；缓存键使用实际回复的模型，
+                # 切换到其他模型的端点时不会作为配置的模型的回复被命中
+                if (cacheable and output
+                        and not (cancel_token is not None and cancel_token.cancelled)
+                        and not any(chunk.startswith("错误:") for chunk in output)):
+                    model = served["endpoint"].model
+                    completion_cache.put(make_cache_key(messages, model, self.temperature, self.max_tokens),
+                                         model, output, served["usage"] or None)
+                return
+            except RetryableLLMError as e:
+                print(f"LLM端点 {endpoint.name} 请求失败: {str(e)}")
+                last_error = e
+                if e.status == 429:
+                    # 该模型的其他排队请求暂缓发送，避免接连收到429
+                    llm_scheduler.report_rate_limited(endpoint.model, e.retry_after)
+            except Exception as e:
+                # 取消导致的连接中断不是错误
+                if cancel_token is not None and cancel_token.cancelled:
+                    return
+                if not output:
+                    endpoint.record_failure()
+                print(f"API调用失败: {str(e)}")
+                yield f"错误: {str(e)}"
+                return
+            finally:
+                # 服务商未返回用量时按本地估算（提示词按消息内容估算）
+                if served["usage"]:
+                    call_usage.update(served["usage"])
+                elif output:
+                    completion_tokens = estimate_tokens("".join(output))
+                    call_usage.update({
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                        "estimated": True
+                    })
+                # 按实际用量修正限流额度
+                reservation.actual_tokens = call_usage.get("total_tokens") or prompt_tokens
+                llm_scheduler.release(reservation)
+
+        yield f"错误: {str(last_error)}"
+
+    def _get_hedge_endpoint(self, endpoint: LLMEndpoint) -> Optional[LLMEndpoint]:
+        """
+        获取对冲请求使用的端点：除首个端点外优先级最高的健康端点
+
+        Args:
+            endpoint: 首个请求使用的端点
+
+        Returns:
+            端点，没有可用端点时返回None
+        """
+        for candidate in self.endpoint_pool.ordered():
+            if candidate is not endpoint and candidate.healthy:
+                return candidate
+        return None
+
+    async def _stream_hedge(self, endpoint: LLMEndpoint, messages: List[Dict[str, str]],
+                            cancel_token: CancellationToken, prompt_tokens: int, sent: asyncio.Event,
+                            usage: Dict[str, Any]):
+        """
+        发起对冲请求，与首个请求一样经过调度器
+
+        Args:
+            endpoint: 端点
+            messages: 消息列表
+            cancel_token: 对冲请求自己的取消令牌
+            prompt_tokens: 提示词token数
+            sent: 获准发出请求后设置，用于统计对冲开销
+            usage: 接收该请求token用量的字典
+
+        Yields:
+            API响应的文本块
+        """
+        reservation = await cancel_token.run(llm_scheduler.acquire(self.session_id, endpoint.model, prompt_tokens))
+        sent.set()
+        chunks = []
+        try:
+            async for chunk in self._stream_endpoint(endpoint, messages, cancel_token, usage):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            reservation.actual_tokens = usage.get("total_tokens") or prompt_tokens + estimate_tokens("".join(chunks))
+            llm_scheduler.release(reservation)
+
+    async def _stream_endpoint(self, endpoint: LLMEndpoint, messages: List[Dict[str, str]],
+                               cancel_token: Optional[CancellationToken],
+                               usage: Optional[Dict[str, Any]] = None):
+        """
+        向一个端点发起流式请求
+
+        Args:
+            endpoint: 端点
+            messages: 消息列表
+            cancel_token: 取消令牌
+            usage: 接收服务商返回的token用量的字典
+
+        Yields:
+            API响应的文本块
+
+        Raises:
+            RetryableLLMError: 首token之前遇到可重试的错误
+        """
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
+            "Authorization": f"Bearer {endpoint.api_key}"
         }
 
         data = {
-            "model": self.api_model,
+            "model": endpoint.model,
             "messages": messages,
             "temperature": self.temperature,
             "max_tokens": self.max_tokens,
             "stream": True  # 启用流式响应
         }
-
+        if LLM_STREAM_USAGE:
+            # 要求服务商在流的最后一个块中返回token用量
+            data["stream_options"] = {"include_usage": True}
+
+        # 使用 aiohttp 进行异步请求
+        import aiohttp
+        start_time = asyncio.get_running_loop().time()
+        received = False  # 是否已收到首token
+        first_token_time = 0.0
+        completion_parts = []
+        # 回放模式下不访问网络，从录制文件按原始时间回放响应
+        session_factory = llm_replayer.session if llm_replayer.enabled else aiohttp.ClientSession
         try:
-            # 使用 aiohttp 进行异步请求
-            import aiohttp
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.api_url, headers=headers, json=data) as response:
+            async with session_factory() as session:
+                async with session.post(endpoint.url, headers=headers, json=data) as response:
+                    llm_requests.inc(endpoint=endpoint.name, status=str(response.status))
+                    retry_after = response.headers.get("Retry-After")
+                    recording = llm_recorder.start(endpoint.name, data, response.status,
+                                                   {"Retry-After": retry_after} if retry_after else {}, start_time)
+                    if response.status in RETRYABLE_STATUS:
+                        try:
+                            retry_after = float(retry_after) if retry_after else None
+                        except ValueError:
+                            retry_after = None
+                        endpoint.record_failure()
+                        if recording is not None:
+                            recording.finish()
+                        raise RetryableLLMError(f"HTTP {response.status}", retry_after, response.status)
+                    if response.status >= 400 and recording is not None:
+                        recording.finish()
                     response.raise_for_status()
-                    async for line in response.content:
-                        if line.strip():
-                            line_str = line.decode('utf-8').strip()
-                            if line_str.startswith('data: '):
-                                line_str = line_str[len('data: '):]
-                            if line_str == '[DONE]' or line_str == '[ERROR]':
+                    # 取消时关闭响应，正在等待的读取会立即结束，连接不再放回连接池
+                    if cancel_token is not None:
+                        cancel_token.add_callback(response.close)
+                    try:
+                        # 按网络读取的字节块增量解码SSE事件
+                        decoder = SSEDecoder()
+                        done = False
+                        while not done:
+                            if cancel_token is not None and cancel_token.cancelled:
                                 break
-                            try:
-                                chunk = json.loads(line_str)
-                                if chunk.get("choices") and chunk["choices"][0].get("delta") and chunk["choices"][0]["delta"].get("content"):
-                                    yield chunk["choices"][0]["delta"]["content"]
-                            except json.JSONDecodeError:
-                                # 某些流式API可能会发送非JSON的keep-alive消息，忽略它们
-                                # print(f"Skipping non-JSON line: {line_str}")
-                                pass
-                            except Exception as e:
-                                print(f"Error processing chunk: {line_str}, error: {e}")
-                                yield f"错误: 解析块时出错 {e}"
-        except Exception as e:
-            print(f"API调用失败: {str(e)}")
-            yield f"错误: {str(e)}"
+                            raw = await response.content.readany()
+                            if raw:
+                                if recording is not None:
+                                    recording.add(raw)
+                                events = decoder.feed(raw)
+                            else:
+                                events = decoder.flush()
+                                done = True
+                            for event_data in events:
+                                if event_data in DONE_MARKERS:
+                                    done = True
+                                    break
+                                # 非JSON的keep-alive消息在parse_event中被忽略
+                                for chunk in parse_event(event_data):
+                                    try:
+                                        content, _, chunk_usage = extract_delta(chunk)
+                                    except Exception as e:
+                                        print(f"Error processing chunk: {event_data!r}, error: {e}")
+                                        yield f"错误: 解析块时出错 {e}"
+                                        continue
+                                    if chunk_usage and usage is not None:
+                                        usage.clear()
+                                        usage.update(chunk_usage)
+                                    if content:
+                                        if not received:
+                                            received = True
+                                            first_token_time = asyncio.get_running_loop().time()
+                                            endpoint.record_success(first_token_time - start_time)
+                                            llm_time_to_first_token.observe(first_token_time - start_time, endpoint=endpoint.name)
+                                        completion_parts.append(content)
+                                        yield content
+                        # 只录制完整的响应
+                        if recording is not None and not (cancel_token is not None and cancel_token.cancelled):
+                            recording.finish()
+                        # 没有文本输出的响应同样视为成功
+                        if not received and not (cancel_token is not None and cancel_token.cancelled):
+                            endpoint.record_success(asyncio.get_running_loop().time() - start_time)
+                        elif received:
+                            elapsed = asyncio.get_running_loop().time() - first_token_time
+                            if elapsed > 0:
+                                tokens = ((usage or {}).get("completion_tokens")
+                                          or estimate_tokens("".join(completion_parts)))
+                                llm_tokens_per_second.observe(tokens / elapsed, endpoint=endpoint.name)
+                    finally:
+                        if cancel_token is not None:
+                            cancel_token.remove_callback(response.close)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if not (cancel_token is not None and cancel_token.cancelled):
+                llm_requests.inc(endpoint=endpoint.name, status=type(e).__name__)
+            # 首token之前的连接错误可以换端点重试
+            if received or (cancel_token is not None and cancel_token.cancelled):
+                raise
+            endpoint.record_failure()
+            raise RetryableLLMError(f"连接失败: {str(e) or type(e).__name__}")
 
     async def get_response(self, user_message: str):
         """
@@ -203,14 +628,15 @@ class LLMClient:
         """
         self.add_message("user", user_message)
         full_response = ""
-        async for chunk in self.call_llm_api():
+        usage = {}
+        async for chunk in self.call_llm_api(usage=usage):
             if isinstance(chunk, str) and chunk.startswith("错误:"):
                 yield chunk
                 return
             full_response += chunk
             yield chunk
 
-        self.add_message("assistant", full_response)
+        self.add_message("assistant", full_response, usage or None)
 
 
 class MCPLLMClient:
@@ -225,12 +651,120 @@ class MCPLLMClient:
         Args:
             mcp_servers_file: MCP服务器配置文件路径
         """
-        self.current_session_id = 1  # 默认会话ID
-        self.llm_client = LLMClient(self.current_session_id)
+        self.llm_clients = OrderedDict()  # 会话ID到LLMClient的映射，支持多个会话并发对话
+        self.session_locks = {}           # 会话ID到锁的映射，同一会话的请求串行处理
+        self._app_state_cache = {}        # 状态名称到(过期时间, 值)的映射
+        self.llm_client = None
+        self.llm_client = self.get_llm_client(self.current_session_id)
         self.mcp_servers_file = mcp_servers_file
         self.mcp_clients = {}  # 存储多个MCP客户端
         self.tools_map = {}    # 存储工具名称到客户端的映射
         self.all_tools = []    # 存储所有工具
+        self.mcp_gateway = None  # 设置了MCP_GATEWAY时到工具网关的连接
+        self.mcp_server_configs = {}  # 直连模式下服务器名称到配置的映射，重连时使用
+        # 后台健康检查，掉线的服务器自动重连；网关模式下由网关负责重连和熔断，这里只轮询可用性
+        self.health_monitor = MCPHealthMonitor(self._check_server, self._reconnect_server, self._update_all_tools,
+                                               poll_interval=MCP_GATEWAY_POLL_INTERVAL if MCP_GATEWAY else None)
+
+    @property
+    def current_session_id(self) -> int:
+        """
+        当前会话ID，保存在数据库中，多个工作进程共享
+        """
+        return self._get_app_state("current_session_id", 1)
+
+    @current_session_id.setter
+    def current_session_id(self, session_id: int) -> None:
+        self._set_app_state("current_session_id", session_id)
+
+    def _get_app_state(self, key: str, default: Any = None) -> Any:
+        # 每次访问都查询数据库会阻塞事件循环，在APP_STATE_CACHE_TTL内使用缓存的值
+        now = time.monotonic()
+        cached = self._app_state_cache.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        value = db_utils.get_app_state(key, default)
+        self._app_state_cache[key] = (now + APP_STATE_CACHE_TTL, value)
+        return value
+
+    def _set_app_state(self, key: str, value: Any) -> None:
+        db_utils.set_app_state(key, value)
+        self._app_state_cache[key] = (time.monotonic() + APP_STATE_CACHE_TTL, value)
+
+    def get_llm_client(self, session_id: int) -> LLMClient:
+        """
+        获取指定会话的LLM客户端，不存在时创建并沿用当前客户端的设置。
+        LLM参数使用数据库中共享的设置；对话历史由process_message在持有会话锁时与数据库同步
+
+        Args:
+            session_id: 会话ID
+
+        Returns:
+            LLM客户端
+        """
+        params = self._get_app_state("llm_params", {})
+        client = self.llm_clients.get(session_id)
+        if client is not None:
+            self.llm_clients.move_to_end(session_id)
+            self._apply_llm_params(client, params)
+            return client
+
+        client = LLMClient(session_id)
+        if self.llm_client is not None:
+            client.set_system_message(self.llm_client.system_message)
+            client.set_temperature(self.llm_client.temperature)
+            client.set_max_tokens(self.llm_client.max_tokens)
+        self._apply_llm_params(client, params)
+        self.llm_clients[session_id] = client
+
+        # 超出缓存上限时淘汰最久未使用且没有进行中请求的会话
+        current_session_id = self.current_session_id
+        for cached_id in list(self.llm_clients.keys()):
+            if len(self.llm_clients) <= MAX_CACHED_SESSIONS:
+                break
+            lock = self.session_locks.get(cached_id)
+            if cached_id in (session_id, current_session_id) or (lock is not None and lock.locked()):
+                continue
+            del self.llm_clients[cached_id]
+            self.session_locks.pop(cached_id, None)
+
+        return client
+
+    @staticmethod
+    def _apply_llm_params(client: LLMClient, params: Dict[str, Any]) -> None:
+        if "temperature" in params:
+            client.set_temperature(params["temperature"])
+        if "max_tokens" in params:
+            client.set_max_tokens(params["max_tokens"])
+
+    async def sync_history(self, llm_client: LLMClient) -> None:
+        """
+        对话历史被其他工作进程修改过时重新从数据库加载。
+        调用方必须持有该会话的锁，否则可能替换掉正在进行的对话轮次使用的历史
+
+        Args:
+            llm_client: 会话的LLM客户端
+        """
+        # 版本查询在线程中执行，不阻塞事件循环
+        version = await asyncio.to_thread(db_utils.get_session_version, llm_client.session_id)
+        if llm_client.history_version != version:
+            llm_client.load_history_from_db()
+
+    def session_lock(self, session_id: int) -> SessionLock:
+        """
+        获取会话锁，保证同一会话的消息在所有工作进程中按顺序处理
+
+        Args:
+            session_id: 会话ID
+
+        Returns:
+            会话锁
+        """
+        lock = self.session_locks.get(session_id)
+        if lock is None:
+            lock = SessionLock(session_id, SESSION_LOCK_DIR)
+            self.session_locks[session_id] = lock
+        return lock
 
     def _load_mcp_servers(self) -> Dict[str, Dict[str, Any]]:
         """
@@ -250,61 +784,145 @@ class MCPLLMClient:
     async def initialize(self) -> None:
         """
         初始化MCP客户端
+
+        Raises:
+            Exception: 无法连接MCP工具网关，调用方保持未初始化状态，下次请求时重试
         """
-        # 加载MCP服务器配置
-        mcp_servers = self._load_mcp_servers()
+        if MCP_GATEWAY:
+            # 通过共享的MCP工具网关调用工具，不自行启动MCP服务器
+            gateway = MCPGatewayConnection(MCP_GATEWAY)
+            try:
+                server_names = await gateway.list_servers()
+            except Exception as e:
+                print(f"连接MCP工具网关 {MCP_GATEWAY} 时出错: {str(e)}")
+                await gateway.close()
+                raise
+            self.mcp_gateway = gateway
+            server_clients = {name: gateway.server(name) for name in server_names}
+        else:
+            # 加载MCP服务器配置
+            mcp_servers = self._load_mcp_servers()
+
+            if not mcp_servers:
+                print("警告: 未找到MCP服务器配置")
+                return
 
-        if not mcp_servers:
-            print("警告: 未找到MCP服务器配置")
-            return
+            # 为每个服务器创建客户端，按需启动的服务器此时不启动进程
+            self.mcp_server_configs = mcp_servers
+            server_clients = {name: self._create_server_client(name) for name in mcp_servers}
 
-        # 初始化所有MCP服务器
-        for name, server_config in mcp_servers.items():
+        # 初始化所有MCP服务器，连接失败的服务器由健康监控在后台重连
+        for name, client in server_clients.items():
             try:
-                # 创建客户端配置
-                client_config = {
-                    'mcpServers': {
-                        name: server_config
-                    }
-                }
+                await self._connect_server(name, client)
+                connected = True
+            except Exception as e:
+                print(f"初始化MCP服务器 {name} 时出错: {str(e)}")
+                connected = False
+            self.health_monitor.add(name, healthy=connected)
 
-                # 创建客户端
-                client = Client(client_config)
+        # 更新所有工具列表
+        await self._update_all_tools()
 
-                # 连接客户端
-                await client.__aenter__()
-                self.mcp_clients[name] = client
+    def _create_server_client(self, name: str) -> Any:
+        """
+        为配置中的服务器创建客户端
 
-                print(f"已连接到MCP服务器: {name}")
+        Args:
+            name: 服务器名称
 
-                # 获取工具列表
-                tools = await client.list_tools()
-                for tool in tools:
-                    self.tools_map[tool.name] = name
+        Returns:
+            按需启动的客户端，或立即启动服务器的fastmcp客户端（在专属任务中连接和关闭）
+        """
+        config = self.mcp_server_configs[name]
+        if is_lazy(name):
+            return LazyMCPClient(name, config, on_tools_changed=self._update_all_tools)
+        return OwnedClient(Client({'mcpServers': {name: config}}))
 
-                # 如果是本地服务器，获取系统提示词
-                if name == 'FastMcpLLM':
-                    try:
-                        prompts = await client.list_prompts()
-                        if "system_prompt" in prompts:
-                            prompt = await client.get_prompt("system_prompt")
-                            if prompt and hasattr(prompt, "text"):
-                                self.llm_client.set_system_message(prompt.text)
-                    except Exception as e:
-                        print(f"获取系统提示词时出错: {str(e)}")
+    async def _connect_server(self, name: str, client: Any) -> None:
+        """
+        连接一个MCP服务器并获取其工具列表
+
+        Args:
+            name: 服务器名称
+            client: fastmcp客户端或网关上该服务器的客户端
+        """
+        # 连接客户端
+        await client.__aenter__()
+        self.mcp_clients[name] = client
+
+        print(f"已连接到MCP服务器: {name}")
+
+        # 获取工具列表
+        tools = await client.list_tools()
+        for tool in tools:
+            self.tools_map[tool.name] = name
 
+        # 如果是本地服务器，获取系统提示词
+        if name == 'FastMcpLLM':
+            try:
+                prompts = await client.list_prompts()
+                if "system_prompt" in prompts:
+                    prompt = await client.get_prompt("system_prompt")
+                    if prompt and hasattr(prompt, "text"):
+                        for llm_client in self.llm_clients.values():
+                            llm_client.set_system_message(prompt.text)
             except Exception as e:
-                print(f"初始化MCP服务器 {name} 时出错: {str(e)}")
+                print(f"获取系统提示词时出错: {str(e)}")
 
-        # 更新所有工具列表
-        await self._update_all_tools()
+    async def _check_server(self, name: str) -> None:
+        """
+        健康检查：对服务器发送ping或获取工具列表
+
+        Args:
+            name: 服务器名称
+
+        Raises:
+            Exception: 服务器未连接或检查失败
+        """
+        client = self.mcp_clients.get(name)
+        if client is None:
+            raise RuntimeError("未连接")
+        await check_client(client)
+
+    async def _reconnect_server(self, name: str) -> None:
+        """
+        关闭服务器的旧连接（stdio服务器的子进程随之退出）并重新连接
+
+        Args:
+            name: 服务器名称
+
+        Raises:
+            Exception: 重新连接失败
+        """
+        old_client = self.mcp_clients.pop(name, None)
+        if old_client is not None:
+            await close_client(old_client)
+        if self.mcp_gateway is not None:
+            # 网关自行重连上游服务器，这里只需确认网关上该服务器恢复可用
+            client = self.mcp_gateway.server(name)
+        else:
+            client = self._create_server_client(name)
+        await self._connect_server(name, client)
+
+    def get_lazy_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        获取按需启动的服务器的状态
+
+        Returns:
+            服务器名称到状态的映射
+        """
+        return {name: client.get_stats() for name, client in self.mcp_clients.items()
+                if isinstance(client, LazyMCPClient)}
 
     async def _update_all_tools(self) -> None:
         """
-        更新所有工具列表
+        更新所有工具列表，不包括掉线或熔断中的服务器
         """
-        self.all_tools = []
-        for name, client in self.mcp_clients.items():
+        all_tools = []
+        for name, client in list(self.mcp_clients.items()):
+            if not self.health_monitor.available(name):
+                continue
             try:
                 tools = await client.list_tools()
                 for tool in tools:
@@ -312,36 +930,101 @@ class MCPLLMClient:
                     if name != 'FastMcpLLM':  # 本地工具不加前缀
                         tool.name = f"{name}:{tool.name}"
                         tool.description = f"[{name}] {tool.description}"
-                    self.all_tools.append(tool)
+                    all_tools.append(tool)
             except Exception as e:
                 print(f"获取服务器 {name} 的工具列表时出错: {str(e)}")
+                self.health_monitor.report_failure(name)
+        self.all_tools = all_tools
 
     async def close(self) -> None:
         """
         关闭所有MCP客户端
         """
+        await self.health_monitor.stop()
         for name, client in self.mcp_clients.items():
             try:
                 await client.__aexit__(None, None, None)
                 print(f"已关闭MCP服务器: {name}")
             except Exception as e:
                 print(f"关闭MCP服务器 {name} 时出错: {str(e)}")
+        if self.mcp_gateway is not None:
+            await self.mcp_gateway.close()
+            self.mcp_gateway = None
+
+    async def _stream_llm_events(self, llm_client: LLMClient, messages: Optional[List[Dict[str, str]]],
+                                 collected: List[str], usage: Dict[str, Any],
+                                 cancel_token: Optional[CancellationToken] = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        调用LLM并将输出解析为事件
+
+        Args:
+            llm_client: 会话的LLM客户端
+            messages: 消息列表，如果为None则使用当前对话历史
+            collected: 用于收集LLM原始输出文本的列表
+            usage: 接收本次调用token用量的字典（取消时为已生成部分的用量）
+            cancel_token: 取消令牌
+
+        Yields:
+            事件；LLM调用失败时产生一个致命错误事件后结束
 
-    async def process_message(self, user_message: str) -> AsyncGenerator[str, None]:
+        Raises:
+            GenerationCancelled: 生成被取消，已输出的文本保留在collected中
         """
-        处理用户消息，包括可能的工具调用，并以流式方式返回响应。
+        parser = TagStreamParser()
+        with span("llm_stream", messages=len(messages) if messages is not None else 0) as llm_span:
+            start_time = asyncio.get_running_loop().time()
+            chunk_count = 0
+            chars = 0
+            async for chunk in llm_client.call_llm_api(messages, cancel_token, usage):
+                if isinstance(chunk, str) and chunk.startswith("错误:"):
+                    llm_span.set(error=chunk)
+                    yield error_event(chunk[len("错误:"):].strip())
+                    return
+                if not chunk_count:
+                    llm_span.set(first_chunk_ms=round((asyncio.get_running_loop().time() - start_time) * 1000, 3))
+                chunk_count += 1
+                chars += len(chunk)
+                llm_span.set(chunks=chunk_count, chars=chars)
+                collected.append(chunk)
+                for event in parser.feed(chunk):
+                    yield event
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        for event in parser.flush():
+            yield event
+
+        if usage:
+            yield make_event(
+                EVENT_USAGE,
+                prompt_tokens=usage.get("prompt_tokens"),
+                completion_tokens=usage.get("completion_tokens"),
+                total_tokens=usage.get("total_tokens"),
+                estimated=bool(usage.get("estimated"))
+            )
+
+    async def process_message(self, user_message: str, session_id: Optional[int] = None,
+                              cancel_token: Optional[CancellationToken] = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        处理用户消息，包括可能的工具调用，并以流式方式返回响应。调用方需持有该会话的锁（session_lock）
 
         Args:
             user_message: 用户消息
+            session_id: 会话ID，为None时使用当前会话
+            cancel_token: 取消令牌，取消后停止LLM输出和工具调用，已生成的部分回复会保存到对话历史
 
         Yields:
-            处理后的响应文本块
+            类型化的流式事件（见stream_events模块）
         """
         if not self.mcp_clients:
-            yield "错误: MCP客户端未初始化"
+            yield error_event("MCP客户端未初始化")
             return
 
-        self.llm_client.add_message("user", user_message)
+        llm_client = self.get_llm_client(self.current_session_id if session_id is None else session_id)
+        # 调用方持有会话锁，此时同步其他工作进程写入的历史是安全的
+        await self.sync_history(llm_client)
+        llm_client.add_message("user", user_message)
+        partial_chunks = None  # 正在生成、尚未保存的LLM输出
+        partial_usage = None   # 其token用量
 
         try:
             tool_descriptions = []
@@ -350,27 +1033,39 @@ class MCPLLMClient:
                 tool_descriptions.append(description)
 
             tools_info = "\n".join(tool_descriptions)
-            system_message_content = f"{self.llm_client.system_message}\n\n你有以下工具可以使用:\n{tools_info}\n\n如果需要使用工具，请使用以下格式（在你的思考过程之后）：\n<tool>\n{{\n  \"name\": \"工具名称\",\n  \"parameters\": {{\n    \"参数1\": \"值1\",\n    \"参数2\": \"值2\"\n  }}\n}}\n</tool>\nLLM在生成工具调用后应该停止输出，等待工具执行结果。"
+            # 注入其他会话中的相关历史片段（工具结果轮次沿用对话历史，不再检索）
+            memory_context = ""
+            if not user_message.startswith("<tool_result>"):
+                with span("memory_search"):
+                    memory_context = await llm_client.get_memory_context(user_message)
+            if memory_context:
+                memory_context = f"\n\n{memory_context}"
+
+            system_message_content = f"{llm_client.system_message}{llm_client.get_summary_prompt()}{memory_context}\n\n你有以下工具可以使用:\n{tools_info}\n\n如果需要使用工具，请使用以下格式（在你的思考过程之后）：\n<tool>\n{{\n  \"name\": \"工具名称\",\n  \"parameters\": {{\n    \"参数1\": \"值1\",\n    \"参数2\": \"值2\"\n  }}\n}}\n</tool>\nLLM在生成工具调用后应该停止输出，等待工具执行结果。"
 
             current_messages = [{"role": "system", "content": system_message_content}]
-            current_messages.extend(self.llm_client.conversation_history)
+            current_messages.extend(llm_client.get_recent_history())
 
             # Stream 1: Initial LLM response
-            initial_llm_response_buffer = ""
+            collected_chunks = []
+            collected_usage = {}
+            partial_chunks, partial_usage = collected_chunks, collected_usage
             # print("Calling LLM with messages:", current_messages)
-            async for chunk in self.llm_client.call_llm_api(current_messages):
-                if isinstance(chunk, str) and chunk.startswith("错误:"):
-                    yield chunk
+            async for event in self._stream_llm_events(llm_client, current_messages, collected_chunks, collected_usage,
+                                                       cancel_token):
+                if event["type"] == EVENT_ERROR:
+                    yield event
                     # Attempt to remove the last user message if LLM call failed early
-                    if self.llm_client.conversation_history and self.llm_client.conversation_history[-1]["role"] == "user":
-                        self.llm_client.conversation_history.pop()
+                    if llm_client.conversation_history and llm_client.conversation_history[-1]["role"] == "user":
+                        llm_client.conversation_history.pop()
                     return
-                initial_llm_response_buffer += chunk
-                yield chunk # Stream raw text to client
+                yield event # Stream parsed events to client
+            initial_llm_response_buffer = "".join(collected_chunks)
 
             # Add the full initial assistant message to history (important for context if no tool call or if tool call fails before next LLM)
             # This will be overwritten if a tool call is successful and a new assistant message is generated later.
-            self.llm_client.add_message("assistant", initial_llm_response_buffer)
+            llm_client.add_message("assistant", initial_llm_response_buffer, collected_usage or None)
+            partial_chunks = None
 
             # Parse the complete initial_llm_response_buffer for tool calls
             import re
@@ -396,7 +1091,7 @@ class MCPLLMClient:
                         parsed_tool_args = tool_data.get("parameters", {})
                     except Exception as e:
                         error_msg = f"解析工具调用JSON时出错: {str(e)}"
-                        yield f"\n<think>\n内部错误: {error_msg}\n</think>\n"
+                        yield error_event(f"内部错误: {error_msg}", fatal=False)
                         # LLM already added initial_llm_response_buffer to history.
                         return
 
@@ -414,11 +1109,29 @@ class MCPLLMClient:
 
                             mcp_client_instance = self.mcp_clients.get(target_server_name)
                             if not mcp_client_instance:
-                                error_msg = f"错误: 找不到服务器 {target_server_name} 的客户端"
-                                yield f"\n<think>\n内部错误: {error_msg}\n</think>\n"
+                                error_msg = f"找不到服务器 {target_server_name} 的客户端"
+                                yield error_event(f"内部错误: {error_msg}", fatal=False)
                                 return
 
-                            tool_result_list = await mcp_client_instance.call_tool(tool_name_on_server, parsed_tool_args or {})
+                            tool_call = mcp_client_instance.call_tool(tool_name_on_server, parsed_tool_args or {})
+                            tool_start = asyncio.get_running_loop().time()
+                            try:
+                                with span(f"tool_call[{parsed_tool_name}]", server=target_server_name,
+                                          args_chars=len(json.dumps(parsed_tool_args or {}, ensure_ascii=False))) as tool_span:
+                                    if cancel_token is not None:
+                                        tool_result_list = await cancel_token.run(tool_call)
+                                    else:
+                                        tool_result_list = await tool_call
+                            except GenerationCancelled:
+                                raise
+                            except Exception:
+                                tool_call_errors.inc(server=target_server_name, tool=tool_name_on_server)
+                                # 服务器可能已崩溃，立即做一次健康检查
+                                self.health_monitor.report_failure(target_server_name)
+                                raise
+                            finally:
+                                tool_call_duration.observe(asyncio.get_running_loop().time() - tool_start,
+                                                           server=target_server_name, tool=tool_name_on_server)
 
                             result_text_parts = []
                             for content_item in tool_result_list:
@@ -428,76 +1141,93 @@ class MCPLLMClient:
                                     result_text_parts.append(f"[图片] {content_item.url}")
                                 # else: skip unknown content types or add a placeholder
                             tool_result_str = "\n".join(result_text_parts).strip()
+                            tool_span.set(result_chars=len(tool_result_str))
 
                             # Escape for JSON string compatibility within the XML-like tag
                             escaped_tool_result_str = tool_result_str.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
                             tool_result_message_for_llm = f"<tool_result>\n{{\n  \"name\": \"{parsed_tool_name}\",\n  \"result\": \"{escaped_tool_result_str}\"\n}}\n</tool_result>\n"
 
-                            yield f"{tool_result_message_for_llm}" # Stream the tool result to the client
+                            yield make_event(EVENT_TOOL_RESULT, name=parsed_tool_name, result=tool_result_str) # Stream the tool result to the client
 
                             tool_results_message_for_llm += tool_result_message_for_llm
 
                             # Update conversation history for the next LLM call
                             # The initial assistant message (initial_llm_response_buffer) is already there.
                             # Now add the tool_result as if it's a user message for the LLM.
-                            # self.llm_client.add_message("user", tool_result_message_for_llm)
+                            # llm_client.add_message("user", tool_result_message_for_llm)
 
+                        except GenerationCancelled:
+                            raise
                         except Exception as e:
                             error_message = f"调用工具 {parsed_tool_name} 时出错: {str(e)}"
-                            yield f"\n<think>\n内部错误: {error_message}\n</think>\n"
+                            yield error_event(f"内部错误: {error_message}", fatal=False)
                             # Add error as tool result for LLM to potentially explain
                             escaped_error_str = str(e).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
                             error_tool_result = f"<tool_result>\n{{\n  \"name\": \"{parsed_tool_name}\",\n  \"error\": \"{escaped_error_str}\"\n}}\n</tool_result>"
-                            yield f"\n{error_tool_result}\n"
-                            self.llm_client.add_message("user", error_tool_result)
+                            yield make_event(EVENT_TOOL_RESULT, name=parsed_tool_name, error=str(e))
+                            llm_client.add_message("user", error_tool_result)
 
                             # Optionally, call LLM again to explain the error
-                            error_explanation_content = ""
-                            async for chunk in self.llm_client.call_llm_api():
-                                error_explanation_content += chunk
-                                yield chunk
-                            self.llm_client.add_message("assistant", error_explanation_content)
+                            error_explanation_chunks = []
+                            error_explanation_usage = {}
+                            partial_chunks, partial_usage = error_explanation_chunks, error_explanation_usage
+                            async for event in self._stream_llm_events(llm_client, None, error_explanation_chunks,
+                                                                       error_explanation_usage, cancel_token):
+                                yield event
+                            llm_client.add_message("assistant", "".join(error_explanation_chunks),
+                                                   error_explanation_usage or None)
+                            partial_chunks = None
                     else:
                         # Invalid tool name requested by LLM
-                        yield f"\n<think>\n无效的工具: {parsed_tool_name}. 初始回复已发送。\n</think>\n"
+                        yield error_event(f"无效的工具: {parsed_tool_name}. 初始回复已发送。", fatal=False)
                         # The initial_llm_response_buffer (containing the invalid tool call) was already added to history.
                 # Stream 2: LLM explanation of tool result
-                final_explanation_content = ""
                 # print("Calling LLM with tool results:", tool_results_message_for_llm)
-                async for chunk in self.process_message(tool_results_message_for_llm): # Uses updated history
-                    if isinstance(chunk, str) and chunk.startswith("错误:"):
-                        yield chunk
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
+                async for event in self.process_message(tool_results_message_for_llm, llm_client.session_id, cancel_token): # Uses updated history
+                    yield event
+                    if event["type"] == EVENT_ERROR and event["fatal"]:
                         return
-                    final_explanation_content += chunk
-                    yield chunk
+                # 后续调用被取消时，部分回复已由后续调用保存
+                if cancel_token is not None and cancel_token.cancelled:
+                    return
 
                 # Replace the previous assistant message with the full exchange if tool call was successful
-                if self.llm_client.conversation_history and self.llm_client.conversation_history[-2]["role"] == "assistant":
-                    self.llm_client.conversation_history[-2]["content"] = initial_llm_response_buffer # Ensure this is the one with the <tool> tag
+                if llm_client.conversation_history and llm_client.conversation_history[-2]["role"] == "assistant":
+                    llm_client.conversation_history[-2]["content"] = initial_llm_response_buffer # Ensure this is the one with the <tool> tag
 
-                # self.llm_client.add_message("assistant", final_explanation_content)
+                # llm_client.add_message("assistant", final_explanation_content)
 
 
             # else: No tool call found in the initial LLM response.
             # The initial_llm_response_buffer was already streamed and added to history.
             # Nothing more to do in this case.
 
+        except GenerationCancelled:
+            # 保存已生成的部分回复，使对话历史与界面上显示的内容一致
+            print(f"会话 {llm_client.session_id} 的生成已取消")
+            if partial_chunks is not None:
+                partial_text = "".join(partial_chunks)
+                llm_client.add_message("assistant", f"{partial_text}\n{CANCELLED_MARKER}" if partial_text else CANCELLED_MARKER,
+                                       partial_usage or None)
+
         except Exception as e:
             error_message = f"处理消息时出错: {str(e)}"
             print(error_message) # Log to server console
-            yield f"错误: {error_message}"
+            yield error_event(error_message)
             # Clean up history if an unexpected error occurs
-            if self.llm_client.conversation_history and self.llm_client.conversation_history[-1]["role"] == "user":
-                 self.llm_client.conversation_history.pop()
-            if self.llm_client.conversation_history and self.llm_client.conversation_history[-1]["role"] == "assistant": # if initial response was added
-                 self.llm_client.conversation_history.pop()
+            if llm_client.conversation_history and llm_client.conversation_history[-1]["role"] == "user":
+                 llm_client.conversation_history.pop()
+            if llm_client.conversation_history and llm_client.conversation_history[-1]["role"] == "assistant": # if initial response was added
+                 llm_client.conversation_history.pop()
 
     def clear_history(self) -> None:
         """
         清除当前会话的对话历史
         """
-        self.llm_client.clear_history()
+        self.get_llm_client(self.current_session_id).clear_history()
 
     def get_sessions(self) -> List[Dict[str, Any]]:
         """
@@ -528,7 +1258,7 @@ class MCPLLMClient:
             session_id: 会话ID
         """
         self.current_session_id = session_id
-        self.llm_client.set_session(session_id)
+        self.llm_client = self.get_llm_client(session_id)
 
     def rename_session(self, session_id: int, name: str) -> bool:
         """
@@ -557,7 +1287,11 @@ class MCPLLMClient:
         if session_id == self.current_session_id:
             self.switch_session(1)  # 默认会话ID为1
 
-        return db_utils.delete_session(session_id)
+        success = db_utils.delete_session(session_id)
+        if success:
+            self.llm_clients.pop(session_id, None)
+            self.session_locks.pop(session_id, None)
+        return success
 
     def set_temperature(self, temperature: float) -> None:
         """
@@ -567,6 +1301,9 @@ class MCPLLMClient:
             temperature: 温度值，控制生成文本的随机性
         """
         self.llm_client.set_temperature(temperature)
+        for llm_client in self.llm_clients.values():
+            llm_client.set_temperature(temperature)
+        self._save_llm_params(temperature=self.llm_client.temperature)
 
     def set_max_tokens(self, max_tokens: int) -> None:
         """
@@ -576,6 +1313,15 @@ class MCPLLMClient:
             max_tokens: 生成文本的最大token数
         """
         self.llm_client.set_max_tokens(max_tokens)
+        for llm_client in self.llm_clients.values():
+            llm_client.set_max_tokens(max_tokens)
+        self._save_llm_params(max_tokens=self.llm_client.max_tokens)
+
+    def _save_llm_params(self, **params: Any) -> None:
+        # 保存到数据库，其他工作进程在下次获取LLM客户端时使用
+        saved = dict(db_utils.get_app_state("llm_params", {}))
+        saved.update(params)
+        self._set_app_state("llm_params", saved)
 
     def get_llm_params(self) -> Dict[str, Any]:
         """
@@ -584,9 +1330,10 @@ class MCPLLMClient:
         Returns:
             包含temperature和max_tokens的字典
         """
+        llm_client = self.get_llm_client(self.current_session_id)
         return {
-            "temperature": self.llm_client.temperature,
-            "max_tokens": self.llm_client.max_tokens
+            "temperature": llm_client.temperature,
+            "max_tokens": llm_client.max_tokens
         }
 
 
@@ -0,0 +1,599 @@
+"""
+MCP工具网关
+独立进程统一持有mcpServers.json中所有MCP服务器的连接，通过本地HTTP（TCP或Unix套接字）对外提供工具列表、
+工具调用和提示词接口，多个网页应用工作进程共用同一组MCP服务器进程，而不是每个进程各启动一份。
+每个服务器可以保持多个会话组成连接池，调用时选择进行中调用最少的会话；每个工具有独立的并发上限。
+网关对每个服务器做后台健康检查，掉线的服务器自动重建会话池，恢复前调用其工具返回503。
+
+MCPLLMClient在设置了MCP_GATEWAY时通过本模块的MCPGatewayConnection连接网关，不再自行启动MCP服务器。
+
+用法:
+    python mcp_gateway.py                                   # 监听MCP_GATEWAY，默认http://127.0.0.1:8765
+    MCP_GATEWAY=unix:/tmp/mcp_gateway.sock python mcp_gateway.py
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, List, Any, Optional, Tuple, Union
+from urllib.parse import quote
+
+import aiohttp
+from aiohttp import web
+from yarl import URL
+from dotenv import load_dotenv
+from fastmcp import Client
+from mcp import types
+from pydantic import TypeAdapter
+
+from mcp_health import MCPHealthMonitor, OwnedClient, check_client, close_client
+
+# 加载环境变量
+load_dotenv()
+
+# 网关地址，http://主机:端口 或 unix:套接字路径；网页应用设置后通过网关调用工具
+MCP_GATEWAY = os.getenv("MCP_GATEWAY", "")
+
+# 网页应用轮询网关上不可用服务器恢复情况的间隔（秒）
+MCP_GATEWAY_POLL_INTERVAL = float(os.getenv("MCP_GATEWAY_POLL_INTERVAL", "5"))
+
+# 网关未设置地址时监听的默认地址
+DEFAULT_GATEWAY_ADDRESS = "http://127.0.0.1:8765"
+
+# 每个MCP服务器保持的会话数
+MCP_GATEWAY_POOL_SIZE = int(os.getenv("MCP_GATEWAY_POOL_SIZE", "1"))
+
+# 每个工具默认的并发调用上限，0表示不限制
+MCP_GATEWAY_TOOL_CONCURRENCY = int(os.getenv("MCP_GATEWAY_TOOL_CONCURRENCY", "4"))
+
+# 单独设置的并发上限，格式"服务器:工具=N"，逗号分隔，工具为*时作用于该服务器的所有工具
+MCP_GATEWAY_TOOL_LIMITS = os.getenv("MCP_GATEWAY_TOOL_LIMITS", "")
+
+
+class GatewayError(Exception):
+    """
+    网关返回的错误（工具调用失败、服务器不存在等）
+    """
+
+
+class ServerUnavailableError(GatewayError):
+    """
+    服务器已配置但当前掉线或熔断中
+    """
+
+
+def parse_address(address: str) -> Tuple[Optional[str], str]:
+    """
+    解析网关地址
+
+    Args:
+        address: http://主机:端口 或 unix:套接字路径
+
+    Returns:
+        (Unix套接字路径, HTTP基础URL)，TCP地址时套接字路径为None
+    """
+    if address.startswith("unix:"):
+        # 通过Unix套接字访问时URL中的主机名不起作用
+        return address[len("unix:"):], "http://mcp-gateway"
+    return None, address.rstrip("/")
+
+
+def parse_tool_limits(spec: str) -> Dict[Tuple[str, str], int]:
+    """
+    解析工具并发上限配置
+
+    Args:
+        spec: 格式"服务器:工具=N"，逗号分隔
+
+    Returns:
+        (服务器, 工具)到上限的映射，工具为*时作用于该服务器的所有工具
+    """
+    limits = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, value = item.rpartition("=")
+        server, _, tool = key.partition(":")
+        try:
+            limits[(server.strip(), tool.strip() or "*")] = int(value)
+        except ValueError:
+            print(f"忽略无效的工具并发上限配置: {item}")
+    return limits
+
+
+class UpstreamServer:
+    """
+    一个MCP服务器的会话池
+    """
+
+    def __init__(self, name: str, config: Dict[str, Any], pool_size: int):
+        """
+        初始化会话池
+
+        Args:
+            name: 服务器名称
+            config: mcpServers.json中该服务器的配置
+            pool_size: 会话数
+        """
+        self.name = name
+        self.config = config
+        self.pool_size = max(pool_size, 1)
+        self.clients = []
+        self.in_flight: List[int] = []
+        self.tools: List[Dict[str, Any]] = []
+        self.calls = 0
+        self.errors = 0
+
+    async def connect(self) -> None:
+        """
+        建立所有会话并获取工具列表
+        """
+        for _ in range(self.pool_size):
+            # 在专属任务中连接，重连和关闭可以在其他任务中进行
+            client = OwnedClient(Client({'mcpServers': {self.name: self.config}}))
+            await client.__aenter__()
+            self.clients.append(client)
+            self.in_flight.append(0)
+        self.tools = [tool.model_dump(mode="json") for tool in await self.clients[0].list_tools()]
+
+    @asynccontextmanager
+    async def session(self):
+        """
+        取得进行中调用最少的会话
+        """
+        index = min(range(len(self.clients)), key=lambda i: self.in_flight[i])
+        self.in_flight[index] += 1
+        try:
+            yield self.clients[index]
+        finally:
+            self.in_flight[index] -= 1
+
+    async def check(self) -> None:
+        """
+        对所有会话做健康检查，任一会话失败即视为服务器掉线
+        """
+        if not self.clients:
+            raise RuntimeError("未连接")
+        await asyncio.gather(*(check_client(client) for client in self.clients))
+
+    async def close(self) -> None:
+        for client in self.clients:
+            await close_client(client)
+        self.clients = []
+        self.in_flight = []
+
+
+class MCPGateway:
+    """
+    MCP工具网关服务
+    """
+
+    def __init__(self, mcp_servers_file: str = "mcpServers.json", pool_size: int = MCP_GATEWAY_POOL_SIZE,
+                 tool_concurrency: int = MCP_GATEWAY_TOOL_CONCURRENCY, tool_limits: str = MCP_GATEWAY_TOOL_LIMITS):
+        """
+        初始化网关
+
+        Args:
+            mcp_servers_file: MCP服务器配置文件路径
+            pool_size: 每个服务器的会话数
+            tool_concurrency: 每个工具默认的并发上限，0表示不限制
+            tool_limits: 单独设置的并发上限
+        """
+        self.mcp_servers_file = mcp_servers_file
+        self.pool_size = pool_size
+        self.tool_concurrency = tool_concurrency
+        self.tool_limits = parse_tool_limits(tool_limits)
+        self.servers: Dict[str, UpstreamServer] = {}
+        self.server_configs: Dict[str, Dict[str, Any]] = {}
+        self.health_monitor = MCPHealthMonitor(self._check_server, self._reconnect_server)
+        self._semaphores: Dict[Tuple[str, str], asyncio.Semaphore] = {}
+        self._waiting: Dict[Tuple[str, str], int] = {}
+        self._active: Dict[Tuple[str, str], int] = {}
+        self.started_at = time.time()
+
+    async def start(self) -> None:
+        """
+        并发连接所有MCP服务器，连接失败的服务器由健康监控在后台重连
+        """
+        try:
+            with open(self.mcp_servers_file, 'r', encoding='utf-8') as f:
+                mcp_servers = json.load(f).get('mcpServers', {})
+        except Exception as e:
+            print(f"加载MCP服务器配置时出错: {str(e)}")
+            mcp_servers = {}
+        self.server_configs = mcp_servers
+
+        async def connect(name: str) -> None:
+            try:
+                await self._connect_server(name)
+                connected = True
+            except Exception as e:
+                print(f"初始化MCP服务器 {name} 时出错: {str(e)}")
+                connected = False
+            self.health_monitor.add(name, healthy=connected)
+
+        await asyncio.gather(*(connect(name) for name in mcp_servers))
+
+    async def _connect_server(self, name: str) -> None:
+        server = UpstreamServer(name, self.server_configs[name], self.pool_size)
+        try:
+            await server.connect()
+        except BaseException:
+            await server.close()
+            raise
+        self.servers[name] = server
+        print(f"已连接到MCP服务器: {name}（{server.pool_size} 个会话，{len(server.tools)} 个工具）")
+
+    async def _check_server(self, name: str) -> None:
+        server = self.servers.get(name)
+        if server is None:
+            raise RuntimeError("未连接")
+        await server.check()
+
+    async def _reconnect_server(self, name: str) -> None:
+        # 关闭整个会话池后重建，进行中的调用会失败
+        old_server = self.servers.pop(name, None)
+        if old_server is not None:
+            await old_server.close()
+        await self._connect_server(name)
+
+    def available(self, name: str) -> bool:
+        """
+        服务器是否已连接且健康
+
+        Args:
+            name: 服务器名称
+
+        Returns:
+            是否可用
+        """
+        return name in self.servers and self.health_monitor.available(name)
+
+    async def close(self) -> None:
+        await self.health_monitor.stop()
+        for server in self.servers.values():
+            await server.close()
+        self.servers = {}
+
+    def _limit(self, server: str, tool: str) -> int:
+        for key in ((server, tool), (server, "*")):
+            if key in self.tool_limits:
+                return self.tool_limits[key]
+        return self.tool_concurrency
+
+    def _semaphore(self, server: str, tool: str) -> Optional[asyncio.Semaphore]:
+        key = (server, tool)
+        if key not in self._semaphores:
+            limit = self._limit(server, tool)
+            self._semaphores[key] = asyncio.Semaphore(limit) if limit > 0 else None
+        return self._semaphores[key]
+
+    async def call_tool(self, server_name: str, tool: str, arguments: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        调用工具，超过该工具的并发上限时排队
+
+        Args:
+            server_name: 服务器名称
+            tool: 工具名称
+            arguments: 参数
+
+        Returns:
+            工具结果的内容列表
+
+        Raises:
+            ServerUnavailableError: 服务器掉线或熔断中
+            GatewayError: 服务器不存在
+        """
+        if server_name in self.server_configs and not self.available(server_name):
+            raise ServerUnavailableError(f"服务器 {server_name} 暂不可用")
+        server = self.servers.get(server_name)
+        if server is None:
+            raise GatewayError(f"找不到服务器 {server_name}")
+
+        key = (server_name, tool)
+        semaphore = self._semaphore(server_name, tool)
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            if semaphore is not None:
+                await semaphore.acquire()
+        finally:
+            self._waiting[key] -= 1
+        self._active[key] = self._active.get(key, 0) + 1
+        try:
+            server.calls += 1
+            async with server.session() as client:
+                result = await client.call_tool(tool, arguments)
+            return [item.model_dump(mode="json") for item in result]
+        except Exception:
+            server.errors += 1
+            # 服务器可能已崩溃，立即做一次健康检查
+            self.health_monitor.report_failure(server_name)
+            raise
+        finally:
+            self._active[key] -= 1
+            if semaphore is not None:
+                semaphore.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取网关统计
+
+        Returns:
+            每个服务器的会话数、进行中调用、调用次数和失败次数，每个服务器的健康状态，
+            以及每个调用过的工具的并发上限、进行中和排队的调用数
+        """
+        tools = {}
+        for server, tool in self._semaphores:
+            tools[f"{server}:{tool}"] = {
+                "limit": self._limit(server, tool),
+                "in_flight": self._active.get((server, tool), 0),
+                "waiting": self._waiting.get((server, tool), 0)
+            }
+        return {
+            "uptime": time.time() - self.started_at,
+            "servers": {
+                name: {
+                    "sessions": len(server.clients),
+                    "in_flight": sum(server.in_flight),
+                    "calls": server.calls,
+                    "errors": server.errors,
+                    "tools": len(server.tools)
+                }
+                for name, server in self.servers.items()
+            },
+            "health": self.health_monitor.get_stats(),
+            "tools": tools
+        }
+
+    # HTTP接口
+
+    def create_app(self) -> web.Application:
+        async def health(request):
+            return web.json_response({"status": "ok",
+                                      "servers": [name for name in self.server_configs if self.available(name)]})
+
+        async def servers(request):
+            # 列出所有配置的服务器，掉线的服务器没有工具，客户端据此等待其恢复
+            return web.json_response({"servers": {
+                name: {
+                    "available": self.available(name),
+                    "tools": self.servers[name].tools if self.available(name) else []
+                }
+                for name in self.server_configs
+            }})
+
+        async def call_tool(request):
+            data = await request.json()
+            try:
+                content = await self.call_tool(request.match_info["server"], request.match_info["tool"],
+                                               data.get("arguments") or {})
+            except ServerUnavailableError as e:
+                return web.json_response({"error": str(e)}, status=503)
+            except GatewayError as e:
+                return web.json_response({"error": str(e)}, status=404)
+            except Exception as e:
+                return web.json_response({"error": str(e)}, status=502)
+            return web.json_response({"content": content})
+
+        def prompt_server(request):
+            # 与call_tool相同：掉线或熔断中的服务器返回503
+            name = request.match_info["server"]
+            if name in self.server_configs and not self.available(name):
+                return None, web.json_response({"error": f"服务器 {name} 暂不可用"}, status=503)
+            server = self.servers.get(name)
+            if server is None:
+                return None, web.json_response({"error": f"找不到服务器 {name}"}, status=404)
+            return server, None
+
+        async def list_prompts(request):
+            server, error = prompt_server(request)
+            if error is not None:
+                return error
+            try:
+                async with server.session() as client:
+                    prompts = await client.list_prompts()
+            except Exception as e:
+                return web.json_response({"error": str(e)}, status=502)
+            return web.json_response({"prompts": [prompt.model_dump(mode="json") for prompt in prompts]})
+
+        async def get_prompt(request):
+            server, error = prompt_server(request)
+            if error is not None:
+                return error
+            data = await request.json()
+            try:
+                async with server.session() as client:
+                    prompt = await client.get_prompt(request.match_info["prompt"], data.get("arguments"))
+            except Exception as e:
+                return web.json_response({"error": str(e)}, status=502)
+            return web.json_response({"prompt": prompt.model_dump(mode="json")})
+
+        async def stats(request):
+            return web.json_response(self.get_stats())
+
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/health", health)
+        app.router.add_get("/servers", servers)
+        app.router.add_post("/servers/{server}/tools/{tool}/call", call_tool)
+        app.router.add_get("/servers/{server}/prompts", list_prompts)
+        app.router.add_post("/servers/{server}/prompts/{prompt}", get_prompt)
+        app.router.add_get("/stats", stats)
+        return app
+
+
+# 工具结果的内容列表
+_content_adapter = TypeAdapter(List[Union[types.TextContent, types.ImageContent, types.EmbeddedResource]])
+
+
+class GatewayServerClient:
+    """
+    网关上一个MCP服务器的客户端，提供MCPLLMClient使用到的fastmcp.Client接口
+    """
+
+    def __init__(self, connection: "MCPGatewayConnection", name: str):
+        self.connection = connection
+        self.name = name
+        self._path = f"/servers/{quote(name, safe='')}"
+
+    async def __aenter__(self) -> "GatewayServerClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        # 连接由MCPGatewayConnection统一关闭
+        pass
+
+    async def list_tools(self) -> list:
+        data = await self.connection.request("GET", "/servers")
+        server = data["servers"].get(self.name)
+        if server is None:
+            raise GatewayError(f"网关上没有服务器 {self.name}")
+        if not server.get("available", True):
+            raise ServerUnavailableError(f"网关上的服务器 {self.name} 暂不可用")
+        # 每次返回新的对象，调用方会修改工具名称
+        return [types.Tool.model_validate(tool) for tool in server["tools"]]
+
+    async def call_tool(self, name: str, arguments: Optional[Dict[str, Any]] = None) -> list:
+        data = await self.connection.request("POST", f"{self._path}/tools/{quote(name, safe='')}/call",
+                                             {"arguments": arguments or {}})
+        return _content_adapter.validate_python(data["content"])
+
+    async def list_prompts(self) -> list:
+        data = await self.connection.request("GET", f"{self._path}/prompts")
+        return [types.Prompt.model_validate(prompt) for prompt in data["prompts"]]
+
+    async def get_prompt(self, name: str, arguments: Optional[Dict[str, Any]] = None):
+        data = await self.connection.request("POST", f"{self._path}/prompts/{quote(name, safe='')}",
+                                             {"arguments": arguments})
+        return types.GetPromptResult.model_validate(data["prompt"])
+
+
+class MCPGatewayConnection:
+    """
+    到MCP工具网关的连接，所有服务器的请求复用同一个HTTP连接池
+    """
+
+    def __init__(self, address: str = MCP_GATEWAY):
+        """
+        初始化连接
+
+        Args:
+            address: 网关地址，http://主机:端口 或 unix:套接字路径
+        """
+        self.address = address
+        self._socket_path, self._base_url = parse_address(address)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.UnixConnector(path=self._socket_path) if self._socket_path else aiohttp.TCPConnector()
+            # 工具调用可能耗时较长，只限制连接时间
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=None, sock_connect=10))
+        return self._session
+
+    async def request(self, method: str, path: str, data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        发送请求
+
+        Args:
+            method: HTTP方法
+            path: 路径
+            data: JSON请求体
+
+        Returns:
+            JSON响应
+
+        Raises:
+            ServerUnavailableError: 服务器掉线或熔断中（HTTP 503）
+            GatewayError: 网关返回其他错误
+        """
+        async with self._get_session().request(method, self._base_url + path, json=data) as response:
+            body = await response.json(content_type=None)
+            if response.status == 503:
+                raise ServerUnavailableError(body.get("error") or "服务器暂不可用")
+            if response.status >= 400:
+                raise GatewayError(body.get("error") or f"网关返回 HTTP {response.status}")
+            return body
+
+    async def list_servers(self) -> List[str]:
+        """
+        获取网关上配置的服务器名称，包括暂不可用的服务器
+
+        Returns:
+            服务器名称列表
+        """
+        data = await self.request("GET", "/servers")
+        return list(data["servers"])
+
+    def server(self, name: str) -> GatewayServerClient:
+        """
+        获取网关上一个服务器的客户端
+
+        Args:
+            name: 服务器名称
+
+        Returns:
+            服务器客户端
+        """
+        return GatewayServerClient(self, name)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+async def serve(address: str, mcp_servers_file: str) -> None:
+    """
+    运行网关直到收到终止信号
+
+    Args:
+        address: 监听地址
+        mcp_servers_file: MCP服务器配置文件路径
+    """
+    gateway = MCPGateway(mcp_servers_file)
+    await gateway.start()
+
+    # 客户端断开（例如生成被停止）时取消进行中的工具调用
+    runner = web.AppRunner(gateway.create_app(), handler_cancellation=True)
+    await runner.setup()
+    socket_path, base_url = parse_address(address)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        site = web.UnixSite(runner, socket_path)
+    else:
+        url = URL(base_url)
+        site = web.TCPSite(runner, url.host, url.port)
+    await site.start()
+    print(f"MCP工具网关已启动: {address}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows不支持，按Ctrl+C时由asyncio.run处理
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await gateway.close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+        print("MCP工具网关已停止")
+
+
+if __name__ == "__main__":
+    servers_file = sys.argv[1] if len(sys.argv) > 1 else "mcpServers.json"
+    try:
+        asyncio.run(serve(MCP_GATEWAY or DEFAULT_GATEWAY_ADDRESS, servers_file))
+    except KeyboardInterrupt:
+        pass
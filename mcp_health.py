@@ -0,0 +1,346 @@
+"""
+MCP服务器健康监控模块
+后台为每个MCP服务器定期执行带超时的健康检查（ping，不支持时用list_tools），失败后按指数退避自动重连，
+重连成功后刷新工具列表；连续重连失败或短时间内反复掉线的服务器进入熔断状态，冷却期内不再重连，其工具不提供给LLM。
+直连模式下由MCPLLMClient使用，网关模式下由mcp_gateway中的网关使用；网关模式下MCPLLMClient只按固定间隔轮询网关上服务器的可用性，
+不自行熔断（熔断由网关负责）
+"""
+
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Dict, Any, Optional
+
+from metrics import mcp_server_up, mcp_server_reconnects
+
+# 健康检查间隔（秒），为0时不做定期检查（仍会在工具调用失败后检查）
+MCP_HEALTH_INTERVAL = float(os.getenv("MCP_HEALTH_INTERVAL", "30"))
+
+# 健康检查超时（秒）
+MCP_HEALTH_TIMEOUT = float(os.getenv("MCP_HEALTH_TIMEOUT", "10"))
+
+# 重连超时（秒），npx等需要下载的服务器启动较慢
+MCP_RECONNECT_TIMEOUT = float(os.getenv("MCP_RECONNECT_TIMEOUT", "60"))
+
+# 重连退避的初始和最大间隔（秒）
+MCP_RECONNECT_BASE_DELAY = float(os.getenv("MCP_RECONNECT_BASE_DELAY", "1"))
+MCP_RECONNECT_MAX_DELAY = float(os.getenv("MCP_RECONNECT_MAX_DELAY", "60"))
+
+# 连续重连失败达到该次数后熔断
+MCP_CIRCUIT_FAILURES = int(os.getenv("MCP_CIRCUIT_FAILURES", "5"))
+
+# 在MCP_FLAP_WINDOW秒内掉线达到该次数视为反复掉线，熔断
+MCP_FLAP_THRESHOLD = int(os.getenv("MCP_FLAP_THRESHOLD", "3"))
+MCP_FLAP_WINDOW = float(os.getenv("MCP_FLAP_WINDOW", "600"))
+
+# 熔断的冷却时间（秒），之后尝试一次重连
+MCP_CIRCUIT_COOLDOWN = float(os.getenv("MCP_CIRCUIT_COOLDOWN", "300"))
+
+# 服务器状态
+STATUS_HEALTHY = "healthy"
+STATUS_DOWN = "down"
+STATUS_OPEN = "circuit_open"
+
+
+class ServerHealth:
+    """
+    一个MCP服务器的健康状态
+    """
+
+    def __init__(self, name: str, healthy: bool):
+        self.name = name
+        self.status = STATUS_HEALTHY if healthy else STATUS_DOWN
+        self.failures = 0               # 连续重连失败次数
+        self.downs: deque = deque()     # 最近的掉线时间
+        self.last_error: Optional[str] = None
+        self.last_check: Optional[float] = None
+        self.open_until: Optional[float] = None
+        self.reconnects = 0
+        self.wake = asyncio.Event()     # 工具调用失败时提前检查
+        self.task: Optional[asyncio.Task] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "consecutive_failures": self.failures,
+            "recent_downs": len(self.downs),
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+            "last_check": self.last_check,
+            "circuit_open_until": self.open_until if self.status == STATUS_OPEN else None
+        }
+
+
+class MCPHealthMonitor:
+    """
+    MCP服务器健康监控器
+    """
+
+    def __init__(self, check: Callable[[str], Awaitable[None]], reconnect: Callable[[str], Awaitable[None]],
+                 on_change: Optional[Callable[[], Awaitable[None]]] = None, interval: float = MCP_HEALTH_INTERVAL,
+                 poll_interval: Optional[float] = None):
+        """
+        初始化监控器
+
+        Args:
+            check: 健康检查，失败时抛出异常
+            reconnect: 关闭旧连接并重新连接，失败时抛出异常
+            on_change: 服务器可用性变化后调用（刷新工具列表）
+            interval: 健康检查间隔（秒）
+            poll_interval: 设置时不熔断，掉线期间按该间隔（秒）轮询，失败不计入熔断；
+                用于服务器由其他进程（MCP工具网关）负责重连和熔断的情况
+        """
+        self.check = check
+        self.reconnect = reconnect
+        self.on_change = on_change
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.servers: Dict[str, ServerHealth] = {}
+
+    def add(self, name: str, healthy: bool = True) -> None:
+        """
+        开始监控一个服务器，未连接成功的服务器以掉线状态加入，随后自动重连
+
+        Args:
+            name: 服务器名称
+            healthy: 当前是否已连接
+        """
+        if name in self.servers:
+            return
+        state = ServerHealth(name, healthy)
+        self.servers[name] = state
+        mcp_server_up.set(1 if healthy else 0, server=name)
+        state.task = asyncio.get_running_loop().create_task(self._watch(state))
+
+    def available(self, name: str) -> bool:
+        """
+        服务器是否可用（未被监控的服务器视为可用）
+
+        Args:
+            name: 服务器名称
+
+        Returns:
+            是否可用
+        """
+        state = self.servers.get(name)
+        return state is None or state.status == STATUS_HEALTHY
+
+    def report_failure(self, name: str) -> None:
+        """
+        工具调用失败时调用，立即检查该服务器
+
+        Args:
+            name: 服务器名称
+        """
+        state = self.servers.get(name)
+        if state is not None and state.status == STATUS_HEALTHY:
+            state.wake.set()
+
+    async def stop(self) -> None:
+        """
+        停止监控
+        """
+        tasks = [state.task for state in self.servers.values() if state.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.servers = {}
+
+    def _reconnect_delay(self, state: ServerHealth) -> float:
+        if self.poll_interval is not None:
+            return self.poll_interval
+        if state.status == STATUS_OPEN:
+            return max(state.open_until - time.time(), 0.0)
+        delay = min(MCP_RECONNECT_BASE_DELAY * 2 ** max(state.failures - 1, 0), MCP_RECONNECT_MAX_DELAY)
+        # 加入抖动，避免多个工作进程同时重连
+        return delay * random.uniform(0.5, 1.0)
+
+    def _open_circuit(self, state: ServerHealth, reason: str) -> None:
+        state.status = STATUS_OPEN
+        state.open_until = time.time() + MCP_CIRCUIT_COOLDOWN
+        print(f"MCP服务器 {state.name} {reason}，熔断 {MCP_CIRCUIT_COOLDOWN:.0f} 秒")
+
+    async def _notify(self) -> None:
+        if self.on_change is None:
+            return
+        try:
+            await self.on_change()
+        except Exception as e:
+            print(f"刷新工具列表时出错: {str(e)}")
+
+    async def _watch(self, state: ServerHealth) -> None:
+        while True:
+            if state.status == STATUS_HEALTHY:
+                try:
+                    await asyncio.wait_for(state.wake.wait(), self.interval if self.interval > 0 else None)
+                except asyncio.TimeoutError:
+                    pass
+                state.wake.clear()
+                state.last_check = time.time()
+                try:
+                    await asyncio.wait_for(self.check(state.name), MCP_HEALTH_TIMEOUT)
+                    continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    state.last_error = str(e) or type(e).__name__
+                await self._mark_down(state)
+                continue
+
+            await asyncio.sleep(self._reconnect_delay(state))
+            try:
+                await asyncio.wait_for(self.reconnect(state.name), MCP_RECONNECT_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                state.last_error = str(e) or type(e).__name__
+                if self.poll_interval is not None:
+                    # 只轮询可用性，不计入熔断
+                    continue
+                state.failures += 1
+                mcp_server_reconnects.inc(server=state.name, outcome="failed")
+                print(f"重连MCP服务器 {state.name} 失败（第 {state.failures} 次）: {state.last_error}")
+                if state.failures >= MCP_CIRCUIT_FAILURES:
+                    self._open_circuit(state, f"连续 {state.failures} 次重连失败")
+                elif state.status == STATUS_OPEN:
+                    # 冷却后的试探重连失败，继续熔断
+                    self._open_circuit(state, "冷却后重连仍然失败")
+                continue
+
+            state.status = STATUS_HEALTHY
+            state.failures = 0
+            state.open_until = None
+            state.reconnects += 1
+            mcp_server_reconnects.inc(server=state.name, outcome="succeeded")
+            mcp_server_up.set(1, server=state.name)
+            print(f"已重新连接MCP服务器: {state.name}")
+            await self._notify()
+
+    async def _mark_down(self, state: ServerHealth) -> None:
+        now = time.time()
+        state.downs.append(now)
+        while state.downs and state.downs[0] < now - MCP_FLAP_WINDOW:
+            state.downs.popleft()
+        mcp_server_up.set(0, server=state.name)
+        print(f"MCP服务器 {state.name} 健康检查失败: {state.last_error}")
+        if self.poll_interval is None and len(state.downs) >= MCP_FLAP_THRESHOLD:
+            self._open_circuit(state, f"{MCP_FLAP_WINDOW:.0f} 秒内掉线 {len(state.downs)} 次")
+        else:
+            state.status = STATUS_DOWN
+        # 掉线期间不向LLM提供该服务器的工具
+        await self._notify()
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        获取所有服务器的健康状态
+
+        Returns:
+            服务器名称到状态的映射
+        """
+        return {name: state.to_dict() for name, state in self.servers.items()}
+
+
+async def check_client(client: Any) -> None:
+    """
+    对MCP客户端做一次健康检查：支持ping时发送ping，否则获取工具列表
+
+    Args:
+        client: fastmcp客户端或网关上服务器的客户端
+
+    Raises:
+        Exception: 检查失败
+    """
+    ping = getattr(client, "ping", None)
+    if ping is not None:
+        await ping()
+    else:
+        await client.list_tools()
+
+
+def _retrieve_exception(task: asyncio.Task) -> None:
+    # 关闭超时被放弃等待的任务，其异常不再有人读取
+    if not task.cancelled():
+        task.exception()
+
+
+class OwnedClient:
+    """
+    在专属任务中持有fastmcp客户端的上下文。
+    fastmcp客户端内部使用anyio的取消作用域，必须在进入它的同一个任务中退出；连接和关闭常常发生在不同的任务中
+    （初始化请求、健康检查的重连、空闲关闭、服务关闭），因此由一个长期运行的任务进入上下文并等待停止事件，
+    关闭时只设置停止事件，由该任务自己退出。其余属性和方法直接转发给客户端
+    """
+
+    def __init__(self, client: Any):
+        """
+        初始化
+
+        Args:
+            client: 未连接的fastmcp客户端
+        """
+        self.client = client
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
+
+    async def _own(self, ready: asyncio.Future) -> None:
+        try:
+            async with self.client:
+                if not ready.done():
+                    ready.set_result(None)
+                await self._stop.wait()
+        except BaseException as e:
+            if ready.done():
+                raise
+            # 连接失败，交给等待连接的调用方
+            if isinstance(e, asyncio.CancelledError):
+                ready.cancel()
+                raise
+            ready.set_exception(e)
+
+    async def __aenter__(self) -> "OwnedClient":
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        self._stop = asyncio.Event()
+        task = loop.create_task(self._own(ready))
+        task.add_done_callback(_retrieve_exception)
+        try:
+            await ready
+        except asyncio.CancelledError:
+            # 等待连接的调用方被取消（例如重连超时），由专属任务自己中止连接
+            task.cancel()
+            raise
+        self._task = task
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        task, self._task = self._task, None
+        if task is None:
+            return
+        self._stop.set()
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # 放弃等待关闭（例如超时），取消专属任务，它仍在自己的任务中退出上下文
+            task.cancel()
+            raise
+
+
+async def close_client(client: Any, timeout: float = 5.0) -> None:
+    """
+    关闭可能已失效的MCP客户端，忽略错误
+
+    Args:
+        client: fastmcp客户端（OwnedClient）
+        timeout: 等待关闭的时间（秒）
+    """
+    try:
+        await asyncio.wait_for(client.__aexit__(None, None, None), timeout)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"关闭失效的MCP客户端时出错: {str(e) or type(e).__name__}")
@@ -0,0 +1,305 @@
+"""
+MCP服务器按需启动模块
+把每个服务器的工具列表连同其配置的哈希缓存在磁盘上，启动时直接用缓存的工具列表向LLM提供工具，
+服务器进程在第一次实际调用工具时才启动，空闲超过一定时间后自动关闭，下次调用时再启动。
+配置变化（哈希不同）或没有缓存时，启动服务器获取工具列表并更新缓存，之后同样在空闲后关闭
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, Any, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from fastmcp import Client
+from mcp import types
+
+import db_utils
+from mcp_health import OwnedClient, close_client
+
+# 是否按需启动MCP服务器
+MCP_LAZY_START = os.getenv("MCP_LAZY_START", "true").lower() == "true"
+
+# 始终在启动时连接的服务器，逗号分隔；本地服务器提供系统提示词，默认不按需启动
+MCP_EAGER_SERVERS = [name.strip() for name in os.getenv("MCP_EAGER_SERVERS", "FastMcpLLM").split(",") if name.strip()]
+
+# 服务器空闲多久（秒）后关闭，0表示启动后不再关闭
+MCP_IDLE_TIMEOUT = float(os.getenv("MCP_IDLE_TIMEOUT", "300"))
+
+# 工具列表缓存文件路径（与对话数据库放在一起）
+TOOL_CACHE_FILE = os.path.splitext(db_utils.DB_FILE)[0] + '.mcptools.json'
+
+
+def config_hash(config: Dict[str, Any]) -> str:
+    """
+    计算服务器配置的哈希，配置变化后缓存的工具列表失效
+
+    Args:
+        config: mcpServers.json中该服务器的配置
+
+    Returns:
+        SHA-256十六进制字符串
+    """
+    payload = json.dumps(config, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ToolCatalogCache:
+    """
+    磁盘上的工具列表缓存，JSON文件，服务器名称到配置哈希和工具列表的映射
+    """
+
+    def __init__(self, path: str = TOOL_CACHE_FILE):
+        """
+        初始化缓存
+
+        Args:
+            path: 缓存文件路径
+        """
+        self.path = path
+        self.lock_file = path + '.lock'
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _file_lock(self):
+        """
+        跨进程的缓存文件锁（不支持fcntl的平台上只有进程内的锁）
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"读取MCP工具列表缓存时出错: {str(e)}")
+            return {}
+
+    def get(self, name: str, config: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        """
+        获取缓存的工具列表
+
+        Args:
+            name: 服务器名称
+            config: 服务器当前的配置
+
+        Returns:
+            工具列表（JSON形式），没有缓存或配置已变化时返回None
+        """
+        entry = self._read().get(name)
+        if not entry or entry.get("config_hash") != config_hash(config):
+            return None
+        return entry.get("tools")
+
+    def put(self, name: str, config: Dict[str, Any], tools: List[Dict[str, Any]]) -> None:
+        """
+        保存工具列表。读取、修改和写回期间持有文件锁，多个工作进程同时写入不同服务器时不会互相覆盖；
+        先写入临时文件再替换，不持锁的读取不会读到不完整的文件
+
+        Args:
+            name: 服务器名称
+            config: 服务器的配置
+            tools: 工具列表（JSON形式）
+        """
+        with self._lock, self._file_lock():
+            data = self._read()
+            data[name] = {"config_hash": config_hash(config), "tools": tools, "updated_at": time.time()}
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"保存MCP工具列表缓存时出错: {str(e)}")
+
+
+class LazyMCPClient:
+    """
+    按需启动的MCP服务器客户端，提供MCPLLMClient使用到的fastmcp.Client接口。
+    工具列表来自缓存，调用工具或获取提示词时才启动服务器
+    """
+
+    def __init__(self, name: str, config: Dict[str, Any], catalog: Optional[ToolCatalogCache] = None,
+                 idle_timeout: float = MCP_IDLE_TIMEOUT,
+                 on_tools_changed: Optional[Callable[[], Awaitable[None]]] = None):
+        """
+        初始化客户端
+
+        Args:
+            name: 服务器名称
+            config: mcpServers.json中该服务器的配置
+            catalog: 工具列表缓存
+            idle_timeout: 空闲多久（秒）后关闭服务器，0表示不关闭
+            on_tools_changed: 启动后发现工具列表与缓存不同时调用（刷新工具列表）
+        """
+        self.name = name
+        self.config = config
+        self.catalog = catalog if catalog is not None else tool_catalog
+        self.idle_timeout = idle_timeout
+        self.on_tools_changed = on_tools_changed
+        self.tools = self.catalog.get(name, config)
+        self.client = None
+        self.in_flight = 0
+        self.last_used = time.time()
+        self.starts = 0
+        self._lock = asyncio.Lock()
+        self._idle_task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.client is not None
+
+    async def __aenter__(self) -> "LazyMCPClient":
+        # 不启动服务器
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._idle_task is not None:
+            self._idle_task.cancel()
+            self._idle_task = None
+        async with self._lock:
+            await self._stop()
+
+    async def _start(self) -> None:
+        # 调用方持有self._lock
+        if self.client is not None:
+            return
+        start_time = time.time()
+        # 在专属任务中连接，空闲关闭和服务关闭可以在其他任务中进行
+        client = OwnedClient(Client({'mcpServers': {self.name: self.config}}))
+        await client.__aenter__()
+        try:
+            tools = [tool.model_dump(mode="json") for tool in await client.list_tools()]
+        except BaseException:
+            await close_client(client)
+            raise
+        self.client = client
+        self.starts += 1
+        self.last_used = time.time()
+        print(f"已按需启动MCP服务器: {self.name}（{time.time() - start_time:.1f} 秒）")
+
+        changed = tools != self.tools
+        if changed:
+            # 等待文件锁和写入文件在线程中进行，不阻塞事件循环
+            await asyncio.to_thread(self.catalog.put, self.name, self.config, tools)
+        had_tools = self.tools is not None
+        self.tools = tools
+        if self.idle_timeout > 0:
+            self._idle_task = asyncio.get_running_loop().create_task(self._close_when_idle())
+        if changed and had_tools and self.on_tools_changed is not None:
+            # 服务器更新后工具列表可能变化，配置没变时缓存不会失效
+            asyncio.get_running_loop().create_task(self.on_tools_changed())
+
+    async def _stop(self) -> None:
+        # 调用方持有self._lock
+        if self.client is None:
+            return
+        client, self.client = self.client, None
+        await close_client(client)
+
+    async def _close_when_idle(self) -> None:
+        while True:
+            await asyncio.sleep(max(self.last_used + self.idle_timeout - time.time(), 0.0) + 0.1)
+            async with self._lock:
+                if self.client is None:
+                    break
+                if self.in_flight == 0 and time.time() - self.last_used >= self.idle_timeout:
+                    self._idle_task = None
+                    await self._stop()
+                    print(f"MCP服务器 {self.name} 空闲 {self.idle_timeout:g} 秒，已关闭")
+                    break
+
+    async def _acquire(self):
+        async with self._lock:
+            await self._start()
+            self.in_flight += 1
+            return self.client
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self.last_used = time.time()
+
+    async def list_tools(self) -> list:
+        if self.tools is None:
+            # 没有可用的缓存，启动服务器获取工具列表
+            async with self._lock:
+                await self._start()
+        # 每次返回新的对象，调用方会修改工具名称
+        return [types.Tool.model_validate(tool) for tool in self.tools]
+
+    async def call_tool(self, name: str, arguments: Optional[Dict[str, Any]] = None) -> list:
+        client = await self._acquire()
+        try:
+            return await client.call_tool(name, arguments or {})
+        finally:
+            self._release()
+
+    async def list_prompts(self) -> list:
+        client = await self._acquire()
+        try:
+            return await client.list_prompts()
+        finally:
+            self._release()
+
+    async def get_prompt(self, name: str, arguments: Optional[Dict[str, Any]] = None):
+        client = await self._acquire()
+        try:
+            return await client.get_prompt(name, arguments)
+        finally:
+            self._release()
+
+    async def ping(self) -> None:
+        # 未启动时没有需要检查的进程
+        client = self.client
+        if client is not None:
+            await client.ping()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取按需启动的状态
+
+        Returns:
+            是否正在运行、启动次数、进行中的调用数和最近一次使用的时间
+        """
+        return {
+            "running": self.running,
+            "starts": self.starts,
+            "in_flight": self.in_flight,
+            "last_used": self.last_used,
+            "cached_tools": len(self.tools) if self.tools is not None else None
+        }
+
+
+def is_lazy(name: str) -> bool:
+    """
+    服务器是否按需启动
+
+    Args:
+        name: 服务器名称
+
+    Returns:
+        是否按需启动
+    """
+    return MCP_LAZY_START and name not in MCP_EAGER_SERVERS
+
+
+# 创建全局工具列表缓存实例
+tool_catalog = ToolCatalogCache()
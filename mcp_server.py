@@ -5,12 +5,27 @@ MCP服务器实现，提供工具函数供LLM调用
 import os
 import datetime
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Any, Optional
 
 from fastmcp import FastMCP, Context
 
 from baidusearch.baidusearch import search
 from web_parser import fetch_and_parse_url
+from file_tools import (
+    DEFAULT_MAX_READ_BYTES, get_file_stats, count_text_lines, read_byte_range, read_line_range,
+    read_tail, grep_file, append_to_file, replace_lines, truncate_text
+)
+from local_index import local_index
+import db_utils
+
+# 默认搜索后端，可选值: 'auto'（优先本地索引，本地结果不足时联网）、'baidu'、'local'
+DEFAULT_SEARCH_PROVIDER = os.getenv("SEARCH_PROVIDER", "auto")
+
+# auto模式下本地结果的最低相关度（BM25分数），低于该值的结果不算命中
+LOCAL_SEARCH_MIN_SCORE = float(os.getenv("LOCAL_SEARCH_MIN_SCORE", "0.5"))
+
+# auto模式下至少命中多少条本地结果才不再联网（不超过请求的结果数）
+LOCAL_SEARCH_MIN_HITS = int(os.getenv("LOCAL_SEARCH_MIN_HITS", "1"))
 
 # 创建MCP服务器实例
 mcp = FastMCP(
@@ -18,22 +33,99 @@ mcp = FastMCP(
     instructions="这是一个支持MCP的LLM对话工具，可以通过工具函数扩展LLM的能力。"
 )
 
+
+class SearchProvider:
+    """
+    搜索后端接口，新的搜索后端继承本类并通过register_search_provider注册
+    """
+
+    name = ""
+
+    def search(self, query: str, num_results: int) -> List[Dict[str, Any]]:
+        """
+        执行搜索
+
+        Args:
+            query: 搜索查询
+            num_results: 返回结果的数量
+
+        Returns:
+            搜索结果列表，每项包含title、abstract、url、rank
+        """
+        raise NotImplementedError
+
+
+class BaiduSearchProvider(SearchProvider):
+    """
+    基于baidusearch的联网搜索
+    """
+
+    name = "baidu"
+
+    def search(self, query: str, num_results: int) -> List[Dict[str, Any]]:
+        return search(query, num_results=num_results)
+
+
+class LocalIndexSearchProvider(SearchProvider):
+    """
+    基于本地全文索引的离线搜索，索引内容来自fetch_web_content和read_file
+    """
+
+    name = "local"
+
+    def search(self, query: str, num_results: int) -> List[Dict[str, Any]]:
+        return local_index.search(query, num_results=num_results)
+
+
+# 已注册的搜索后端
+SEARCH_PROVIDERS: Dict[str, SearchProvider] = {}
+
+
+def register_search_provider(provider: SearchProvider) -> None:
+    """
+    注册搜索后端
+
+    Args:
+        provider: 搜索后端实例
+    """
+    SEARCH_PROVIDERS[provider.name] = provider
+
+
+register_search_provider(BaiduSearchProvider())
+register_search_provider(LocalIndexSearchProvider())
+
+
 @mcp.tool()
-async def search_web(query: str, num_results: int, ctx: Context) -> str:
+async def search_web(query: str, num_results: int, ctx: Context, provider: str = DEFAULT_SEARCH_PROVIDER) -> str:
     """搜索网络获取信息，搜索完成后，你可以使用fetch_web_content工具获取具体网页的详细内容
 
 Args:
     query: 搜索查询
     num_results: 返回结果的数量
+    provider: 搜索后端，可选值: 'auto'（优先检索本地已获取过的网页和文件，相关结果不足时联网搜索）、'baidu'（联网搜索）、'local'（仅本地）
 
 Returns:
     搜索结果
 """
     await ctx.info(f"正在搜索: {query}")
-    # 这里应该实现实际的搜索功能，这里只是模拟
 
-    # 搜索关键字 "Full Stack Developer"
-    results = search(query, num_results=num_results)
+    if provider == "auto":
+        results = SEARCH_PROVIDERS["local"].search(query, num_results)
+        # 子串匹配（score为None）和相关度过低的结果不算命中
+        hits = [result for result in results
+                if result.get("score") is not None and result["score"] >= LOCAL_SEARCH_MIN_SCORE]
+        if hits and len(hits) >= min(LOCAL_SEARCH_MIN_HITS, num_results):
+            await ctx.info(f"本地索引命中 {len(hits)} 条结果")
+            return hits
+        if results:
+            await ctx.info(f"本地索引只有 {len(hits)} 条相关结果，改为联网搜索")
+        provider = "baidu"
+
+    search_provider = SEARCH_PROVIDERS.get(provider)
+    if search_provider is None:
+        return f"错误: 未知的搜索后端 '{provider}'，可选值: auto, {', '.join(SEARCH_PROVIDERS)}"
+
+    results = search_provider.search(query, num_results)
     return results
 
 @mcp.tool()
@@ -51,14 +143,35 @@ Returns:
     return f"当前时间是: {current_time}"
 
 @mcp.tool()
-async def read_file(file_path: str, ctx: Context) -> str:
-    """读取文件内容
+async def read_file(
+    file_path: str,
+    ctx: Context,
+    start_line: int = 0,
+    end_line: int = 0,
+    head: int = 0,
+    tail: int = 0,
+    offset: Optional[int] = None,
+    length: int = 0,
+    grep: str = "",
+    ignore_case: bool = False,
+    max_bytes: int = DEFAULT_MAX_READ_BYTES
+) -> str:
+    """读取文件内容，支持按行/字节范围、头尾和正则过滤分页读取大文件。返回内容前附带文件大小等元信息（按行读取时还有总行数），便于继续翻页
 
 Args:
     file_path: 文件路径
+    start_line: 起始行号（从1开始），与end_line配合读取行范围
+    end_line: 结束行号（包含），0表示读到文件末尾
+    head: 读取文件开头的行数
+    tail: 读取文件末尾的行数
+    offset: 起始字节偏移，负数表示从文件末尾倒数，与length配合读取字节范围；只指定length时从0开始
+    length: 读取的字节数
+    grep: 正则表达式，只返回匹配的行（带行号）
+    ignore_case: grep时是否忽略大小写
+    max_bytes: 单次返回内容的最大字节数，超出部分会被截断
 
 Returns:
-    文件内容
+    文件元信息和文件内容
 """
     await ctx.info(f"读取文件: {file_path}")
     try:
@@ -66,23 +179,72 @@ Returns:
         if not path.exists():
             return f"错误: 文件 '{file_path}' 不存在"
 
-        with open(path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        # 统计总行数需要扫描整个文件，只在按行读取时统计，按字节分页时保持与文件大小无关的开销
+        size = path.stat().st_size
+        total_lines = None
+        whole_file = False
 
-        return content
+        if grep:
+            matches, more = grep_file(path, grep, ignore_case=ignore_case)
+            content = "\n".join(f"{line_no}: {line}" for line_no, line in matches)
+            scope = f"匹配 {len(matches)} 行" + ("（已达上限，可能还有更多）" if more else "")
+        elif tail > 0:
+            size, total_lines = get_file_stats(path)
+            lines = read_tail(path, tail)
+            content = "".join(lines)
+            scope = f"第 {total_lines - len(lines) + 1}-{total_lines} 行"
+        elif head > 0 or start_line > 0 or end_line > 0:
+            size, total_lines = get_file_stats(path)
+            first = max(start_line, 1)
+            last = first + head - 1 if head > 0 else end_line
+            lines = read_line_range(path, first, last)
+            content = "".join(lines)
+            scope = f"第 {first}-{first + len(lines) - 1} 行"
+        elif offset is not None or length > 0:
+            offset = offset if offset is not None else 0
+            read_length = length if length > 0 else max_bytes
+            content = read_byte_range(path, offset, read_length)
+            start = max(size + offset, 0) if offset < 0 else min(offset, size)
+            scope = f"字节 {start}-{min(start + read_length, size)}"
+        elif size <= max_bytes:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            total_lines = count_text_lines(content)
+            scope = "全部内容"
+            whole_file = True
+        else:
+            content = read_byte_range(path, 0, max_bytes)
+            scope = f"字节 0-{max_bytes}"
+
+        content, truncated = truncate_text(content, max_bytes)
+        if truncated:
+            scope += f"，已截断至 {max_bytes} 字节"
+
+        # 完整读取的文件加入本地索引，便于后续search_web离线检索
+        if whole_file:
+            try:
+                local_index.add_document(path.resolve().as_uri(), path.name, content, 'file')
+            except Exception as e:
+                await ctx.warning(f"写入本地索引失败: {str(e)}")
+
+        lines_info = f" | 总行数: {total_lines}" if total_lines is not None else ""
+        return f"[文件: {file_path} | 大小: {size} 字节{lines_info} | 返回: {scope}]\n{content}"
     except Exception as e:
         return f"读取文件时出错: {str(e)}"
 
 @mcp.tool()
-async def write_file(file_path: str, content: str, ctx: Context) -> str:
-    """写入文件内容
+async def write_file(file_path: str, content: str, ctx: Context, mode: str = "overwrite", start_line: int = 0, end_line: int = 0) -> str:
+    """写入文件内容，支持覆盖、追加和按行替换
 
 Args:
     file_path: 文件路径
     content: 要写入的内容
+    mode: 写入模式，可选值: 'overwrite'（覆盖整个文件）、'append'（追加到末尾）、'patch'（用content替换start_line到end_line的行，end_line小于start_line时表示在start_line之前插入）
+    start_line: patch模式的起始行号（从1开始）
+    end_line: patch模式的结束行号（包含）
 
 Returns:
-    操作结果
+    操作结果及写入后的文件大小和总行数
 """
     await ctx.info(f"写入文件: {file_path}")
     try:
@@ -91,10 +253,25 @@ Returns:
         # 确保目录存在
         path.parent.mkdir(parents=True, exist_ok=True)
 
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        if mode == "append":
+            append_to_file(path, content)
+        elif mode == "patch":
+            if not path.exists():
+                return f"错误: 文件 '{file_path}' 不存在，无法使用patch模式"
+            if start_line < 1:
+                return "错误: patch模式需要指定start_line（从1开始）"
+            replace_lines(path, start_line, end_line, content)
+        elif mode == "overwrite":
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+        else:
+            return f"错误: 未知的写入模式 '{mode}'，可选值: overwrite, append, patch"
 
-        return f"成功写入文件: {file_path}"
+        # 追加和按行替换时不再扫描整个文件统计行数
+        size = path.stat().st_size
+        if mode == "overwrite":
+            return f"成功写入文件: {file_path} (大小: {size} 字节, 总行数: {count_text_lines(content)})"
+        return f"成功写入文件: {file_path} (大小: {size} 字节)"
     except Exception as e:
         return f"写入文件时出错: {str(e)}"
 
@@ -113,10 +290,53 @@ Returns:
     await ctx.info(f"正在获取网页内容: {url}")
     try:
         result = fetch_and_parse_url(url, format=format, max_length=max_length)
+
+        # 加入本地索引，便于后续search_web离线检索（解析失败的结果不入索引）
+        if not result.startswith("获取或解析URL内容失败"):
+            try:
+                local_index.add_document(url, url, result, 'web')
+            except Exception as e:
+                await ctx.warning(f"写入本地索引失败: {str(e)}")
+
         return result
     except Exception as e:
         return f"获取网页内容失败: {str(e)}"
 
+@mcp.tool()
+async def search_conversations(query: str, ctx: Context, session_id: int = 0, limit: int = 5, offset: int = 0) -> str:
+    """全文搜索历史对话记录，用于回忆之前会话中讨论过的内容，无需加载完整的历史记录
+
+Args:
+    query: 搜索关键词
+    session_id: 只搜索指定会话，0表示搜索所有会话
+    limit: 返回结果的数量
+    offset: 结果偏移量，用于翻页
+
+Returns:
+    按相关度排序的匹配片段，包含会话ID、会话名称、角色和时间
+"""
+    await ctx.info(f"搜索历史对话: {query}")
+    try:
+        results, total = db_utils.search_conversations(
+            query,
+            limit=limit,
+            offset=offset,
+            session_id=session_id or None,
+            escape=False
+        )
+    except Exception as e:
+        return f"搜索历史对话时出错: {str(e)}"
+
+    if not results:
+        return f"未找到与 '{query}' 相关的历史对话"
+
+    lines = [f"共找到 {total} 条相关记录，当前显示第 {offset + 1}-{offset + len(results)} 条:"]
+    for result in results:
+        lines.append(
+            f"- [会话 {result['session_id']} {result['session_name'] or ''} | {result['role']} | {result['timestamp']}] {result['snippet']}"
+        )
+    return "\n".join(lines)
+
 @mcp.resource("config://env")
 async def get_env_config() -> Dict[str, str]:
     """获取环境配置信息（不包含敏感信息）
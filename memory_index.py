@@ -0,0 +1,372 @@
+"""
+跨会话语义记忆模块
+使用哈希n-gram向量在CPU上为消息生成嵌入，存储在基于NumPy的向量索引中（持久化在conversations.db旁），
+并为当前问题检索其他会话中的相关历史片段
+"""
+
+import os
+import re
+import zlib
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import db_utils
+
+# 向量维度
+EMBEDDING_DIM = int(os.getenv("MEMORY_EMBEDDING_DIM", "256"))
+
+# 参与嵌入计算的最大字符数
+MAX_EMBED_CHARS = 4000
+
+# 相似度低于该值的历史片段不注入提示词
+MIN_SIMILARITY = float(os.getenv("MEMORY_MIN_SIMILARITY", "0.25"))
+
+# 索引文件路径（与对话数据库放在一起）
+INDEX_BASE_PATH = os.path.splitext(db_utils.DB_FILE)[0] + '.memory'
+
+_WORD_PATTERN = re.compile(r'[a-z0-9_]+')
+_CJK_PATTERN = re.compile(r'[㐀-鿿豈-﫿]+')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的token数：中日韩字符每个约1个token，其余字符每4个约1个token
+
+    Args:
+        text: 文本
+
+    Returns:
+        估算的token数
+    """
+    cjk_chars = sum(len(run) for run in _CJK_PATTERN.findall(text))
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+
+def should_index(content: str) -> bool:
+    """
+    消息是否写入记忆索引：工具结果（以<tool_result>开头的消息）不入索引
+
+    Args:
+        content: 消息内容
+
+    Returns:
+        是否写入索引
+    """
+    return not content.startswith("<tool_result>")
+
+
+def embed_text(text: str, dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """
+    使用带符号的特征哈希生成文本向量：英文按单词，中文按单字和相邻双字
+
+    Args:
+        text: 文本
+        dim: 向量维度
+
+    Returns:
+        L2归一化后的float32向量，文本没有可用特征时返回零向量
+    """
+    text = text[:MAX_EMBED_CHARS].lower()
+
+    features = _WORD_PATTERN.findall(text)
+    for run in _CJK_PATTERN.findall(text):
+        features.extend(run)
+        features.extend(run[i:i + 2] for i in range(len(run) - 1))
+
+    vector = np.zeros(dim, dtype=np.float32)
+    if not features:
+        return vector
+
+    hashes = np.fromiter((zlib.crc32(f.encode('utf-8')) for f in features), dtype=np.uint32, count=len(features))
+    signs = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+    np.add.at(vector, (hashes % dim).astype(np.intp), signs)
+
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class MemoryIndex:
+    """
+    基于NumPy的向量索引
+
+    向量和元数据以追加方式写入两个二进制文件，启动时整体加载到内存；
+    查询时对全部向量做一次矩阵乘法，再用argpartition取top-k。
+    多个工作进程共享索引文件：追加时持有文件锁，查询前读入其他进程追加的部分
+    """
+
+    def __init__(self, base_path: str = INDEX_BASE_PATH, dim: int = EMBEDDING_DIM):
+        """
+        初始化向量索引
+
+        Args:
+            base_path: 索引文件路径前缀
+            dim: 向量维度
+        """
+        self.dim = dim
+        self.vectors_file = base_path + '.vec'
+        self.ids_file = base_path + '.ids'
+        self.lock_file = base_path + '.lock'
+        self._lock = threading.Lock()
+
+        # 预分配容量，按倍数扩容以摊销追加开销
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._ids = np.zeros((0, 2), dtype=np.int64)  # 每行: (message_id, session_id)
+        self._size = 0
+        self._file_count = 0  # 已从索引文件读入（或由本进程写入）的记录数
+        self._loaded = False
+        # 从数据库重建时已收录的最大消息ID，避免重建后再次添加同一条消息
+        self._rebuilt_max_id = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _ensure_capacity(self, extra: int) -> None:
+        """
+        确保还能容纳extra个向量
+        """
+        needed = self._size + extra
+        capacity = self._vectors.shape[0]
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2, 1024)
+        vectors = np.zeros((new_capacity, self.dim), dtype=np.float32)
+        ids = np.zeros((new_capacity, 2), dtype=np.int64)
+        vectors[:self._size] = self._vectors[:self._size]
+        ids[:self._size] = self._ids[:self._size]
+        self._vectors = vectors
+        self._ids = ids
+
+    def _append(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        """
+        追加向量到内存中的数组
+        """
+        self._ensure_capacity(len(vectors))
+        self._vectors[self._size:self._size + len(vectors)] = vectors
+        self._ids[self._size:self._size + len(ids)] = ids
+        self._size += len(vectors)
+
+    @contextmanager
+    def _file_lock(self):
+        """
+        跨进程的索引文件锁（不支持fcntl的平台上只有进程内的锁）
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_file, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _file_records(self) -> int:
+        try:
+            # 进程异常退出时两个文件可能只写入了一部分，以较短者为准
+            return min(os.path.getsize(self.vectors_file) // (self.dim * 4), os.path.getsize(self.ids_file) // 16)
+        except OSError:
+            return 0
+
+    def _read_new_records_locked(self) -> None:
+        """
+        读入索引文件中尚未读入的记录（其他进程追加的部分）
+        """
+        count = self._file_records() - self._file_count
+        if count <= 0:
+            return
+        vectors = np.fromfile(self.vectors_file, dtype=np.float32, count=count * self.dim,
+                              offset=self._file_count * self.dim * 4)
+        ids = np.fromfile(self.ids_file, dtype=np.int64, count=count * 2, offset=self._file_count * 16)
+        self._append(vectors.reshape(count, self.dim), ids.reshape(count, 2))
+        self._file_count += count
+
+    def load(self) -> None:
+        """
+        从磁盘加载索引，索引文件不存在时从数据库中的全部对话重建
+        """
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+
+            with self._file_lock():
+                if not (os.path.exists(self.vectors_file) and os.path.exists(self.ids_file)):
+                    self._rebuild_from_db()
+                    return
+                self._read_new_records_locked()
+
+    def _rebuild_from_db(self) -> None:
+        """
+        为数据库中已有的对话生成向量并写入索引文件
+        """
+        for path in (self.vectors_file, self.ids_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+        vectors = []
+        ids = []
+        for session in db_utils.get_sessions():
+            for conv in db_utils.get_conversations(session['id']):
+                self._rebuilt_max_id = max(self._rebuilt_max_id, conv['id'])
+                if not should_index(conv['content']):
+                    continue
+                vector = embed_text(conv['content'], self.dim)
+                if vector.any():
+                    vectors.append(vector)
+                    ids.append((conv['id'], session['id']))
+
+        if vectors:
+            self._write_locked(np.stack(vectors), np.array(ids, dtype=np.int64))
+
+    def _add_vectors_locked(self, vectors: np.ndarray, ids: np.ndarray, persist: bool = True) -> None:
+        """
+        批量添加向量（调用方需持有锁）
+        """
+        if not persist:
+            self._append(vectors, ids)
+            return
+        with self._file_lock():
+            # 先读入其他进程追加的记录，保证文件中的位置与已读入的记录数一致
+            self._read_new_records_locked()
+            self._write_locked(vectors, ids)
+
+    def _write_locked(self, vectors: np.ndarray, ids: np.ndarray) -> None:
+        """
+        添加向量并追加写入索引文件（调用方需持有锁和文件锁）
+        """
+        self._append(vectors, ids)
+        with open(self.vectors_file, 'ab') as f:
+            f.write(vectors.astype(np.float32).tobytes())
+        with open(self.ids_file, 'ab') as f:
+            f.write(ids.astype(np.int64).tobytes())
+        self._file_count += len(vectors)
+
+    def add_vectors(self, vectors: np.ndarray, ids: np.ndarray, persist: bool = True) -> None:
+        """
+        批量添加已计算好的向量
+
+        Args:
+            vectors: 形状为 (n, dim) 的L2归一化向量
+            ids: 形状为 (n, 2) 的 (message_id, session_id) 数组
+            persist: 是否追加写入索引文件
+        """
+        self.load()
+        with self._lock:
+            self._add_vectors_locked(vectors, ids, persist)
+
+    def add(self, message_id: int, session_id: int, content: str) -> None:
+        """
+        添加一条消息到索引，不入索引的消息（见should_index）被忽略
+
+        Args:
+            message_id: 消息ID
+            session_id: 会话ID
+            content: 消息内容
+        """
+        self.load()
+        if message_id <= self._rebuilt_max_id or not should_index(content):
+            return
+        vector = embed_text(content, self.dim)
+        if not vector.any():
+            return
+        self.add_vectors(vector[np.newaxis, :], np.array([[message_id, int(session_id)]], dtype=np.int64))
+
+    def search(self, query: str, top_k: int = 5, exclude_session_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        检索与查询最相似的消息
+
+        Args:
+            query: 查询文本
+            top_k: 返回结果的数量
+            exclude_session_id: 排除的会话ID（通常为当前会话，其内容已在对话历史中）
+
+        Returns:
+            结果列表，每项包含message_id、session_id、score，按相似度降序排列
+        """
+        self.load()
+        query_vector = embed_text(query, self.dim)
+        if not query_vector.any():
+            return []
+
+        with self._lock:
+            if self._file_records() > self._file_count:
+                with self._file_lock():
+                    self._read_new_records_locked()
+            if self._size == 0:
+                return []
+            scores = self._vectors[:self._size] @ query_vector
+            if exclude_session_id is not None:
+                scores[self._ids[:self._size, 1] == int(exclude_session_id)] = -1.0
+            k = min(top_k, self._size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                {
+                    'message_id': int(self._ids[i, 0]),
+                    'session_id': int(self._ids[i, 1]),
+                    'score': float(scores[i])
+                }
+                for i in top if scores[i] > 0
+            ]
+
+
+def build_memory_context(index: MemoryIndex, query: str, session_id: int,
+                         top_k: int = 5, token_budget: int = 800) -> str:
+    """
+    检索其他会话中与当前问题相关的历史片段，并在token预算内拼接为提示词片段
+
+    Args:
+        index: 向量索引
+        query: 当前用户问题
+        session_id: 当前会话ID（排除在检索范围外）
+        top_k: 最多注入的片段数量
+        token_budget: 注入内容的token预算
+
+    Returns:
+        提示词片段，没有足够相关的历史时返回空字符串
+    """
+    # 多取一些候选，过滤掉已删除的消息和低相似度结果后再截取
+    hits = [hit for hit in index.search(query, top_k * 3, exclude_session_id=session_id) if hit['score'] >= MIN_SIMILARITY]
+    if not hits:
+        return ""
+
+    messages = db_utils.get_messages_by_ids([hit['message_id'] for hit in hits])
+
+    snippets = []
+    remaining = token_budget
+    for hit in hits:
+        message = messages.get(hit['message_id'])
+        # 旧版本写入的索引文件中可能有工具结果
+        if message is None or not should_index(message['content']):
+            continue
+        header = f"[{message['session_name'] or message['session_id']} | {message['timestamp']} | {message['role']}] "
+        content = message['content']
+        # 超出剩余预算的片段按比例截断
+        allowed = remaining - estimate_tokens(header)
+        if allowed <= 0:
+            break
+        if estimate_tokens(content) > allowed:
+            content = content[:max(allowed, 0)] + "..."
+        snippet = header + content
+        snippets.append(snippet)
+        remaining -= estimate_tokens(snippet)
+        if len(snippets) >= top_k or remaining <= 0:
+            break
+
+    if not snippets:
+        return ""
+    return "以下是与当前问题相关的其他会话中的历史片段，仅在有帮助时参考:\n" + "\n".join(snippets)
+
+
+# 全局向量索引实例
+memory_index = MemoryIndex()
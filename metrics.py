@@ -0,0 +1,280 @@
+"""
+运行指标模块
+提供计数器、仪表和直方图，按Prometheus文本格式输出，由/metrics接口暴露。
+覆盖首token延迟、生成速度、整轮耗时、LLM请求状态、工具调用、MCP服务器可用性、数据库操作、WebSocket连接、排队深度和事件循环延迟
+"""
+
+import time
+import functools
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# 延迟类直方图的默认分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_INF_LABEL = 'le="+Inf"'
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """
+    指标基类，按标签值分别记录
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        """
+        输出Prometheus文本格式的行
+
+        Returns:
+            文本行列表
+        """
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """
+    只增不减的计数器
+    """
+
+    type_name = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, description, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """
+        增加计数
+
+        Args:
+            amount: 增加量
+            **labels: 标签值
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """
+    可增可减的仪表，也可以在输出时通过回调函数取值
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None):
+        """
+        初始化仪表
+
+        Args:
+            name: 指标名称
+            description: 说明
+            labelnames: 标签名称
+            function: 输出时调用以获取当前值的函数（仅用于无标签的仪表）
+        """
+        super().__init__(name, description, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function = function
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def _render_samples(self) -> List[str]:
+        if self._function is not None:
+            try:
+                return [f"{self.name} {_format_value(self._function())}"]
+            except Exception as e:
+                print(f"获取指标 {self.name} 时出错: {str(e)}")
+                return []
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """
+    直方图，记录观测值的分布
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各分桶计数, 总和, 观测次数]
+        self._values: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        记录一个观测值
+
+        Args:
+            value: 观测值
+            **labels: 标签值
+        """
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        lines = []
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, _INF_LABEL)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    指标注册表
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        """
+        注册指标
+
+        Args:
+            metric: 指标
+
+        Returns:
+            传入的指标
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        按Prometheus文本格式输出所有指标
+
+        Returns:
+            指标文本
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def timed(histogram: Histogram, **labels: str):
+    """
+    记录函数执行耗时的装饰器
+
+    Args:
+        histogram: 记录耗时的直方图
+        **labels: 标签值
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+# 创建全局指标注册表及各项指标
+metrics_registry = MetricsRegistry()
+
+llm_time_to_first_token = metrics_registry.register(Histogram(
+    "llm_time_to_first_token_seconds", "LLM请求从发出到收到首个文本块的时间", ["endpoint"]))
+llm_tokens_per_second = metrics_registry.register(Histogram(
+    "llm_tokens_per_second", "首token之后的生成速度（token/秒）", ["endpoint"],
+    buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)))
+llm_requests = metrics_registry.register(Counter(
+    "llm_requests_total", "LLM请求数，按HTTP状态码或错误类型区分", ["endpoint", "status"]))
+chat_turn_duration = metrics_registry.register(Histogram(
+    "chat_turn_duration_seconds", "一轮对话（含工具调用和后续LLM调用）的总耗时", ["outcome"]))
+tool_call_duration = metrics_registry.register(Histogram(
+    "mcp_tool_call_duration_seconds", "MCP工具调用耗时", ["server", "tool"]))
+tool_call_errors = metrics_registry.register(Counter(
+    "mcp_tool_call_errors_total", "MCP工具调用失败次数", ["server", "tool"]))
+db_operation_duration = metrics_registry.register(Histogram(
+    "db_operation_duration_seconds", "数据库操作耗时", ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)))
+active_websockets = metrics_registry.register(Gauge(
+    "websocket_connections", "当前打开的WebSocket连接数"))
+event_loop_lag = metrics_registry.register(Histogram(
+    "event_loop_lag_seconds", "事件循环心跳的延迟（实际等待时间超出预期的部分）",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)))
+event_loop_stalls = metrics_registry.register(Counter(
+    "event_loop_stalls_total", "事件循环阻塞超过阈值的次数"))
+mcp_server_up = metrics_registry.register(Gauge(
+    "mcp_server_up", "MCP服务器是否可用（1可用，0掉线或熔断）", ["server"]))
+mcp_server_reconnects = metrics_registry.register(Counter(
+    "mcp_server_reconnects_total", "MCP服务器重连次数", ["server", "outcome"]))
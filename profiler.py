@@ -0,0 +1,312 @@
+"""
+运行时性能分析模块
+无需重启服务即可在运行中的进程上开启性能分析，持续指定的时间或接下来的若干轮对话后自动停止，结果保存在内存中供查看。
+支持三种方式：
+- sample: 采样分析，后台线程定期读取事件循环线程的调用栈，开销低，可生成火焰图使用的折叠栈
+- cprofile: 标准库的确定性分析，记录事件循环线程中每个函数的调用次数和耗时，开销较高
+- yappi: 安装了yappi时可用，按协程统计墙钟时间
+"""
+
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from typing import Dict, Any, Optional
+
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+# 采样分析的采样间隔（秒）
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+# 单次分析的最长时间（秒），按轮数分析时也以此为上限，避免忘记停止
+PROFILE_MAX_DURATION = float(os.getenv("PROFILE_MAX_DURATION", "600"))
+
+# 结果摘要中列出的函数数
+PROFILE_TOP_FUNCTIONS = 50
+
+PROFILE_MODES = ("sample", "cprofile", "yappi")
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _SamplingBackend:
+    """
+    采样分析：后台线程定期读取目标线程的调用栈并按完整调用栈计数
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def result(self) -> Dict[str, Any]:
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            # 递归调用在同一个栈中只计一次
+            for label in set(stack):
+                total[label] += count
+        samples = self.samples or 1
+        functions = [{
+            "function": label,
+            "self_samples": own[label],
+            "total_samples": count,
+            "self_percent": round(own[label] / samples * 100, 2),
+            "total_percent": round(count / samples * 100, 2)
+        } for label, count in total.most_common()]
+        functions.sort(key=lambda item: item["self_samples"], reverse=True)
+        return {"samples": self.samples, "interval": self.interval, "functions": functions[:PROFILE_TOP_FUNCTIONS]}
+
+    def text(self) -> str:
+        # 折叠栈格式，可直接用flamegraph.pl或speedscope生成火焰图
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+
+class _CProfileBackend:
+    """
+    cProfile确定性分析，只记录调用start的线程（即事件循环线程）
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self) -> None:
+        self.profile.enable()
+
+    def stop(self) -> None:
+        self.profile.disable()
+
+    def result(self) -> Dict[str, Any]:
+        stats = pstats.Stats(self.profile)
+        functions = []
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            functions.append({
+                "function": f"{name} ({os.path.basename(filename)}:{line})",
+                "calls": calls,
+                "tottime": round(tottime, 6),
+                "cumtime": round(cumtime, 6)
+            })
+        functions.sort(key=lambda item: item["cumtime"], reverse=True)
+        return {"total_calls": stats.total_calls, "functions": functions[:PROFILE_TOP_FUNCTIONS]}
+
+    def text(self) -> str:
+        output = io.StringIO()
+        pstats.Stats(self.profile, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS * 2)
+        return output.getvalue()
+
+
+class _YappiBackend:
+    """
+    yappi分析，使用墙钟时间，协程在等待期间的时间也计入
+    """
+
+    def start(self) -> None:
+        yappi.clear_stats()
+        yappi.set_clock_type("wall")
+        yappi.start()
+
+    def stop(self) -> None:
+        yappi.stop()
+        self._stats = yappi.get_func_stats()
+
+    def result(self) -> Dict[str, Any]:
+        self._stats.sort("ttot", "desc")
+        functions = [{
+            "function": f"{stat.name} ({os.path.basename(stat.module)}:{stat.lineno})",
+            "calls": stat.ncall,
+            "tottime": round(stat.tsub, 6),
+            "cumtime": round(stat.ttot, 6)
+        } for stat in list(self._stats)[:PROFILE_TOP_FUNCTIONS]]
+        return {"functions": functions}
+
+    def text(self) -> str:
+        output = io.StringIO()
+        self._stats.sort("ttot", "desc")
+        self._stats.print_all(out=output)
+        return output.getvalue()
+
+
+class RuntimeProfiler:
+    """
+    运行时性能分析器，同一时间只进行一次分析，只保留最近一次的结果。
+    start、stop和turn_finished都应在事件循环线程中调用（cProfile只记录调用它的线程）
+    """
+
+    def __init__(self, sample_interval: float = PROFILE_SAMPLE_INTERVAL, max_duration: float = PROFILE_MAX_DURATION):
+        """
+        初始化分析器
+
+        Args:
+            sample_interval: 采样分析的采样间隔（秒）
+            max_duration: 单次分析的最长时间（秒）
+        """
+        self.sample_interval = sample_interval
+        self.max_duration = max_duration
+        self._backend = None
+        self._session: Optional[Dict[str, Any]] = None
+        self._timer = None
+        self._last: Optional[Dict[str, Any]] = None
+        self._last_backend = None
+
+    @property
+    def running(self) -> bool:
+        return self._backend is not None
+
+    def start(self, loop, mode: str = "sample", duration: Optional[float] = None, turns: Optional[int] = None) -> Dict[str, Any]:
+        """
+        开始分析
+
+        Args:
+            loop: 事件循环，用于定时停止
+            mode: 分析方式，sample、cprofile或yappi
+            duration: 持续时间（秒）
+            turns: 分析接下来的轮数，达到后停止；与duration同时指定时先满足者生效
+
+        Returns:
+            当前分析的状态
+
+        Raises:
+            ValueError: 参数无效
+            RuntimeError: 已有分析正在进行
+        """
+        if self.running:
+            raise RuntimeError("已有性能分析正在进行")
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"不支持的分析方式: {mode}，可选 {', '.join(PROFILE_MODES)}")
+        if mode == "yappi" and yappi is None:
+            raise ValueError("未安装yappi，请使用sample或cprofile")
+        if turns is not None and turns <= 0:
+            raise ValueError("轮数必须大于0")
+        if duration is None and turns is None:
+            duration = 30.0
+        if duration is not None and duration <= 0:
+            raise ValueError("持续时间必须大于0")
+        duration = min(duration if duration is not None else self.max_duration, self.max_duration)
+
+        if mode == "sample":
+            backend = _SamplingBackend(threading.get_ident(), self.sample_interval)
+        elif mode == "cprofile":
+            backend = _CProfileBackend()
+        else:
+            backend = _YappiBackend()
+        try:
+            backend.start()
+        except ValueError as e:
+            # 另一个分析器（如调试器或已启用的cProfile）占用了性能分析钩子
+            raise RuntimeError(f"无法开始性能分析: {str(e)}")
+
+        self._backend = backend
+        self._session = {
+            "mode": mode,
+            "started_at": time.time(),
+            "duration": duration,
+            "turns": turns,
+            "turns_seen": 0
+        }
+        self._timer = loop.call_later(duration, self.stop)
+        print(f"开始性能分析: {mode}，最长 {duration:g} 秒" + (f"，{turns} 轮对话" if turns else ""))
+        return self.get_status()
+
+    def stop(self) -> Optional[Dict[str, Any]]:
+        """
+        停止分析并保存结果
+
+        Returns:
+            结果摘要，没有正在进行的分析时返回None
+        """
+        if not self.running:
+            return None
+        backend, session = self._backend, self._session
+        self._backend = self._session = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        backend.stop()
+        session["ended_at"] = time.time()
+        session["elapsed"] = round(session["ended_at"] - session["started_at"], 3)
+        session.update(backend.result())
+        self._last = session
+        self._last_backend = backend
+        print(f"性能分析结束: {session['mode']}，用时 {session['elapsed']:.1f} 秒，{session['turns_seen']} 轮对话")
+        return session
+
+    def turn_finished(self) -> None:
+        """
+        一轮对话结束时调用，按轮数分析时达到轮数后停止
+        """
+        session = self._session
+        if session is None:
+            return
+        session["turns_seen"] += 1
+        if session["turns"] is not None and session["turns_seen"] >= session["turns"]:
+            self.stop()
+
+    def get_status(self) -> Dict[str, Any]:
+        """
+        获取分析状态
+
+        Returns:
+            是否正在分析、当前分析的参数和可用的分析方式
+        """
+        return {
+            "running": self.running,
+            "current": dict(self._session) if self._session else None,
+            "modes": [mode for mode in PROFILE_MODES if mode != "yappi" or yappi is not None]
+        }
+
+    def get_result(self) -> Optional[Dict[str, Any]]:
+        """
+        获取最近一次分析的结果摘要
+
+        Returns:
+            结果摘要，没有结果时返回None
+        """
+        return self._last
+
+    def get_text(self) -> Optional[str]:
+        """
+        获取最近一次分析的文本结果：采样分析为折叠栈，其他方式为按累计时间排序的统计表
+
+        Returns:
+            文本结果，没有结果时返回None
+        """
+        if self._last_backend is None:
+            return None
+        return self._last_backend.text()
+
+
+# 创建全局分析器实例
+runtime_profiler = RuntimeProfiler()
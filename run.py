@@ -9,6 +9,7 @@ import sys
 from dotenv import load_dotenv
 
 from mcp_client import mcp_llm_client
+from stream_events import event_to_text
 
 # 加载环境变量
 load_dotenv()
@@ -122,8 +123,9 @@ async def chat_loop():
 
             # 处理用户消息
             print("\n助手: ", end="", flush=True)
-            response = await mcp_llm_client.process_message(user_input)
-            print(response)
+            async for event in mcp_llm_client.process_message(user_input):
+                print(event_to_text(event), end="", flush=True)
+            print()
 
         except KeyboardInterrupt:
             break
@@ -0,0 +1,55 @@
+"""
+生产环境入口，使用Hypercorn以多个工作进程运行网页应用
+
+每个工作进程各自导入app.py，拥有独立的事件循环和MCP连接；会话的对话历史、当前会话和LLM参数保存在数据库中，
+补全缓存和跨会话记忆索引的文件由各进程共享，同一会话的对话轮次通过锁文件在进程之间串行执行（见session_lock模块），
+因此请求可以落到任意一个工作进程。断线续传只能在生成回复的进程上恢复，而工作进程共用监听端口，需要可靠的断线续传时
+以WEB_WORKERS=1在不同端口上启动多个实例，由负载均衡器按client_key做会话保持。
+
+用法:
+    python serve.py
+    WEB_WORKERS=4 WEB_BIND=0.0.0.0:8000 python serve.py
+"""
+
+import os
+import sys
+
+from dotenv import load_dotenv
+from hypercorn.config import Config
+from hypercorn.run import run
+
+# 加载环境变量
+load_dotenv()
+
+# 监听地址
+WEB_BIND = os.getenv("WEB_BIND", "127.0.0.1:5000")
+
+# 工作进程数，默认与CPU核数相同
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", str(os.cpu_count() or 1)))
+
+# 关闭时等待进行中请求的时间（秒）
+WEB_GRACEFUL_TIMEOUT = float(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+
+
+def main() -> int:
+    """
+    启动工作进程并等待其退出
+
+    Returns:
+        退出状态
+    """
+    # 在启动工作进程前完成数据库的创建和迁移，避免多个进程同时修改表结构
+    import db_utils  # noqa: F401
+
+    config = Config()
+    config.application_path = "app:app"
+    config.bind = [WEB_BIND]
+    config.workers = WEB_WORKERS
+    config.graceful_timeout = WEB_GRACEFUL_TIMEOUT
+    config.accesslog = "-" if os.getenv("WEB_ACCESS_LOG", "false").lower() == "true" else None
+    print(f"在 {WEB_BIND} 上启动 {WEB_WORKERS} 个工作进程")
+    return run(config)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
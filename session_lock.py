@@ -0,0 +1,85 @@
+"""
+会话锁模块
+同一会话的对话轮次在所有工作进程之间串行执行：进程内用asyncio锁排队，
+进程之间用每个会话一个的锁文件（fcntl.flock）互斥。文件锁以非阻塞方式尝试，
+未获得时在事件循环中等待一段时间后重试，不阻塞其他请求
+"""
+
+import os
+import asyncio
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 会话锁被其他进程持有时重试的间隔（秒）
+SESSION_LOCK_POLL_INTERVAL = float(os.getenv("SESSION_LOCK_POLL_INTERVAL", "0.05"))
+
+
+class SessionLock:
+    """
+    跨进程的会话锁，接口与asyncio.Lock相同（acquire/release/locked）
+    不支持fcntl的平台上只在进程内互斥
+    """
+
+    def __init__(self, session_id: int, lock_dir: str):
+        """
+        初始化会话锁
+
+        Args:
+            session_id: 会话ID
+            lock_dir: 锁文件所在目录
+        """
+        self.session_id = session_id
+        self.path = os.path.join(lock_dir, f"{session_id}.lock")
+        self._lock = asyncio.Lock()
+        self._file = None
+
+    def locked(self) -> bool:
+        """
+        本进程是否持有或正在等待该会话的锁
+        """
+        return self._lock.locked()
+
+    async def acquire(self) -> bool:
+        """
+        获取会话锁，先在进程内排队，再等待其他进程释放锁文件
+
+        Returns:
+            True
+        """
+        await self._lock.acquire()
+        if fcntl is None:
+            return True
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._file = open(self.path, 'a')
+            while not self._try_lock_file():
+                await asyncio.sleep(SESSION_LOCK_POLL_INTERVAL)
+        except BaseException:
+            # 等待期间被取消或出错时不保留进程内的锁
+            self._close_file()
+            self._lock.release()
+            raise
+        return True
+
+    def release(self) -> None:
+        """
+        释放会话锁
+        """
+        self._close_file()
+        self._lock.release()
+
+    def _try_lock_file(self) -> bool:
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _close_file(self) -> None:
+        # 关闭文件即释放文件锁
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,133 @@
+"""
+SSE解码模块
+增量解析服务端推送事件（Server-Sent Events）流：正确处理跨读取边界的不完整行、CRLF换行和多行data字段，
+JSON解析在安装了orjson时使用orjson，并直接从字节解析，不做额外的解码和字符串复制
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+_json_decoder = json.JSONDecoder()
+
+
+def _stdlib_json_loads(data: bytes) -> Any:
+    # 直接使用解码器，跳过json.loads对字节输入的编码检测
+    return _json_decoder.decode(data.decode("utf-8"))
+
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    json_loads = _stdlib_json_loads
+    JSON_BACKEND = "json"
+
+# 流结束标记
+DONE_MARKERS = (b"[DONE]", b"[ERROR]")
+
+
+class SSEDecoder:
+    """
+    增量SSE解码器，输入任意切分的字节块，输出完整事件的data内容
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._data: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """
+        输入一个字节块
+
+        Args:
+            chunk: 从网络读取的字节块，可以在任意位置切分
+
+        Returns:
+            本次解析出的完整事件的data内容列表
+        """
+        if self._buffer:
+            chunk = self._buffer + chunk
+        lines = chunk.split(b"\n")
+        self._buffer = lines.pop()
+        return self._process_lines(lines)
+
+    def flush(self) -> List[bytes]:
+        """
+        流结束时输出缓冲区中剩余的事件（最后一个事件后可能没有空行）
+
+        Returns:
+            事件data内容列表
+        """
+        lines = [self._buffer, b""] if self._buffer else [b""]
+        self._buffer = b""
+        return self._process_lines(lines)
+
+    def _process_lines(self, lines: List[bytes]) -> List[bytes]:
+        events: List[bytes] = []
+        data = self._data
+        for line in lines:
+            if line.endswith(b"\r"):
+                line = line[:-1]
+
+            if not line:
+                # 空行：事件结束
+                if data:
+                    events.append(data[0] if len(data) == 1 else b"\n".join(data))
+                    data.clear()
+            elif line.startswith(b"data:"):
+                data.append(line[6:] if line.startswith(b"data: ") else line[5:])
+            elif line.startswith(b"{"):
+                # 兼容不带data:前缀、每行一个JSON对象的流
+                events.append(line)
+            # 注释（以冒号开头）以及event、id、retry等字段不影响data内容，忽略
+        return events
+
+
+def parse_event(data: bytes) -> List[Any]:
+    """
+    解析事件的JSON内容
+
+    多行data通常是一个跨行的JSON对象；不符合规范、用单个换行分隔多个JSON对象的流则逐行解析。
+    非JSON内容（例如keep-alive消息）被忽略
+
+    Args:
+        data: 事件的data内容
+
+    Returns:
+        解析出的对象列表
+    """
+    try:
+        return [json_loads(data)]
+    except ValueError:
+        if b"\n" not in data:
+            return []
+
+    objects = []
+    for line in data.split(b"\n"):
+        try:
+            objects.append(json_loads(line))
+        except ValueError:
+            pass
+    return objects
+
+
+def extract_delta(chunk: Dict[str, Any]) -> Tuple[Optional[str], Optional[List[Dict[str, Any]]], Optional[Dict[str, Any]]]:
+    """
+    从OpenAI兼容的流式响应块中提取增量
+
+    Args:
+        chunk: 解析后的响应块
+
+    Returns:
+        (文本增量, 工具调用增量, token用量)，不存在的项为None
+    """
+    content = None
+    tool_calls = None
+    choices = chunk.get("choices")
+    if choices:
+        delta = choices[0].get("delta")
+        if delta:
+            content = delta.get("content")
+            tool_calls = delta.get("tool_calls")
+    return content, tool_calls, chunk.get("usage")
@@ -3,6 +3,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const chatMessages = document.getElementById('chat-messages');
     const userInput = document.getElementById('user-input');
     const sendButton = document.getElementById('send-btn');
+    const stopButton = document.getElementById('stop-btn');
     const clearButton = document.getElementById('clear-btn');
     const toolsList = document.getElementById('tools-list');
     const refreshToolsButton = document.getElementById('refresh-tools-btn');
@@ -45,6 +46,29 @@ document.addEventListener('DOMContentLoaded', function() {
     let ws = null;
     let isConnecting = false;
 
+    // 进行中的请求: 请求ID -> {onEvent, onClose, lastSeq}
+    const pendingRequests = new Map();
+    let nextRequestId = 1;
+
+    // 请求ID前缀，保证重连后请求ID在服务器上仍然唯一
+    const clientId = Math.random().toString(36).slice(2, 10);
+
+    // 客户端密钥，服务器只接受同一密钥对请求的恢复和停止
+    const clientKey = Array.from(crypto.getRandomValues(new Uint8Array(16)),
+        b => b.toString(16).padStart(2, '0')).join('');
+
+    // 断线重连设置，重连后从最后收到的序号继续接收进行中的请求
+    const WS_MAX_RECONNECT_ATTEMPTS = 5;
+    const WS_RECONNECT_DELAY = 1000;
+    let reconnectAttempts = 0;
+
+    // 当前正在生成的请求ID，用于停止生成
+    let activeRequestId = null;
+
+    // 心跳定时器，定期发送ping保持连接
+    const WS_PING_INTERVAL = 25000;
+    let pingTimer = null;
+
     // 检查用户偏好的主题
     const prefersDarkScheme = window.matchMedia('(prefers-color-scheme: dark)');
 
@@ -146,7 +170,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
         // 创建WebSocket连接
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/api/ws`;
+        const wsUrl = `${protocol}//${window.location.host}/api/ws?client_key=${clientKey}`;
 
         console.log("创建WebSocket连接:", wsUrl);
         ws = new WebSocket(wsUrl);
@@ -155,6 +179,47 @@ document.addEventListener('DOMContentLoaded', function() {
         ws.onopen = function() {
             console.log("WebSocket连接已建立");
             isConnecting = false;
+            reconnectAttempts = 0;
+
+            // 恢复断线前进行中的请求
+            pendingRequests.forEach((pending, requestId) => {
+                ws.send(JSON.stringify({ type: 'resume', id: requestId, last_seq: pending.lastSeq }));
+            });
+
+            pingTimer = setInterval(() => {
+                if (ws !== null && ws.readyState === WebSocket.OPEN) {
+                    ws.send(JSON.stringify({ type: 'ping' }));
+                }
+            }, WS_PING_INTERVAL);
+        };
+
+        // 按请求ID分发服务器事件
+        ws.onmessage = function(event) {
+            const streamEvent = JSON.parse(event.data);
+
+            // 心跳帧
+            if (streamEvent.type === 'heartbeat' || streamEvent.type === 'pong') {
+                return;
+            }
+
+            const pending = pendingRequests.get(streamEvent.id);
+            if (!pending) {
+                console.warn("收到未知请求的事件:", streamEvent);
+                return;
+            }
+
+            // 重连后补发的事件可能已经收到过
+            if (streamEvent.seq !== undefined) {
+                if (streamEvent.seq <= pending.lastSeq) {
+                    return;
+                }
+                pending.lastSeq = streamEvent.seq;
+            }
+
+            if (streamEvent.type === 'done') {
+                pendingRequests.delete(streamEvent.id);
+            }
+            pending.onEvent(streamEvent);
         };
 
         // 连接关闭时的处理
@@ -162,6 +227,25 @@ document.addEventListener('DOMContentLoaded', function() {
             console.log("WebSocket连接已关闭");
             ws = null;
             isConnecting = false;
+
+            if (pingTimer !== null) {
+                clearInterval(pingTimer);
+                pingTimer = null;
+            }
+
+            // 有进行中的请求时尝试重连，服务器会在等待时间内保留生成的输出
+            if (pendingRequests.size > 0 && reconnectAttempts < WS_MAX_RECONNECT_ATTEMPTS) {
+                reconnectAttempts++;
+                console.log(`${reconnectAttempts * WS_RECONNECT_DELAY}毫秒后重连`);
+                setTimeout(createWebSocketConnection, reconnectAttempts * WS_RECONNECT_DELAY);
+                return;
+            }
+            reconnectAttempts = 0;
+
+            // 无法重连时结束所有进行中的请求
+            const requests = Array.from(pendingRequests.values());
+            pendingRequests.clear();
+            requests.forEach(pending => pending.onClose());
         };
 
         // 连接错误时的处理
@@ -194,6 +278,32 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // 在WebSocket连接上发起一个请求，返回请求ID
+    function sendWebSocketRequest(payload, onEvent, onClose) {
+        const requestId = `${clientId}-${nextRequestId++}`;
+        pendingRequests.set(requestId, { onEvent: onEvent, onClose: onClose, lastSeq: 0 });
+        ws.send(JSON.stringify(Object.assign({ id: requestId }, payload)));
+        return requestId;
+    }
+
+    // 显示或隐藏停止按钮
+    function setStopButtonVisible(visible) {
+        stopButton.style.display = visible ? 'flex' : 'none';
+        stopButton.disabled = false;
+        if (!visible) {
+            activeRequestId = null;
+        }
+    }
+
+    // 停止当前生成，服务器会中止上游请求并保存已生成的部分回复
+    function stopGeneration() {
+        if (activeRequestId === null || ws === null || ws.readyState !== WebSocket.OPEN) {
+            return;
+        }
+        ws.send(JSON.stringify({ type: 'stop', id: activeRequestId }));
+        stopButton.disabled = true;
+    }
+
     // 获取会话列表
     function fetchSessions() {
         sessionsList.innerHTML = '<div class="loading-sessions"><i class="fas fa-spinner fa-spin"></i> 加载中...</div>';
@@ -289,6 +399,11 @@ document.addEventListener('DOMContentLoaded', function() {
         });
 
         sessionInfo.innerHTML = `<i class="fas fa-message"></i> ${session.message_count || 0} · <i class="fas fa-clock"></i> ${formattedDate}`;
+        const totalTokens = (session.prompt_tokens || 0) + (session.completion_tokens || 0);
+        if (totalTokens > 0) {
+            sessionInfo.innerHTML += ` · <i class="fas fa-coins"></i> ${totalTokens.toLocaleString()}`;
+            sessionInfo.title = `提示词 ${session.prompt_tokens} / 生成 ${session.completion_tokens} token，单次最大提示词 ${session.max_prompt_tokens} token`;
+        }
 
         const sessionActions = document.createElement('div');
         sessionActions.className = 'session-actions';
@@ -726,6 +841,75 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    // --- 流式事件处理：服务器已完成标签解析，按事件类型直接路由内容 ---
+    function openStreamSection(tagKey) {
+        const tagInfo = tagConfig[tagKey];
+        activeCollapsibleSectionContent = createCollapsibleSection(
+            mainContentContainer,
+            tagInfo.className,
+            tagInfo.summaryText
+        );
+        activeCollapsibleTagKey = tagKey;
+    }
+
+    function closeStreamSection() {
+        if (activeCollapsibleSectionContent) {
+            // 在关闭折叠框时对其内容进行 Markdown 解析
+            activeCollapsibleSectionContent.innerHTML = marked.parse(activeCollapsibleSectionContent.innerHTML);
+        }
+        activeCollapsibleSectionContent = null;
+        activeCollapsibleTagKey = null;
+    }
+
+    function appendStreamDelta(streamEvent) {
+        appendTextToContainer(activeCollapsibleSectionContent || mainContentContainer, streamEvent.delta);
+    }
+
+    const streamEventHandlers = {
+        "text": function(streamEvent) {
+            appendTextToContainer(mainContentContainer, streamEvent.delta);
+        },
+        "think_start": function() { openStreamSection('think'); },
+        "think_delta": appendStreamDelta,
+        "think_end": closeStreamSection,
+        "tool_call_start": function() { openStreamSection('tool'); },
+        "tool_call_delta": appendStreamDelta,
+        "tool_call_end": closeStreamSection,
+        "tool_result": function(streamEvent) {
+            const payload = { name: streamEvent.name };
+            if (streamEvent.error !== undefined) {
+                payload.error = streamEvent.error;
+            } else {
+                payload.result = streamEvent.result;
+            }
+            openStreamSection('tool_result');
+            appendTextToContainer(activeCollapsibleSectionContent, JSON.stringify(payload, null, 2));
+            closeStreamSection();
+        },
+        "usage": function(streamEvent) {
+            console.log("token用量:", streamEvent);
+        },
+        "error": function(streamEvent) {
+            closeStreamSection();
+            if (streamEvent.fatal) {
+                addMessage('system', `<i class="fas fa-exclamation-circle"></i> 错误: ${streamEvent.message}`);
+            } else {
+                // 非致命错误显示在当前回复中，回复会继续
+                const errorContent = createCollapsibleSection(mainContentContainer, 'think', '⚠️ 内部错误');
+                appendTextToContainer(errorContent, streamEvent.message);
+            }
+        }
+    };
+
+    function handleStreamEvent(streamEvent) {
+        const handler = streamEventHandlers[streamEvent.type];
+        if (handler) {
+            handler(streamEvent);
+        } else {
+            console.warn("未知的流式事件:", streamEvent);
+        }
+    }
+
     // 发送消息
     async function sendMessage() {
         const message = userInput.value.trim();
@@ -766,14 +950,8 @@ document.addEventListener('DOMContentLoaded', function() {
             // 确保WebSocket连接已建立
             await ensureWebSocketConnection();
 
-            // 发送消息，包含会话ID
-            ws.send(JSON.stringify({
-                message: message,
-                session_id: currentSessionId
-            }));
-
-            // 处理接收到的消息
-            ws.onmessage = function(event) {
+            // 处理接收到的事件
+            const onEvent = function(streamEvent) {
                 // 如果已经完成，忽略后续消息
                 if (isCompleted) {
                     return;
@@ -784,17 +962,14 @@ document.addEventListener('DOMContentLoaded', function() {
                     loadingElement.remove();
                 }
 
-                const data = event.data;
+                // 本轮结束
+                if (streamEvent.type === "done") {
+                    closeStreamSection();
+                    setStopButtonVisible(false);
 
-                // 处理特殊消息
-                if (data === "[DONE]") {
-					if (streamBuffer.length > 0) {
-						const target = activeCollapsibleSectionContent || mainContentContainer;
-						if (target) {
-							appendTextToContainer(target, streamBuffer);
-						}
-						streamBuffer = "";
-					}
+                    if (streamEvent.cancelled) {
+                        addMessage('system', '<i class="fas fa-stop-circle"></i> 已停止生成');
+                    }
 
                     isCompleted = true;
                     scrollToBottom();
@@ -806,25 +981,10 @@ document.addEventListener('DOMContentLoaded', function() {
                     return;
                 }
 
-                if (data.startsWith("[ERROR]")) {
-					// 同样，处理缓冲区中可能存在的未完成文本
-					if (streamBuffer.length > 0) {
-						const target = activeCollapsibleSectionContent || mainContentContainer;
-						if (target) appendTextToContainer(target, streamBuffer);
-						streamBuffer = "";
-					}
-					activeCollapsibleSectionContent = null; // 清理状态
-					activeCollapsibleTagKey = null;
-
-                    const errorMessage = data.substring("[ERROR]".length).trim();
-                    addMessage('system', `<i class="fas fa-exclamation-circle"></i> 错误: ${errorMessage}`);
-                    isCompleted = true;
+                // 尚未开始回复时出错，只显示错误消息
+                if (streamEvent.type === "error" && !assistantMessageDiv) {
+                    addMessage('system', `<i class="fas fa-exclamation-circle"></i> 错误: ${streamEvent.message}`);
                     scrollToBottom();
-
-                    // 恢复发送按钮状态
-                    sendButton.disabled = false;
-                    sendButton.innerHTML = '<i class="fas fa-paper-plane"></i> 发送';
-                    userInput.disabled = false;
                     return;
                 }
 
@@ -841,29 +1001,22 @@ document.addEventListener('DOMContentLoaded', function() {
 					chatMessages.appendChild(assistantMessageDiv);
 
 					mainContentContainer = newContentDiv; // 设置主内容容器
-					// currentContainer = contentDiv; // 原来的逻辑，现在由 mainContentContainer 替代
+					activeCollapsibleSectionContent = null;
+					activeCollapsibleTagKey = null;
 					scrollToBottom();
                 }
 
-                // 处理流式输出
-                // 将新数据追加到缓冲区并处理
-				streamBuffer += data;
-				processStreamBuffer(); // 处理累积的缓冲区内容
-
-				// currentAssistantMessage += data; // 可以保留这个变量，如果需要完整的原始消息字符串
-
+                // 按事件类型处理流式输出
+                handleStreamEvent(streamEvent);
 
                 if (isAtBottom()) {
                     scrollToBottom();
                 }
             };
 
-            // 处理WebSocket错误
-            const originalOnError = ws.onerror;
-            ws.onerror = function(error) {
-                console.error("WebSocket错误:", error);
-
-                // 如果已经完成，忽略错误
+            // 连接断开时结束本次请求
+            const onClose = function() {
+                // 如果已经完成，忽略
                 if (isCompleted) {
                     return;
                 }
@@ -874,21 +1027,27 @@ document.addEventListener('DOMContentLoaded', function() {
                 }
 
                 // 显示错误消息
-                addMessage('system', '<i class="fas fa-exclamation-triangle"></i> 与服务器的连接发生错误，请稍后再试。');
+                addMessage('system', '<i class="fas fa-exclamation-triangle"></i> 与服务器的连接已断开，请稍后再试。');
                 scrollToBottom();
+                setStopButtonVisible(false);
 
                 // 恢复发送按钮状态
                 sendButton.disabled = false;
                 sendButton.innerHTML = '<i class="fas fa-paper-plane"></i> 发送';
                 userInput.disabled = false;
 
-                // 恢复原始的onerror处理函数
-                ws.onerror = originalOnError;
-
                 // 标记为已完成
                 isCompleted = true;
             };
 
+            // 发送消息，包含会话ID
+            activeRequestId = sendWebSocketRequest({
+                type: 'chat',
+                message: message,
+                session_id: currentSessionId
+            }, onEvent, onClose);
+            setStopButtonVisible(true);
+
         } catch (error) {
             console.error("发送消息时出错:", error);
 
@@ -1166,6 +1325,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // 事件监听器
     sendButton.addEventListener('click', sendMessage);
+    stopButton.addEventListener('click', stopGeneration);
 
     userInput.addEventListener('keydown', function(event) {
         // 按下Enter发送消息
@@ -0,0 +1,198 @@
+"""
+可恢复流模块
+每个进行中的生成在服务器端保存在有界环形缓冲区中，事件带有递增的序号；
+WebSocket断开后生成继续进行，客户端重连后可从最后收到的序号继续接收，无需重新请求模型
+"""
+
+import os
+import hmac
+import asyncio
+from collections import deque
+from typing import Dict, Any, Optional
+
+from cancellation import CancellationToken
+from stream_events import EVENT_DONE
+
+# 每个流在缓冲区中保留的事件数
+STREAM_BUFFER_EVENTS = int(os.getenv("STREAM_BUFFER_EVENTS", "2048"))
+
+# 客户端断开后等待重连的时间（秒），超时仍未恢复则停止生成
+STREAM_RESUME_GRACE_SECONDS = float(os.getenv("STREAM_RESUME_GRACE_SECONDS", "30"))
+
+# 生成结束后流继续保留的时间（秒），供断线的客户端取回剩余事件
+STREAM_RETENTION_SECONDS = float(os.getenv("STREAM_RETENTION_SECONDS", "60"))
+
+
+class ResumableStream:
+    """
+    一次生成的事件流
+
+    事件写入环形缓冲区并转发给当前连接的订阅队列；同一时刻最多一个订阅者，
+    新的订阅者接入时旧的订阅者被关闭
+    """
+
+    def __init__(self, stream_id: str, cancel_token: CancellationToken, owner: str = "",
+                 capacity: int = STREAM_BUFFER_EVENTS):
+        """
+        初始化流
+
+        Args:
+            stream_id: 流ID（即客户端的请求ID）
+            cancel_token: 该生成的取消令牌
+            owner: 发起请求的客户端密钥，只有同一客户端可以恢复或停止该流
+            capacity: 缓冲区保留的事件数
+        """
+        self.stream_id = stream_id
+        self.cancel_token = cancel_token
+        self.owner = owner
+        self.finished = False
+        self.generation = 0  # 订阅者接入次数，用于判断断开后是否已重新接入
+        self.trace = None     # 该生成的追踪，由处理请求的任务设置
+        self._buffer: deque = deque(maxlen=capacity)
+        self._last_seq = 0
+        self._subscriber: Optional[asyncio.Queue] = None
+
+    @property
+    def attached(self) -> bool:
+        """
+        是否有客户端正在接收
+        """
+        return self._subscriber is not None
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        """
+        发布事件，分配序号后写入缓冲区并转发给订阅者
+
+        Args:
+            event: 事件
+        """
+        self._last_seq += 1
+        event = dict(event, seq=self._last_seq)
+        self._buffer.append(event)
+        if event["type"] == EVENT_DONE:
+            self.finished = True
+        if self._subscriber is not None:
+            self._subscriber.put_nowait(event)
+
+    def attach(self, after_seq: int = 0) -> Optional[asyncio.Queue]:
+        """
+        接入订阅者，先补发序号大于after_seq的缓冲事件
+
+        Args:
+            after_seq: 客户端已收到的最后一个事件的序号
+
+        Returns:
+            订阅队列（队列中的None表示订阅已关闭）；所需事件已被移出缓冲区时返回None
+        """
+        first_seq = self._buffer[0]["seq"] if self._buffer else self._last_seq + 1
+        if after_seq < first_seq - 1:
+            return None
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for event in self._buffer:
+            if event["seq"] > after_seq:
+                queue.put_nowait(event)
+
+        if self._subscriber is not None:
+            self._subscriber.put_nowait(None)
+        self._subscriber = queue
+        self.generation += 1
+        return queue
+
+    def detach(self, queue: asyncio.Queue) -> None:
+        """
+        移除订阅者
+
+        Args:
+            queue: attach返回的订阅队列
+        """
+        if self._subscriber is queue:
+            self._subscriber = None
+            queue.put_nowait(None)
+
+
+class StreamRegistry:
+    """
+    进行中和刚结束的流的注册表
+    """
+
+    def __init__(self, grace_seconds: float = STREAM_RESUME_GRACE_SECONDS,
+                 retention_seconds: float = STREAM_RETENTION_SECONDS):
+        """
+        初始化注册表
+
+        Args:
+            grace_seconds: 断开后等待重连的时间（秒）
+            retention_seconds: 结束后保留的时间（秒）
+        """
+        self.grace_seconds = grace_seconds
+        self.retention_seconds = retention_seconds
+        self._streams: Dict[str, ResumableStream] = {}
+
+    def create(self, stream_id: str, cancel_token: CancellationToken, owner: str) -> Optional[ResumableStream]:
+        """
+        创建流
+
+        Args:
+            stream_id: 流ID
+            cancel_token: 取消令牌
+            owner: 发起请求的客户端密钥
+
+        Returns:
+            新建的流，ID已被占用时返回None
+        """
+        if stream_id in self._streams:
+            return None
+        stream = ResumableStream(stream_id, cancel_token, owner)
+        self._streams[stream_id] = stream
+        return stream
+
+    def get(self, stream_id: str, owner: str) -> Optional[ResumableStream]:
+        """
+        获取客户端自己的流，其他客户端无法通过猜测请求ID读取输出或停止生成
+
+        Args:
+            stream_id: 流ID
+            owner: 客户端密钥
+
+        Returns:
+            流，不存在、已过期或不属于该客户端时返回None
+        """
+        stream = self._streams.get(stream_id)
+        if stream is None or not hmac.compare_digest(stream.owner, owner):
+            return None
+        return stream
+
+    def detach(self, stream: ResumableStream, queue: asyncio.Queue) -> None:
+        """
+        客户端断开时移除订阅者，超过等待时间仍未恢复则停止生成
+
+        Args:
+            stream: 流
+            queue: 订阅队列
+        """
+        stream.detach(queue)
+        if not stream.finished and not stream.attached:
+            asyncio.get_running_loop().call_later(self.grace_seconds, self._expire_detached, stream, stream.generation)
+
+    def _expire_detached(self, stream: ResumableStream, generation: int) -> None:
+        if not stream.finished and not stream.attached and stream.generation == generation:
+            print(f"流 {stream.stream_id} 在 {self.grace_seconds} 秒内未恢复，停止生成")
+            stream.cancel_token.cancel()
+
+    def finish(self, stream: ResumableStream) -> None:
+        """
+        生成结束，保留一段时间后从注册表中移除
+
+        Args:
+            stream: 流
+        """
+        asyncio.get_running_loop().call_later(self.retention_seconds, self._remove, stream)
+
+    def _remove(self, stream: ResumableStream) -> None:
+        if self._streams.get(stream.stream_id) is stream:
+            del self._streams[stream.stream_id]
+
+
+# 创建全局流注册表实例
+stream_registry = StreamRegistry()
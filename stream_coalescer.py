@@ -0,0 +1,125 @@
+"""
+流式输出合并模块
+将LLM的细碎增量事件按时间窗口和大小合并后再发送，减少WebSocket帧数；首个事件和非增量事件（标签边界、工具结果等）立即发送
+"""
+
+import os
+import asyncio
+from typing import AsyncIterator, AsyncGenerator, Dict, List, Any, Optional
+
+from stream_events import DELTA_EVENT_TYPES, make_event
+
+# 合并窗口（毫秒）：窗口内到达的同类增量合并为一帧
+COALESCE_WINDOW_MS = float(os.getenv("WS_COALESCE_WINDOW_MS", "30"))
+
+# 缓冲区达到该字符数时立即发送
+COALESCE_MAX_CHARS = int(os.getenv("WS_COALESCE_MAX_CHARS", "2048"))
+
+# 源流结束标记
+_END = object()
+
+
+class _SourceError:
+    """
+    包装源流中抛出的异常，交给消费方重新抛出
+    """
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+async def coalesce_stream(source: AsyncIterator[Dict[str, Any]],
+                          window_ms: float = COALESCE_WINDOW_MS,
+                          max_chars: int = COALESCE_MAX_CHARS) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    合并流式事件中连续的同类增量
+
+    Args:
+        source: 原始事件流
+        window_ms: 合并窗口（毫秒），小于等于0时不合并
+        max_chars: 单帧最大字符数
+
+    Yields:
+        合并后的事件
+    """
+    if window_ms <= 0:
+        async for event in source:
+            yield event
+        return
+
+    loop = asyncio.get_running_loop()
+    window = window_ms / 1000
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for event in source:
+                await queue.put(event)
+            await queue.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(_SourceError(e))
+
+    pump_task = asyncio.create_task(pump())
+
+    buffer_type: Optional[str] = None
+    buffer: List[str] = []
+    buffered_chars = 0
+    deadline = None
+    first_event = True
+
+    def take_buffer() -> Dict[str, Any]:
+        nonlocal buffer_type, buffer, buffered_chars, deadline
+        event = make_event(buffer_type, delta="".join(buffer))
+        buffer_type, buffer, buffered_chars, deadline = None, [], 0, None
+        return event
+
+    try:
+        while True:
+            if deadline is None:
+                item = await queue.get()
+            else:
+                try:
+                    item = await asyncio.wait_for(queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    # 窗口到期，发送已缓冲的内容
+                    yield take_buffer()
+                    continue
+
+            if item is _END:
+                break
+            if isinstance(item, _SourceError):
+                if buffer:
+                    yield take_buffer()
+                raise item.error
+
+            # 首个事件立即发送，保证首token延迟不变
+            if first_event:
+                first_event = False
+                yield item
+                continue
+
+            if item["type"] not in DELTA_EVENT_TYPES:
+                # 边界事件：先发送已缓冲的增量，再立即发送该事件
+                if buffer:
+                    yield take_buffer()
+                yield item
+                continue
+
+            if buffer and item["type"] != buffer_type:
+                yield take_buffer()
+
+            buffer_type = item["type"]
+            buffer.append(item["delta"])
+            buffered_chars += len(item["delta"])
+            if deadline is None:
+                deadline = loop.time() + window
+
+            if buffered_chars >= max_chars:
+                yield take_buffer()
+
+        if buffer:
+            yield take_buffer()
+    finally:
+        pump_task.cancel()
@@ -0,0 +1,218 @@
+"""
+流式事件模块
+定义process_message产生的类型化事件，并将LLM输出中的<think>、<tool>标签增量解析为事件，
+使前端按事件类型直接路由内容，无需在文本缓冲区中扫描标签
+"""
+
+import json
+from typing import Dict, List, Any, Optional
+
+# 事件类型
+EVENT_TEXT = "text"                         # 正文增量: {"delta"}
+EVENT_THINK_START = "think_start"           # 思考过程开始
+EVENT_THINK_DELTA = "think_delta"           # 思考过程增量: {"delta"}
+EVENT_THINK_END = "think_end"               # 思考过程结束
+EVENT_TOOL_CALL_START = "tool_call_start"   # 工具调用开始
+EVENT_TOOL_CALL_DELTA = "tool_call_delta"   # 工具调用内容增量: {"delta"}
+EVENT_TOOL_CALL_END = "tool_call_end"       # 工具调用结束: {"name", "parameters"}（解析失败时为None）
+EVENT_TOOL_RESULT = "tool_result"           # 工具结果: {"name", "result"} 或 {"name", "error"}
+EVENT_USAGE = "usage"                       # token用量: {"prompt_tokens", "completion_tokens", "total_tokens", "estimated"}
+EVENT_DONE = "done"                         # 本轮结束
+EVENT_ERROR = "error"                       # 错误: {"message", "fatal"}
+
+# 携带文本增量、可以合并的事件类型
+DELTA_EVENT_TYPES = (EVENT_TEXT, EVENT_THINK_DELTA, EVENT_TOOL_CALL_DELTA)
+
+# LLM输出中的标签: 标签名 -> (开始标签, 结束标签, 开始事件, 增量事件, 结束事件)
+_TAGS = {
+    "think": ("<think>", "</think>", EVENT_THINK_START, EVENT_THINK_DELTA, EVENT_THINK_END),
+    "tool": ("<tool>", "</tool>", EVENT_TOOL_CALL_START, EVENT_TOOL_CALL_DELTA, EVENT_TOOL_CALL_END),
+}
+_MAX_TAG_LENGTH = max(len(tag) for config in _TAGS.values() for tag in config[:2])
+
+
+def make_event(event_type: str, **fields: Any) -> Dict[str, Any]:
+    """
+    创建事件
+
+    Args:
+        event_type: 事件类型
+        **fields: 事件字段
+
+    Returns:
+        事件字典
+    """
+    event = {"type": event_type}
+    event.update(fields)
+    return event
+
+
+def error_event(message: str, fatal: bool = True) -> Dict[str, Any]:
+    """
+    创建错误事件
+
+    Args:
+        message: 错误信息
+        fatal: 是否导致本轮中止
+
+    Returns:
+        错误事件
+    """
+    return make_event(EVENT_ERROR, message=message, fatal=fatal)
+
+
+def serialize_event(event: Dict[str, Any]) -> str:
+    """
+    将事件序列化为紧凑的JSON帧
+
+    Args:
+        event: 事件
+
+    Returns:
+        JSON字符串
+    """
+    return json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+
+
+def event_to_text(event: Dict[str, Any]) -> str:
+    """
+    将事件还原为带标签的文本，用于命令行等只能显示纯文本的场景
+
+    Args:
+        event: 事件
+
+    Returns:
+        文本
+    """
+    event_type = event["type"]
+    if event_type in DELTA_EVENT_TYPES:
+        return event["delta"]
+    if event_type == EVENT_THINK_START:
+        return "<think>"
+    if event_type == EVENT_THINK_END:
+        return "</think>"
+    if event_type == EVENT_TOOL_CALL_START:
+        return "<tool>"
+    if event_type == EVENT_TOOL_CALL_END:
+        return "</tool>"
+    if event_type == EVENT_TOOL_RESULT:
+        payload = {key: value for key, value in event.items() if key != "type"}
+        return f"\n<tool_result>\n{json.dumps(payload, ensure_ascii=False, indent=2)}\n</tool_result>\n"
+    if event_type == EVENT_ERROR:
+        return f"\n错误: {event['message']}\n"
+    return ""
+
+
+class TagStreamParser:
+    """
+    增量解析LLM输出中的<think>和<tool>标签，将文本块转换为事件
+
+    只在缓冲区末尾可能是不完整标签时保留少量字符，其余内容立即输出
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._active: Optional[str] = None  # 当前所在标签名，None表示在正文中
+        self._tool_text: List[str] = []
+
+    def _delta_type(self) -> str:
+        return _TAGS[self._active][3] if self._active else EVENT_TEXT
+
+    def _partial_tag_length(self, text: str, candidates: List[str]) -> int:
+        """
+        返回文本末尾可能是不完整标签的字符数
+        """
+        index = text.rfind("<", max(len(text) - _MAX_TAG_LENGTH, 0))
+        if index == -1:
+            return 0
+        suffix = text[index:]
+        if any(tag.startswith(suffix) for tag in candidates):
+            return len(suffix)
+        return 0
+
+    def _emit_delta(self, events: List[Dict[str, Any]], text: str) -> None:
+        if not text:
+            return
+        if self._active == "tool":
+            self._tool_text.append(text)
+        events.append(make_event(self._delta_type(), delta=text))
+
+    def _end_event(self) -> Dict[str, Any]:
+        tag = self._active
+        self._active = None
+        if tag != "tool":
+            return make_event(_TAGS[tag][4])
+
+        # 工具调用结束时解析工具名称和参数
+        tool_text = "".join(self._tool_text).strip()
+        self._tool_text = []
+        name, parameters = None, None
+        try:
+            tool_data = json.loads(tool_text)
+            name = tool_data.get("name")
+            parameters = tool_data.get("parameters", {})
+        except Exception:
+            pass
+        return make_event(EVENT_TOOL_CALL_END, name=name, parameters=parameters)
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """
+        输入一个文本块
+
+        Args:
+            text: LLM输出的文本块
+
+        Returns:
+            解析出的事件列表
+        """
+        buffer = self._buffer + text
+        events: List[Dict[str, Any]] = []
+
+        while buffer:
+            if self._active is None:
+                # 查找最早出现的开始标签
+                earliest_tag, earliest_index = None, -1
+                for tag, config in _TAGS.items():
+                    index = buffer.find(config[0])
+                    if index != -1 and (earliest_index == -1 or index < earliest_index):
+                        earliest_tag, earliest_index = tag, index
+
+                if earliest_tag is not None:
+                    self._emit_delta(events, buffer[:earliest_index])
+                    events.append(make_event(_TAGS[earliest_tag][2]))
+                    self._active = earliest_tag
+                    buffer = buffer[earliest_index + len(_TAGS[earliest_tag][0]):]
+                    continue
+
+                keep = self._partial_tag_length(buffer, [config[0] for config in _TAGS.values()])
+            else:
+                close_tag = _TAGS[self._active][1]
+                index = buffer.find(close_tag)
+                if index != -1:
+                    self._emit_delta(events, buffer[:index])
+                    events.append(self._end_event())
+                    buffer = buffer[index + len(close_tag):]
+                    continue
+
+                keep = self._partial_tag_length(buffer, [close_tag])
+
+            self._emit_delta(events, buffer[:len(buffer) - keep])
+            buffer = buffer[len(buffer) - keep:]
+            break
+
+        self._buffer = buffer
+        return events
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """
+        结束解析，输出缓冲区中剩余的内容并关闭未闭合的标签
+
+        Returns:
+            事件列表
+        """
+        events: List[Dict[str, Any]] = []
+        self._emit_delta(events, self._buffer)
+        self._buffer = ""
+        if self._active is not None:
+            events.append(self._end_event())
+        return events
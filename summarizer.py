@@ -0,0 +1,99 @@
+"""
+会话滚动摘要模块
+当会话中未压缩的历史超过阈值时，在后台将较早的对话增量压缩为摘要，使每轮提示词大小基本保持恒定
+"""
+
+import os
+import re
+from typing import List, Dict, Any, Optional
+
+import db_utils
+from memory_index import estimate_tokens
+
+# 未压缩历史超过该token数时触发摘要
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "6000"))
+
+# 始终保留原文的最近消息数
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "6"))
+
+# 单次摘要最多压缩的对话token数，超出部分留给后续轮次继续压缩
+SUMMARY_BATCH_TOKENS = int(os.getenv("SUMMARY_BATCH_TOKENS", "8000"))
+
+# 摘要中单条消息的最大字符数（工具结果等长消息会被截断）
+SUMMARY_MESSAGE_MAX_CHARS = 2000
+
+SUMMARY_SYSTEM_PROMPT = "你是一个对话摘要助手。请将对话内容压缩为简洁的摘要，保留用户的目标、关键事实、已得出的结论、工具调用的重要结果以及尚未解决的问题。只输出摘要本身，使用中文，不超过800字。"
+
+
+def needs_summary(recent: List[Dict[str, str]]) -> bool:
+    """
+    判断未压缩的历史是否需要摘要
+
+    Args:
+        recent: 未被摘要覆盖的对话历史
+
+    Returns:
+        是否需要摘要
+    """
+    if len(recent) <= SUMMARY_KEEP_RECENT:
+        return False
+    return sum(estimate_tokens(message["content"]) for message in recent) > SUMMARY_TRIGGER_TOKENS
+
+
+def _select_messages_to_fold(conversations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    从未压缩的对话中选出本次要压缩的消息：保留最近的消息，且不超过单次压缩的token数
+    """
+    candidates = conversations[:-SUMMARY_KEEP_RECENT] if SUMMARY_KEEP_RECENT > 0 else conversations
+    selected = []
+    tokens = 0
+    for conv in candidates:
+        tokens += estimate_tokens(conv["content"][:SUMMARY_MESSAGE_MAX_CHARS])
+        if selected and tokens > SUMMARY_BATCH_TOKENS:
+            break
+        selected.append(conv)
+    return selected
+
+
+async def summarize_session(llm_client, session_id: int) -> Optional[Dict[str, Any]]:
+    """
+    将会话中尚未压缩的较早对话合并到摘要中
+
+    Args:
+        llm_client: 用于生成摘要的LLMClient
+        session_id: 会话ID
+
+    Returns:
+        更新后的摘要信息，没有需要压缩的消息或生成失败时返回None
+    """
+    summary = db_utils.get_summary(session_id)
+    last_message_id = summary["last_message_id"] if summary else 0
+
+    conversations = [conv for conv in db_utils.get_conversations(session_id) if conv["id"] > last_message_id]
+    to_fold = _select_messages_to_fold(conversations)
+    if not to_fold:
+        return None
+
+    transcript = "\n\n".join(
+        f"{conv['role']}: {conv['content'][:SUMMARY_MESSAGE_MAX_CHARS]}" for conv in to_fold
+    )
+    previous = summary["content"] if summary else "（无）"
+    messages = [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": f"已有摘要:\n{previous}\n\n新增对话:\n{transcript}\n\n请输出合并新增对话后的完整摘要。"}
+    ]
+
+    content = ""
+    async for chunk in llm_client.call_llm_api(messages):
+        if isinstance(chunk, str) and chunk.startswith("错误:"):
+            print(f"生成会话 {session_id} 的摘要时出错: {chunk}")
+            return None
+        content += chunk
+
+    # 去掉模型输出的思考过程
+    content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL).strip()
+    if not content:
+        return None
+
+    db_utils.save_summary(session_id, content, to_fold[-1]["id"])
+    return db_utils.get_summary(session_id)
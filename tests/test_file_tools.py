@@ -0,0 +1,44 @@
+"""
+文件读写辅助模块的测试：按行替换时范围之外的内容按字节原样保留
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_tools import replace_lines
+
+
+class ReplaceLinesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = Path(self.dir.name) / "file.txt"
+
+    def replace(self, data: bytes, start_line: int, end_line: int, content: str) -> bytes:
+        self.path.write_bytes(data)
+        replace_lines(self.path, start_line, end_line, content)
+        return self.path.read_bytes()
+
+    def test_preserves_crlf_and_invalid_bytes(self):
+        self.assertEqual(self.replace(b'a\r\nb\r\nc\xff\r\n', 2, 2, 'B'), b'a\r\nB\r\nc\xff\r\n')
+
+    def test_multiline_content_uses_file_newlines(self):
+        self.assertEqual(self.replace(b'a\r\nb\r\n', 1, 1, 'x\ny\n'), b'x\r\ny\r\nb\r\n')
+
+    def test_lf_file(self):
+        self.assertEqual(self.replace(b'a\nb\nc\n', 2, 3, 'B'), b'a\nB\n')
+
+    def test_insert_before_line(self):
+        self.assertEqual(self.replace(b'a\n\xfe\n', 2, 1, 'x'), b'a\nx\n\xfe\n')
+
+    def test_append_past_end_without_trailing_newline(self):
+        self.assertEqual(self.replace(b'a\r\nb', 5, 5, 'c'), b'a\r\nb\r\nc\r\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
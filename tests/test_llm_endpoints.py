@@ -0,0 +1,47 @@
+"""
+LLM端点池的测试：LLM_ENDPOINTS为空或无法解析时回退到LLM_API_URL，端点池不接受空列表
+"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_endpoints
+from llm_endpoints import EndpointPool, LLMEndpoint
+
+
+class LoadEndpointsTest(unittest.TestCase):
+    def load(self, value: str):
+        with mock.patch.object(llm_endpoints, "LLM_ENDPOINTS", value), \
+                mock.patch.dict(os.environ, {"LLM_API_URL": "http://fallback/v1/chat/completions"}):
+            return llm_endpoints._load_endpoints()
+
+    def test_configured_endpoints(self):
+        endpoints = self.load('[{"url": "http://a", "model": "m"}, {"name": "b", "url": "http://b", "model": "m"}]')
+        self.assertEqual([endpoint.name for endpoint in endpoints], ["endpoint-1", "b"])
+
+    def test_empty_list_falls_back(self):
+        endpoints = self.load("[]")
+        self.assertEqual([endpoint.url for endpoint in endpoints], ["http://fallback/v1/chat/completions"])
+
+    def test_invalid_config_falls_back(self):
+        for value in ("not json", '{"url": "http://a"}', '["http://a"]', '[{"url": "http://a"}]'):
+            with self.subTest(value=value):
+                self.assertEqual([endpoint.name for endpoint in self.load(value)], ["default"])
+
+
+class EndpointPoolTest(unittest.TestCase):
+    def test_rejects_empty(self):
+        with self.assertRaises(ValueError):
+            EndpointPool([])
+
+    def test_plan_cycles_endpoints(self):
+        pool = EndpointPool([LLMEndpoint("a", "http://a", "m"), LLMEndpoint("b", "http://b", "m")])
+        self.assertEqual([endpoint.name for endpoint in pool.plan(3)], ["a", "b", "a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,216 @@
+"""
+LLM请求调度器的测试：令牌桶补充、会话间公平、限流时不阻塞其他模型，以及服务商返回429后的处理
+
+令牌桶按分钟计算额度，测试用可控的时钟替换llm_scheduler模块中的time，推进时钟后手动调度
+"""
+
+import os
+import sys
+import asyncio
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_scheduler
+from llm_scheduler import LLMScheduler, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class RateLimitedServer:
+    """
+    本地模拟的LLM服务：按固定的一分钟窗口计数，窗口内的请求数超过rpm时返回429
+    （与调度器的令牌桶独立实现，窗口从第一个请求开始）
+    """
+
+    def __init__(self, clock: FakeClock, rpm: int):
+        self.clock = clock
+        self.rpm = rpm
+        self.window_start = None
+        self.window_count = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def complete(self) -> int:
+        now = self.clock.now
+        if self.window_start is None or now - self.window_start >= 60:
+            self.window_start = now
+            self.window_count = 0
+        if self.window_count >= self.rpm:
+            self.rejected += 1
+            return 429
+        self.window_count += 1
+        self.accepted += 1
+        return 200
+
+
+class ClockTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(llm_scheduler, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def settle(self):
+        # 让获准的等待方继续执行
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+
+class TokenBucketTest(ClockTestCase):
+    def test_refill(self):
+        bucket = TokenBucket(60)
+        bucket.consume(60)
+        self.assertAlmostEqual(bucket.delay(1), 1.0)
+        self.clock.advance(0.5)
+        self.assertAlmostEqual(bucket.delay(1), 0.5)
+        self.clock.advance(0.5)
+        self.assertEqual(bucket.delay(1), 0)
+
+    def test_refill_capped_at_capacity(self):
+        bucket = TokenBucket(60)
+        bucket.consume(30)
+        self.clock.advance(600)
+        self.assertEqual(bucket.delay(60), 0)
+        bucket.consume(60)
+        self.assertGreater(bucket.delay(1), 0)
+
+    def test_refund(self):
+        bucket = TokenBucket(60)
+        bucket.consume(60)
+        bucket.consume(-10)
+        self.assertEqual(bucket.delay(10), 0)
+
+    def test_unlimited(self):
+        bucket = TokenBucket(0)
+        bucket.consume(10 ** 9)
+        self.assertEqual(bucket.delay(10 ** 9), 0)
+
+
+class LLMSchedulerTest(ClockTestCase):
+    async def test_fair_across_sessions(self):
+        scheduler = LLMScheduler(max_concurrency=1)
+        order = []
+
+        async def request(session_id):
+            reservation = await scheduler.acquire(session_id, "model", 10)
+            order.append(session_id)
+            await asyncio.sleep(0)
+            scheduler.release(reservation)
+
+        tasks = [asyncio.create_task(request("heavy")) for _ in range(6)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(request(f"light-{i}")) for i in range(2)]
+        await asyncio.gather(*tasks)
+
+        # 不轮转时轻量会话要排在重度会话的6个请求之后
+        self.assertEqual(len(order), 8)
+        self.assertLess(max(order.index("light-0"), order.index("light-1")), 5)
+
+    async def test_rate_limited_head_does_not_block_other_models(self):
+        scheduler = LLMScheduler(max_concurrency=4, model_limits={"slow": {"rpm": 1}})
+        first = await scheduler.acquire("a", "slow", 10)
+
+        blocked = asyncio.create_task(scheduler.acquire("a", "slow", 10))
+        other = asyncio.create_task(scheduler.acquire("b", "fast", 10))
+        await self.settle()
+
+        self.assertTrue(other.done())
+        self.assertFalse(blocked.done())
+        self.assertEqual(scheduler.get_stats()["rate_limited_waits"], 1)
+
+        self.clock.advance(60)
+        scheduler._dispatch()
+        await self.settle()
+        self.assertTrue(blocked.done())
+
+        for reservation in (first, other.result(), blocked.result()):
+            scheduler.release(reservation)
+        self.assertEqual(scheduler.get_stats()["in_flight"], 0)
+
+    async def test_paces_requests_below_server_limit(self):
+        server = RateLimitedServer(self.clock, rpm=10)
+        scheduler = LLMScheduler(max_concurrency=20, rpm_limit=10)
+        statuses = []
+
+        async def request(session_id):
+            reservation = await scheduler.acquire(session_id, "model", 10)
+            try:
+                statuses.append(server.complete())
+            finally:
+                scheduler.release(reservation)
+
+        tasks = [asyncio.create_task(request(i % 3)) for i in range(15)]
+        await self.settle()
+        self.assertEqual(len(statuses), 10)
+
+        # 服务端进入下一个窗口，调度器的令牌桶同时补满
+        self.clock.advance(60)
+        scheduler._dispatch()
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(statuses, [200] * 15)
+        self.assertEqual(server.rejected, 0)
+
+        # 不经过调度器时同样的突发请求会收到429
+        direct = RateLimitedServer(self.clock, rpm=10)
+        self.assertEqual([direct.complete() for _ in range(15)].count(429), 5)
+
+    async def test_pause_after_429(self):
+        scheduler = LLMScheduler(max_concurrency=4)
+        scheduler.report_rate_limited("model", retry_after=2)
+
+        paused = asyncio.create_task(scheduler.acquire("a", "model", 10))
+        other = asyncio.create_task(scheduler.acquire("b", "other", 10))
+        await self.settle()
+        self.assertFalse(paused.done())
+        self.assertTrue(other.done())
+
+        self.clock.advance(2)
+        scheduler._dispatch()
+        await self.settle()
+        self.assertTrue(paused.done())
+        self.assertEqual(scheduler.get_stats()["rate_limited_responses"], 1)
+
+        scheduler.release(paused.result())
+        scheduler.release(other.result())
+
+    async def test_pause_without_retry_after(self):
+        scheduler = LLMScheduler(max_concurrency=4)
+        scheduler.report_rate_limited("model")
+
+        paused = asyncio.create_task(scheduler.acquire("a", "model", 10))
+        await self.settle()
+        self.assertFalse(paused.done())
+
+        self.clock.advance(llm_scheduler.LLM_RATE_LIMIT_PAUSE)
+        scheduler._dispatch()
+        await self.settle()
+        self.assertTrue(paused.done())
+        scheduler.release(paused.result())
+
+    async def test_cancelled_waiter_leaves_queue(self):
+        scheduler = LLMScheduler(max_concurrency=1)
+        first = await scheduler.acquire("a", "model", 10)
+        waiting = asyncio.create_task(scheduler.acquire("b", "model", 10))
+        await self.settle()
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(scheduler.get_stats()["queue_depth"], 0)
+        scheduler.release(first)
+        self.assertEqual(scheduler.get_stats()["in_flight"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+会话锁的测试：同一会话的两个锁对象（相当于两个工作进程）互斥，不同会话互不影响，等待时取消不残留锁
+
+flock按打开的文件互斥，同一进程中分别打开锁文件的两个SessionLock与两个进程中的情况相同
+"""
+
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import session_lock
+from session_lock import SessionLock
+
+
+@unittest.skipIf(session_lock.fcntl is None, "需要fcntl")
+class SessionLockTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        patcher = mock.patch.object(session_lock, "SESSION_LOCK_POLL_INTERVAL", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_lock(self, session_id: int) -> SessionLock:
+        return SessionLock(session_id, self.dir.name)
+
+    async def test_excludes_other_process(self):
+        first, second = self.make_lock(1), self.make_lock(1)
+        await first.acquire()
+
+        waiting = asyncio.create_task(second.acquire())
+        await asyncio.sleep(0.05)
+        self.assertFalse(waiting.done())
+
+        first.release()
+        await asyncio.wait_for(waiting, 1)
+        self.assertTrue(second.locked())
+        second.release()
+        self.assertFalse(second.locked())
+
+    async def test_other_session_not_blocked(self):
+        first, other = self.make_lock(1), self.make_lock(2)
+        await first.acquire()
+        await asyncio.wait_for(other.acquire(), 1)
+        other.release()
+        first.release()
+
+    async def test_cancel_while_waiting(self):
+        first, second = self.make_lock(1), self.make_lock(1)
+        await first.acquire()
+
+        waiting = asyncio.create_task(second.acquire())
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertFalse(second.locked())
+
+        first.release()
+        await asyncio.wait_for(second.acquire(), 1)
+        second.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,315 @@
+"""
+轻量追踪模块
+为每轮对话记录嵌套的耗时片段（LLM流、工具调用、数据库写入、WebSocket发送等）及其大小，
+最近的追踪保存在环形缓冲区中，可通过/api/traces查看，也可以按OTLP JSON格式追加写入本地文件
+"""
+
+import os
+import json
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional
+
+# 内存中保留的最近追踪数
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "100"))
+
+# 追踪结束时按OTLP JSON格式追加写入的文件（每行一个ExportTraceServiceRequest），为空时不导出
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")
+
+# 导出时使用的服务名称
+TRACE_SERVICE_NAME = "SimpleLLMChatWithMCP"
+
+# 当前片段（协程和由其创建的任务共享）
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    追踪中的一个耗时片段
+    """
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self.end_time: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        """
+        设置属性
+
+        Args:
+            **attributes: 属性
+        """
+        self.attributes.update(attributes)
+
+    def end(self) -> None:
+        """
+        结束片段；可以多次调用，以最后一次为准（用于持续累积的片段）
+        """
+        self.end_time = time.time()
+
+    @property
+    def duration(self) -> float:
+        """
+        耗时（秒），未结束时为到目前为止的耗时
+        """
+        return (self.end_time if self.end_time is not None else time.time()) - self.start_time
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        转换为字典
+
+        Returns:
+            片段信息字典
+        """
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+class _NoopSpan:
+    """
+    没有进行中的追踪时使用的空片段
+    """
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """
+    一轮对话的追踪
+    """
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        self.trace_id = os.urandom(16).hex()
+        self.spans: List[Span] = []
+        self.root = self.start_span(name, None, attributes)
+
+    def start_span(self, name: str, parent: Optional[Span] = None, attributes: Optional[Dict[str, Any]] = None) -> Span:
+        """
+        开始一个片段
+
+        Args:
+            name: 片段名称
+            parent: 父片段，None表示根片段
+            attributes: 属性
+
+        Returns:
+            片段
+        """
+        span = Span(self, name, parent.span_id if parent is not None else None, attributes or {})
+        self.spans.append(span)
+        return span
+
+    def to_dict(self, include_spans: bool = True) -> Dict[str, Any]:
+        """
+        转换为字典
+
+        Args:
+            include_spans: 是否包含片段树；为False时只包含摘要和各类片段的耗时合计
+
+        Returns:
+            追踪信息字典
+        """
+        result = {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "start_time": self.root.start_time,
+            "duration_ms": round(self.root.duration * 1000, 3),
+            "attributes": self.root.attributes,
+            "span_count": len(self.spans)
+        }
+        if include_spans:
+            nodes = {span.span_id: dict(span.to_dict(), children=[]) for span in self.spans}
+            for span in self.spans:
+                if span.parent_id in nodes:
+                    nodes[span.parent_id]["children"].append(nodes[span.span_id])
+            result["root"] = nodes[self.root.span_id]
+        else:
+            # 按片段名称（去掉方括号中的工具名）合计耗时，便于快速定位慢的环节
+            totals: Dict[str, float] = {}
+            for span in self.spans[1:]:
+                kind = span.name.split("[", 1)[0]
+                totals[kind] = totals.get(kind, 0.0) + span.duration * 1000
+            result["totals_ms"] = {kind: round(value, 3) for kind, value in totals.items()}
+        return result
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """
+        转换为OTLP JSON格式（ExportTraceServiceRequest）
+
+        Returns:
+            OTLP JSON字典
+        """
+        def attribute(key: str, value: Any) -> Dict[str, Any]:
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            if isinstance(value, float):
+                return {"key": key, "value": {"doubleValue": value}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        spans = []
+        for span in self.spans:
+            item = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(int(span.start_time * 1e9)),
+                "endTimeUnixNano": str(int((span.start_time + span.duration) * 1e9)),
+                "attributes": [attribute(key, value) for key, value in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {}
+            }
+            if span.parent_id:
+                item["parentSpanId"] = span.parent_id
+            spans.append(item)
+
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [attribute("service.name", TRACE_SERVICE_NAME)]},
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}]
+            }]
+        }
+
+
+class Tracer:
+    """
+    追踪记录器，保存最近的追踪
+    """
+
+    def __init__(self, buffer_size: int = TRACE_BUFFER_SIZE, export_file: str = TRACE_EXPORT_FILE):
+        """
+        初始化追踪记录器
+
+        Args:
+            buffer_size: 保留的最近追踪数
+            export_file: OTLP JSON导出文件路径，为空时不导出
+        """
+        self.export_file = export_file
+        self._traces: deque = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def trace(self, name: str, **attributes: Any):
+        """
+        开始一次追踪，期间（包括其中创建的任务）通过span()记录的片段都属于这次追踪
+
+        Args:
+            name: 追踪名称
+            **attributes: 根片段的属性
+
+        Yields:
+            追踪
+        """
+        trace = Trace(name, attributes)
+        with self._lock:
+            self._traces.append(trace)
+        previous = _current_span.set(trace.root)
+        try:
+            yield trace
+        finally:
+            trace.root.end()
+            _current_span.reset(previous)
+            if self.export_file:
+                self._export(trace)
+
+    def _export(self, trace: Trace) -> None:
+        try:
+            with open(self.export_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(trace.to_otlp(), ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"导出追踪时出错: {str(e)}")
+
+    def get_traces(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        获取最近的追踪摘要，最新的在前
+
+        Args:
+            limit: 最大数量
+
+        Returns:
+            追踪摘要列表
+        """
+        with self._lock:
+            traces = list(self._traces)[-limit:] if limit > 0 else []
+        return [trace.to_dict(include_spans=False) for trace in reversed(traces)]
+
+    def get_trace(self, trace_id: str) -> Optional[Dict[str, Any]]:
+        """
+        获取一次追踪的完整片段树
+
+        Args:
+            trace_id: 追踪ID
+
+        Returns:
+            追踪信息字典，不存在时返回None
+        """
+        with self._lock:
+            for trace in self._traces:
+                if trace.trace_id == trace_id:
+                    return trace.to_dict()
+        return None
+
+
+def current_span() -> Optional[Span]:
+    """
+    获取当前片段
+
+    Returns:
+        当前片段，没有进行中的追踪时返回None
+    """
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes: Any):
+    """
+    在当前片段下记录一个子片段；没有进行中的追踪时不做任何记录
+
+    Args:
+        name: 片段名称，例如"llm_stream"、"tool_call[fetch_web_content]"
+        **attributes: 属性
+
+    Yields:
+        片段（可调用set()补充属性）
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield _NOOP_SPAN
+        return
+
+    child = parent.trace.start_span(name, parent, attributes)
+    _current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        child.end()
+        # 异步生成器可能在其他上下文中结束，直接恢复父片段而不使用reset
+        _current_span.set(parent)
+
+
+# 创建全局追踪记录器实例
+tracer = Tracer()